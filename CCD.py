@@ -3,12 +3,19 @@ import numpy as np
 import zachopy.utils
 import astropy.io.fits
 import scipy.ndimage.measurements
+import scipy.sparse
+import scipy.interpolate
 import os
 import matplotlib.pylab as plt
 import matplotlib.gridspec as gridspec
 import Cosmics
+import CosmicLibrary
+import Noisemaker
 import Stamper
+import Workers
+import Spherical
 import logging
+import settings
 from settings import log_file_handler
 
 logger = logging.getLogger(__name__)
@@ -20,10 +27,122 @@ np.set_printoptions(threshold=1e6, linewidth=300)
 
 zipsuffix = ''
 
+# the background rates (electrons/s) already calculated, for any camera's CCDs (see CCD.backgroundRateImage)
+backgroundrates = {}
+
+# bump this whenever the background models change, so rates cached on disk get recalculated
+backgroundmodelversion = 1
+
 # define mapping between CCD number and quadrant
 quadrants = {1: (1, 1), 2: (-1, 1), 3: (-1, -1), 4: (1, -1), 0: None}
 
 
+def exposurePRNG(seed, cadence, ccd, counter, stream=0):
+    """An independent random number generator for one exposure, depending only on (seed, cadence, ccd, counter).
+
+        (stream > 0 gives other generators for the same exposure, independent of the first)"""
+    key = [int(seed), int(cadence), int(ccd), int(counter)]
+    if stream > 0:
+        key.append(int(stream))
+    try:
+        return np.random.Generator(np.random.PCG64(np.random.SeedSequence(key)))
+    except AttributeError:
+        # (older numpy has no Generator; seeding the Mersenne Twister with the whole key still keeps streams apart)
+        return np.random.RandomState(key)
+
+
+# label runs of pixels that are connected only along a column
+columnstructure = np.array([[0, 1, 0], [0, 1, 0], [0, 1, 0]])
+
+
+def spillRuns(columns, column, lo, hi, flux, saturation_limit):
+    """Fill rows [lo, hi] of each (column) to the saturation limit, spilling half of the rest of [flux] over each end."""
+
+    nrows = columns.shape[0]
+
+    # saturate the pixels needed (listing the rows each run covers, one after another)
+    length = hi - lo + 1
+    offset = np.arange(np.sum(length)) - np.repeat(np.cumsum(length) - length, length)
+    columns[np.repeat(lo, length) + offset, np.repeat(column, length)] = saturation_limit
+    leftoverflux = flux - length * saturation_limit
+
+    # split what's left between the pixels just past each end (or all onto one, at the edge of the detector)
+    leftedge, rightedge = lo - 1, hi + 1
+    leftok, rightok = leftedge >= 0, rightedge < nrows
+    if (~leftok & ~rightok).any():
+        logger.info("this star seems to saturate the entire detector!")
+    leftshare = np.where(rightok, 0.5, 1.0) * leftok
+    rightshare = np.where(leftok, 0.5, 1.0) * rightok
+    np.add.at(columns, (leftedge[leftok], column[leftok]), (leftshare * leftoverflux)[leftok])
+    np.add.at(columns, (rightedge[rightok], column[rightok]), (rightshare * leftoverflux)[rightok])
+
+
+def bleedColumns(columns, saturation_limit):
+    """Bleed each oversaturated run of pixels up and down its column (in place), returning how many runs were bled.
+
+        A run holding more than its share of charge spreads out symmetrically about its center, filling
+        as many whole pixels as its charge (plus the charge already there) can saturate, and splits what's
+        left between the two pixels just beyond. All the runs are found and measured at once, as arrays,
+        and then bled in turns: the first oversaturated run of every column, then the second, and so on."""
+
+    nrows = columns.shape[0]
+
+    # find every continuous run of saturated pixels, in any column
+    labels, nruns = scipy.ndimage.measurements.label(columns >= saturation_limit, structure=columnstructure)
+    if nruns == 0:
+        return 0
+
+    # measure each run's length, center, column, and whether it's oversaturated
+    flat = labels.ravel()
+    rows, cols = np.indices(columns.shape)
+    count = np.bincount(flat, minlength=nruns + 1)[1:]
+    center = np.bincount(flat, weights=rows.ravel(), minlength=nruns + 1)[1:] / count
+    column = np.round(np.bincount(flat, weights=cols.ravel(), minlength=nruns + 1)[1:] / count).astype(np.int)
+    over = np.bincount(flat, weights=(columns > saturation_limit).ravel(), minlength=nruns + 1)[1:] > 0
+
+    # only the oversaturated runs need to bleed (sorted along each column)
+    first = np.round(center - (count - 1) / 2.0).astype(np.int)
+    order = np.lexsort((first, column))
+    order = order[over[order]]
+    first, last = first[order], first[order] + count[order] - 1
+    center, column = center[order], column[order]
+    if len(order) == 0:
+        return 0
+
+    # how far from its center can each run totally saturate pixels?
+    def extent(flux, center):
+        grow = (flux / saturation_limit - 1.0) / 2.0
+        lo = np.maximum(np.ceil(center - grow).astype(np.int), 0)
+        hi = np.minimum(np.floor(center + grow).astype(np.int), nrows - 1)
+        return lo, hi
+
+    # the runs in a column take turns, in order down it (charge spilled by one can change how far the next
+    #  reaches), but columns don't affect each other; so on each turn, one run from every column bleeds at once
+    startsacolumn = np.ones(len(order), dtype=np.bool)
+    startsacolumn[1:] = column[1:] != column[:-1]
+    starts = np.nonzero(startsacolumn)[0]
+    turn = np.arange(len(order)) - np.repeat(starts, np.diff(np.append(starts, len(order))))
+
+    def sums(column, lo, hi):
+        """The charge in rows [lo, hi] of each (column).
+
+            (added up within just those rows, not as differences of running totals down the whole column,
+             so a run of exactly saturated pixels adds up to exactly its share and doesn't bleed again)"""
+        flat = np.append(columns.T.ravel(), 0)
+        edges = np.empty(2 * len(column), dtype=np.int)
+        edges[0::2], edges[1::2] = column * nrows + lo, column * nrows + hi + 1
+        return np.add.reduceat(flat, edges, dtype=np.float64)[0::2]
+
+    for k in range(turn.max() + 1):
+        i = turn == k
+
+        # bleed each run's charge (as it is now), with the charge already in the pixels it'll cover
+        lo, hi = extent(sums(column[i], first[i], last[i]), center[i])
+        spillRuns(columns, column[i], lo, hi, sums(column[i], lo, hi), saturation_limit)
+
+    return len(order)
+
+
 class CCD(object):
     def __init__(self, number=1, camera=None, subarray=None, label='', display=False):
         """Turn on a TESS CCD, which can be used to make simulated images.
@@ -71,6 +190,12 @@ class CCD(object):
         self.display = display
         self.plot = False
 
+        # image-sized arrays that are reused from exposure to exposure (see scratch)
+        self.scratchbuffers = {}
+
+        # where the stars were when each cache of rendered stars was made, keyed by cache (see starsHaveMoved)
+        self.starcaches = {}
+
         logger.info('created CCD #{}, of size {}x{}'.format(
             self.number, self.xsize, self.ysize))
 
@@ -197,11 +322,22 @@ class CCD(object):
 
     def zeros(self):
         """Create an image of zeros, the same size as the CCD."""
-        return np.zeros((self.xsize, self.ysize))
+        return np.zeros((self.xsize, self.ysize), dtype=self.camera.imagedtype)
 
     def ones(self):
         """Create an image of ones, the same size as the CCD."""
-        return np.ones((self.xsize, self.ysize))
+        return np.ones((self.xsize, self.ysize), dtype=self.camera.imagedtype)
+
+    def scratch(self, name, shape=None, dtype=None):
+        """An image-sized array (with whatever was left in it), allocated once and then reused every exposure.
+
+            (shape and dtype can be given for arrays that aren't the same size or type as the image)"""
+        try:
+            return self.scratchbuffers[name]
+        except KeyError:
+            self.scratchbuffers[name] = np.empty(shape or (self.xsize, self.ysize),
+                                                 dtype=dtype or self.camera.imagedtype)
+            return self.scratchbuffers[name]
 
     def zodicalBackground(self, elon, elat):
         """Calcaulte the zodiacal background at a given celestial (lat, long)."""
@@ -241,6 +377,74 @@ class CCD(object):
             I_surface_brightness = a0 + a1 * (np.abs(glat) / 40.0) + a2 * (np.abs(glon) / 180.0) ** a3
         return 10 ** (-0.4 * I_surface_brightness) * 1.7e6 * self.camera.effective_area * self.camera.pixel_solid_area
 
+    def backgroundRate(self, x, y):
+        """The smooth background (zodiacal light + unresolved stars), in electrons per second, at pixels (x, y)."""
+        pix = self.camera.cartographer.point(x, y, 'ccdxy')
+        # (like the rest of the code, using the celestial coordinates for the zodiacal light's (lon, lat))
+        elon, elat = pix.celestial.tuple
+        glon, glat = pix.galactic.tuple
+        return self.zodicalBackground(elon, elat) + self.unresolvedBackground(glon, glat)
+
+    def smoothBackground(self, gridsize=33, tolerance=1e-3):
+        """The background rate over the whole image, interpolated (bicubically) from a coarse grid of pixels.
+
+            The interpolation is checked against the exact background halfway between the grid points,
+            where it's least accurate; if it's off by more than [tolerance] (as a fraction), the grid is
+            made finer, and if that doesn't help, the background is calculated exactly at every pixel."""
+
+        # the pixels in the image (x increases with column, y increases with row)
+        xaxis, yaxis = np.arange(self.xsize) + self.xmin, np.arange(self.ysize) + self.ymin
+        while gridsize is not None and 4 <= gridsize < min(self.xsize, self.ysize) // 2:
+
+            # calculate the background exactly on the grid, and halfway between its points
+            xgrid, ygrid = np.linspace(xaxis[0], xaxis[-1], gridsize), np.linspace(yaxis[0], yaxis[-1], gridsize)
+            rate = self.backgroundRate(*np.meshgrid(xgrid, ygrid))
+            xhalf, yhalf = (xgrid[1:] + xgrid[:-1]) / 2.0, (ygrid[1:] + ygrid[:-1]) / 2.0
+            exact = self.backgroundRate(*np.meshgrid(xhalf, yhalf))
+
+            # interpolate, and see how well that reproduces the halfway points
+            interpolator = scipy.interpolate.RectBivariateSpline(ygrid, xgrid, rate, kx=3, ky=3)
+            error = np.max(np.abs(interpolator(yhalf, xhalf) / exact - 1.0))
+            if error <= tolerance:
+                logger.info('   interpolating the background from a {0}x{0} grid (good to {1:.1e})'.format(
+                    gridsize, error))
+                return interpolator(yaxis, xaxis)
+            logger.info('   a {0}x{0} grid reproduces the background only to {1:.1e}; trying a finer one'.format(
+                gridsize, error))
+            gridsize = 2 * gridsize - 1
+
+        # if the grid can't do it, calculate the background at every pixel
+        logger.info('   calculating the background exactly, at every pixel')
+        return self.backgroundRate(*np.meshgrid(xaxis, yaxis))
+
+    def backgroundRateImage(self, gridsize=33):
+        """The background rate (electrons/s) at every pixel, cached in memory and on disk.
+
+            The rate depends only on where the camera points, which CCD this is, and the background
+            model (not on the cadence), so it's calculated once and then scaled for every cadence."""
+
+        key = 'ra{0:.6f}_dec{1:.6f}_ccd{2}_{3}x{4}_center{5:.0f}x{6:.0f}_grid{7}_model{8}'.format(
+            self.camera.ra, self.camera.dec, self.number, self.xsize, self.ysize, self.center[0], self.center[1],
+            gridsize, backgroundmodelversion)
+        try:
+            return backgroundrates[key]
+        except KeyError:
+            pass
+
+        directory = os.path.join(settings.intermediates, 'backgrounds')
+        zachopy.utils.mkdir(directory)
+        filename = os.path.join(directory, key + '.npy')
+        try:
+            rate = np.load(filename)
+            logger.info('loaded background rate from {0}'.format(filename))
+        except IOError:
+            rate = self.smoothBackground(gridsize=gridsize).astype(np.float32)
+            settings.saveAtomically(filename, rate)
+            logger.info('saved background rate to {0}'.format(filename))
+
+        backgroundrates[key] = rate
+        return rate
+
     def writeToFITS(self, image, path, split=False, savetype=np.float32, cancompress=True):
         """General FITS writer for this CCD."""
 
@@ -267,6 +471,22 @@ class CCD(object):
         if self.compress[self.camera.cadence] and cancompress:
             os.system('gzip -vf {}'.format(path))
 
+    def writeHitsToFITS(self, hits, path, cancompress=True):
+        """Write a list of (rows, columns, electrons) hits to a FITS binary table."""
+
+        rows, columns, electrons = hits
+        logger.info('saving a table of {0} hit pixels to'.format(len(rows)))
+        logger.info('  {}'.format(path))
+
+        # (rows and columns are indices into the image, which is indexed [y, x])
+        table = astropy.io.fits.BinTableHDU.from_columns([
+            astropy.io.fits.Column(name='ROW', format='J', array=rows),
+            astropy.io.fits.Column(name='COLUMN', format='J', array=columns),
+            astropy.io.fits.Column(name='ELECTRONS', format='E', array=electrons)])
+        astropy.io.fits.HDUList([astropy.io.fits.PrimaryHDU(header=self.header), table]).writeto(path, clobber=True)
+        if self.compress[self.camera.cadence] and cancompress:
+            os.system('gzip -vf {}'.format(path))
+
     def loadFromFITS(self, path):
         """General FITS loader for this CCD."""
 
@@ -329,22 +549,10 @@ class CCD(object):
         # we want to make a trimmed catalog for this CCD.
         # first figure out which ones are on the CCD
 
-        # pull out positions, magnitudes, and temperatures at the time of the first exposure
-        logger.info('taking an intial snapshot at {0} = {1}'.format(self.camera.bjd, self.epoch))
-        ras, decs, tmag, temperatures = self.camera.catalog.snapshot(self.camera.bjd,
-                                                                     exptime=self.camera.cadence / 60.0 / 60.0 / 24.0)
-        assert (ras.shape == tmag.shape)
-
-        # assign the cartrographer's CCD to this one
-        self.camera.cartographer.ccd = self
-
-        # create coordinate object for the stars
-        stars = self.camera.cartographer.point(ras, decs, 'celestial')
-        x, y = stars.ccdxy.tuple
-
-        # trim everything down to only those stars that could be relevant for this ccd
-        buffer = 0  # 10
-        onccd = (x > -buffer) & (x < self.xsize + buffer) & (y > -buffer) & (y < self.ysize + buffer)
+        # find the stars that could land on this CCD (from the catalog's spatial index, rather than projecting them all)
+        self.candidates = self.camera.catalog.near(*self.footprint(), epoch=self.epoch)
+        logger.info('{0} of the camera\'s {1} stars are near this CCD'.format(
+            len(self.candidates), len(self.camera.catalog.ra)))
 
         # trim to postage stamps, if desired
         self.stamper = Stamper.Stamper(specifier=self.camera.stamps[self.camera.cadence], ccd=self)
@@ -353,7 +561,28 @@ class CCD(object):
         self.stamps = self.camera.stamps[self.camera.cadence]
 
         # create the CCD catalog
-        self.catalog = self.stamper.trimCatalog(self.camera.catalog)
+        self.catalog = self.stamper.trimCatalog(self.camera.catalog, self.candidates)
+
+    def footprint(self, margin=None):
+        """A circle on the sky, (ra, dec, radius) in degrees, that covers this CCD plus a margin (in pixels).
+
+            The default margin leaves room for the PSF, for stars just off the edge, and for stars to
+            drift a little (from aberration and jitter) after the CCD's catalog has been trimmed."""
+
+        if margin is None:
+            margin = self.camera.psf.npixels + 50
+        self.camera.cartographer.ccd = self
+
+        # the center and the corners of the CCD, on the sky
+        center = self.camera.cartographer.point((self.xsize - 1) / 2.0, (self.ysize - 1) / 2.0, 'ccdxy').celestial
+        cornerx = np.array([-0.5, self.xsize - 0.5, -0.5, self.xsize - 0.5])
+        cornery = np.array([-0.5, -0.5, self.ysize - 0.5, self.ysize - 0.5])
+        corners = self.camera.cartographer.point(cornerx, cornery, 'ccdxy').celestial
+
+        # the farthest corner sets the radius
+        cosines = np.dot(Spherical.unitVectors(center.ra, center.dec), Spherical.unitVectors(corners.ra, corners.dec))
+        radius = np.degrees(np.arccos(np.min(np.clip(cosines, -1.0, 1.0)))) + margin * self.camera.pixelscale / 60.0 / 60.0
+        return float(center.ra), float(center.dec), radius
 
     def writeIngredients(self):
 
@@ -393,19 +622,18 @@ class CCD(object):
         assert (ras.shape == tmag.shape)
         self.camera.cartographer.ccd = self
 
-        # create coordinate object for the stars
-        stars = self.camera.cartographer.point(ras, decs, 'celestial')
-        x, y = stars.ccdxy.tuple
+        # project the stars onto this CCD (from the camera's cached tangent plane, rather than the WCS)
+        focalx, focaly = self.camera.pointing.project(self.camera.catalog, self.epoch, roll=self.camera.nudge['z'],
+                                                      subset=self.catalog.parentindices)
+        x, y = self.camera.cartographer.point(focalx, focaly, 'focalxy').ccdxy.tuple
 
         # apply differential velocity aberration, based on the time offset from antisun
         if self.camera.aberrate:
             logger.info('applying differental velocity aberration (relative to this camera only)')
-            dt = self.camera.bjd - self.camera.bjdantisun
-            dx, dy = self.aberrations(stars, dt)
-            fieldcenter = self.camera.cartographer.point(0, 0, 'focalxy')
-            centerx, centery = self.aberrations(fieldcenter, dt)
-            x += dx - np.mean(dx)
-            y += dy - np.mean(dy)
+            dx, dy = self.aberrationTimeseries(self.camera.counter)
+            self.noteAberration(self.camera.bjd - self.camera.bjdantisun)
+            x += dx
+            y += dy
         else:
             logger.info('skipping differental velocity aberration')
 
@@ -418,19 +646,18 @@ class CCD(object):
         self.stary = y[ok]
         self.starmag = np.array(tmag)[ok]
         self.startemp = np.array(temperatures)[ok]
-        self.starlc = np.array(self.camera.catalog.lightcurvecodes)[ok]
-        self.starbasemag = np.array(self.camera.catalog.tmag)[ok]
+        self.starlc = np.array(self.catalog.lightcurvecodes)[ok]
+        self.starbasemag = np.array(self.catalog.tmag)[ok]
         # keep track of which CCD we projected onto
         self.starsareon = self.name
 
-    def aberrations(self, stars, dt):
-
-        # make sure the cartographer is defined
+    def setupAberrator(self):
+        """Make sure this CCD has an Aberrator (fitting its derivatives, or loading them from disk)."""
         try:
             assert (self.aberrator.ccd == self)
         except AttributeError:
             self.aberrator = Aberrator(self.camera.cartographer)
-            if self.camera.counter == 0:
+            if self.aberrator.fitted and self.camera.counter == 0:
                 self.aberrator.plotPossibilities()
 
             self.header['ABERRATE'] = ''
@@ -447,45 +674,80 @@ class CCD(object):
                 self.header['ABD{0}_CYY'.format(pix.upper())] = self.aberrator.coefs[pix][4]
                 self.header['ABD{0}_CXY'.format(pix.upper())] = self.aberrator.coefs[pix][5]
 
-        # sign will definitely be wrong on this
-        beta = 29.8 * zachopy.units.km / zachopy.units.c  # unitless (radians)
-        if self.camera.warpspaceandtime:
-            warp = self.camera.warpspaceandtime
-            beta /= warp
-            self.header['AB_WARP'] = 'speed of light is {0}X what it should be'.format(warp), '(for testing)'
-        self.header['AB_BETA'] = beta, '[radians] v/c (from orbit tangential velocity)'
-
-        # what is the celestial longitude of the field center?
-        fieldcenter = self.camera.cartographer.point(0, 0, type='focalxy')
-        self.header['AB_FCLON'] = fieldcenter.ecliptic.elon, '[deg] ecliptic lon. of focal plane center'
-
-        # how much is each star offset from antisun, at this time?
-        dtheta = 360.0 * dt / 365.25
-        theta = stars.ecliptic.elon - fieldcenter.ecliptic.elon + dtheta
-        self.header['AB_DLON'] = dtheta, '[deg] motion of Earth (in ecliptic lon.)'
-
-        # calculate the current positions and the nudge of celestial longitude
-        x, y = stars.ccdxy.tuple  # pixels
-        delon = beta * np.cos(theta * np.pi / 180.0) * 180 / np.pi  # degrees
-
-        # calculate the aberration at the center of the camera FOV
-        fcx, fcy = fieldcenter.ccdxy.tuple
-        dfcelon = beta * np.cos(dtheta * np.pi / 180.0) * 180 / np.pi
-        fcdx, fcdy = self.aberrator.derivatives['x'](fcx, fcy) * dfcelon, self.aberrator.derivatives['y'](fcx,
-                                                                                                          fcy) * dfcelon
-        self.header['AB_FCDX'] = fcdx, '[pix] dx of FOV center'
-        self.header['AB_FCDY'] = fcdy, '[pix] dy of FOV center'
+            if self.camera.warpspaceandtime:
+                warp = self.camera.warpspaceandtime
+                self.header['AB_WARP'] = 'speed of light is {0}X what it should be'.format(warp), '(for testing)'
+            self.header['AB_BETA'] = self.aberrator.beta, '[radians] v/c (from orbit tangential velocity)'
+            self.header['AB_FCLON'] = self.aberrator.fclon, '[deg] ecliptic lon. of focal plane center'
+        return self.aberrator
+
+    def noteAberration(self, dt):
+        """Record the aberration at time dt from antisun (of the field center) in the header."""
+        self.fcdx, self.fcdy = self.aberrator.fieldCenter(dt)
+        self.header['AB_DLON'] = 360.0 * dt / 365.25, '[deg] motion of Earth (in ecliptic lon.)'
+        self.header['AB_FCDX'] = self.fcdx, '[pix] dx of FOV center'
+        self.header['AB_FCDY'] = self.fcdy, '[pix] dy of FOV center'
+
+    def aberrationFactors(self, subset=None):
+        """The spatial factors of the aberration (see Aberrator.spatialFactors) for the camera catalog's stars.
+
+            Returns (factors, meanfactors): the factors of the stars in subset (an optional array of indices),
+            and the mean factors over the whole camera catalog (less, with postage stamps, the stars on this
+            CCD that fall outside them, just as the CCD's catalog is trimmed). They're calculated once per
+            CCD, with the stars where they are at the time (over an observation, proper motions barely
+            change them)."""
+
+        catalog = self.camera.catalog
+        try:
+            cached = self.aberrationfactors
+            assert (cached['catalog'] is catalog)
+            assert (cached['aberrator'] is self.aberrator)
+            assert (cached['stamps'] == self.stamps)
+        except (AttributeError, AssertionError):
+            logger.info('calculating the spatial factors of the aberration, for {0} stars'.format(len(catalog.ra)))
+            elon, elat = Spherical.convert(*catalog.atEpoch(self.epoch), frm='celestial', to='ecliptic')
+            focalx, focaly = self.camera.pointing.project(catalog, self.epoch, roll=self.camera.nudge['z'])
+            x, y = self.camera.cartographer.point(focalx, focaly, 'focalxy').ccdxy.tuple
+            factors = self.aberrator.spatialFactors(elon, x, y)
+
+            # average over the same stars the mean was always taken over (the ones the stamps don't trim away)
+            if self.stamps is None:
+                counted = slice(None)
+            else:
+                counted = self.stamper.keep(x, y)
+            meanfactors = dict((k, (np.mean(c[counted]), np.mean(s[counted]))) for k, (c, s) in factors.items())
+            cached = dict(catalog=catalog, aberrator=self.aberrator, stamps=self.stamps, factors=factors,
+                          meanfactors=meanfactors)
+            self.aberrationfactors = cached
+
+        factors = cached['factors']
+        if subset is not None:
+            factors = dict((k, (c[subset], s[subset])) for k, (c, s) in factors.items())
+        return factors, cached['meanfactors']
+
+    def aberrationTimeseries(self, counters):
+        """The nudges (dx, dy, in pixels) from differential velocity aberration of this CCD's stars, at one or more counters.
+
+            The nudges are relative to the mean over the camera's catalog (see aberrationFactors). For an array of
+            counters, dx and dy are (counters x stars) arrays."""
 
-        self.delon = delon  # for testing
-        self.fcdx, self.fcdy = fcdx, fcdy
+        self.setupAberrator()
+        factors, meanfactors = self.aberrationFactors(subset=self.catalog.parentindices)
+        dt = self.camera.counterToBJD(np.asarray(counters)) - self.camera.bjdantisun
+        dx, dy = self.aberrator.nudges(factors, dt)
+        meandx, meandy = self.aberrator.nudges(meanfactors, dt)
+        return dx - np.asarray(meandx)[..., np.newaxis], dy - np.asarray(meandy)[..., np.newaxis]
 
-        # calculate the absolute velocity aberration
-        # the linear plane model is probably going to break down at the pole!
-        vax, vay = self.aberrator.derivatives['x'](x, y) * delon, self.aberrator.derivatives['y'](x, y) * delon
+    def aberrations(self, stars, dt, ccdxy=None):
+        """The nudges (dx, dy, in pixels) from differential velocity aberration, for stars at time dt from antisun.
 
-        # subtract the field centers
-        dx, dy = vax - fcdx, vay - fcdy
-        return dx, dy
+            ccdxy is the stars' (x, y) on this CCD, if they're already known."""
+
+        self.setupAberrator()
+        if ccdxy is None:
+            ccdxy = stars.ccdxy.tuple
+        self.noteAberration(dt)
+        return self.aberrator.nudges(self.aberrator.spatialFactors(stars.ecliptic.elon, *ccdxy), dt)
 
     def addStar(self, ccdx, ccdy, mag, temp, verbose=False, plot=False):
         """Add one star to an image, given position, magnitude, and effective temperature."""
@@ -528,7 +790,139 @@ class CCD(object):
         self.starimage[yindex[ok], xindex[ok]] += binned[ok]
         # a = self.input('just added {}'.format(ccdxy))
 
-    def addStars(self, remake=True, jitter=False, magnitudethreshold=None):
+    def addManyStars(self, ccdx, ccdy, mag, temp, chunksize=10000, focus=None, image=None, referencemag=None):
+        """Add arrays of stars to an image at once (same result as looping over addStar).
+
+            By default, stars are added to self.starimage at the current focus. If referencemag
+            is given, only the difference in brightness between mag and referencemag is added."""
+
+        if focus is None:
+            focus = self.currentfocus
+        if image is None:
+            image = self.starimage
+
+        # do this in chunks, to keep the stacks of PSF stamps from getting too big
+        for start in range(0, len(ccdx), chunksize):
+            chunk = slice(start, start + chunksize)
+
+            ccdxy = self.camera.cartographer.point(ccdx[chunk] + self.camera.nudge['x'] / self.camera.pixelscale,
+                                                   ccdy[chunk] + self.camera.nudge['y'] / self.camera.pixelscale,
+                                                   'ccdxy')
+            normalized, xindex, yindex = self.camera.psf.pixelizedPSFs(ccdxy, stellartemp=temp[chunk], focus=focus)
+            photons = self.photons(mag[chunk])
+            if referencemag is not None:
+                photons = photons - self.photons(referencemag[chunk])
+            binned = normalized * self.camera.cadence * photons[:, np.newaxis, np.newaxis]
+
+            # scatter all the stamps onto the image with one (flattened) sum
+            ok = (xindex >= self.xmin) * (xindex < self.xsize) * (yindex >= self.ymin) * (yindex < self.ysize)
+            flat = yindex[ok] * image.shape[1] + xindex[ok]
+            image += np.bincount(flat, weights=binned[ok], minlength=image.size).reshape(image.shape)
+            self.starcounter += len(normalized)
+
+    def starsHaveMoved(self, cache, ccdx, ccdy, temp, tolerance):
+        """Have any stars moved by more than [tolerance] pixels since the [cache] was made? (If so, start tracking them anew.)"""
+
+        # where are the stars (including any jitter), and are they the same stars as before?
+        x = ccdx + self.camera.nudge['x'] / self.camera.pixelscale
+        y = ccdy + self.camera.nudge['y'] / self.camera.pixelscale
+        try:
+            reference = self.starcaches[cache]
+            assert (len(x) == len(reference['x']))
+            assert (np.array_equal(reference['temp'], temp))
+            assert (np.max(np.abs(x - reference['x'])) <= tolerance)
+            assert (np.max(np.abs(y - reference['y'])) <= tolerance)
+            return False
+        except (KeyError, AssertionError):
+            logger.info('stars have moved since the {0} was made'.format(cache))
+            self.starcaches[cache] = dict(x=x, y=y, ccdx=ccdx.copy(), ccdy=ccdy.copy(), temp=temp.copy())
+            return True
+
+    def addStarsFromFocusBasis(self, ccdx, ccdy, mag, temp, tolerance=0.01):
+        """Add stars to self.starimage by blending star images cached at the focus nodes of the PSF library.
+
+            The PSF library is linear in focus between its nodes, so (as long as the stars don't move) the
+            star image at any focus is the same blend of the star images rendered at the two bracketing
+            nodes. Each node's image is rendered once, with the stars at their brightnesses at the time;
+            stars that have since changed brightness get only the difference added, at the current focus.
+            The cached images are remade once any star has moved by more than [tolerance] pixels."""
+
+        if self.starsHaveMoved('focusbasis', ccdx, ccdy, temp, tolerance):
+            logger.info('clearing the star images cached at the focus nodes')
+            self.focusbasis = {}
+            self.focusbasis_mag = mag.copy()
+
+        # blend the images at the bracketing focus nodes (rendering any that haven't been yet)
+        for node, weight in self.camera.psf.focusWeights(self.currentfocus):
+            if weight == 0:
+                continue
+            try:
+                nodeimage = self.focusbasis[node]
+            except KeyError:
+                nodefocus = self.camera.psf.binned_axes['focus'][node]
+                logger.info('rendering (and caching) the star image at a focus of {0}um'.format(nodefocus))
+                nodeimage = self.zeros()
+                stars = self.starcaches['focusbasis']
+                self.addManyStars(stars['ccdx'], stars['ccdy'], self.focusbasis_mag, temp,
+                                  focus=nodefocus, image=nodeimage)
+                self.focusbasis[node] = nodeimage
+            self.starimage += weight * nodeimage
+
+        # correct for any stars that aren't as bright as they were when the cached images were made
+        changed = mag != self.focusbasis_mag
+        if changed.any():
+            logger.info('adding the changes in brightness of {0} stars'.format(np.sum(changed)))
+            self.addManyStars(ccdx[changed], ccdy[changed], mag[changed], temp[changed],
+                              referencemag=self.focusbasis_mag[changed])
+
+    def designMatrix(self, ccdx, ccdy, temp, focus, chunksize=10000):
+        """Sparse [pixels, stars] matrix of normalized PSFs, so that the star image is (matrix * photons per star)."""
+        rows, columns, values = [], [], []
+        for start in range(0, len(ccdx), chunksize):
+            chunk = slice(start, start + chunksize)
+
+            ccdxy = self.camera.cartographer.point(ccdx[chunk] + self.camera.nudge['x'] / self.camera.pixelscale,
+                                                   ccdy[chunk] + self.camera.nudge['y'] / self.camera.pixelscale,
+                                                   'ccdxy')
+            normalized, xindex, yindex = self.camera.psf.pixelizedPSFs(ccdxy, stellartemp=temp[chunk], focus=focus)
+            star = np.arange(start, start + len(normalized))[:, np.newaxis, np.newaxis] * np.ones_like(xindex)
+
+            ok = (xindex >= self.xmin) * (xindex < self.xsize) * (yindex >= self.ymin) * (yindex < self.ysize)
+            rows.append(yindex[ok] * self.ysize + xindex[ok])
+            columns.append(star[ok])
+            values.append(normalized[ok])
+
+        return scipy.sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))),
+                                       shape=(self.xsize * self.ysize, len(ccdx)))
+
+    def addStarsFromDesignMatrix(self, ccdx, ccdy, mag, temp, tolerance=0.01):
+        """Add stars to self.starimage as a (sparse) matrix product of cached PSFs and each star's photons.
+
+            One design matrix is cached for each focus node of the PSF library that's been needed; since the
+            library is linear in focus between nodes, any focus is a blend of two of them. The matrices are
+            remade once any star has moved by more than [tolerance] pixels, but changes in brightness are free."""
+
+        if self.starsHaveMoved('designmatrix', ccdx, ccdy, temp, tolerance):
+            logger.info('clearing the cached PSF design matrices')
+            self.designmatrices = {}
+
+        photons = self.camera.cadence * self.photons(mag)
+        for node, weight in self.camera.psf.focusWeights(self.currentfocus):
+            if weight == 0:
+                continue
+            try:
+                matrix = self.designmatrices[node]
+            except KeyError:
+                nodefocus = self.camera.psf.binned_axes['focus'][node]
+                logger.info('making (and caching) the PSF design matrix at a focus of {0}um'.format(nodefocus))
+                stars = self.starcaches['designmatrix']
+                matrix = self.designMatrix(stars['ccdx'], stars['ccdy'], temp, nodefocus)
+                self.designmatrices[node] = matrix
+            self.starimage += weight * matrix.dot(photons).reshape(self.starimage.shape)
+        self.starcounter += len(ccdx)
+
+    def addStars(self, remake=True, jitter=False, magnitudethreshold=None, focusbasis=False, focusbasistolerance=0.01,
+                 designmatrix=False, designmatrixtolerance=0.01):
         # logger.info("adding stars")
         self.starcounter = 0
         self.nstars = 0
@@ -551,7 +945,8 @@ class CCD(object):
 
         # otherwise loop through thresholds, adding stars at each
         except:
-            self.starimage = self.zeros()
+            self.starimage = self.scratch('stars')
+            self.starimage[:] = 0.0
 
             # propagate proper motions and project onto the detector
             self.projectCatalog()
@@ -594,9 +989,14 @@ class CCD(object):
                     self.header['FOCUS'] = (self.currentfocus, 'distance from optimal focus (microns)')
                     if np.sum(ok) > 0:
                         self.nstars += np.sum(ok)
-                        for i in range(len(x)):
-                            self.addStar(x[i], y[i], mag[i], temp[i])
-                            self.starcounter += 1
+                        if designmatrix:
+                            self.addStarsFromDesignMatrix(x, y, mag, temp, tolerance=designmatrixtolerance)
+                        elif focusbasis:
+                            self.addStarsFromFocusBasis(x, y, mag, temp, tolerance=focusbasistolerance)
+                        else:
+                            # interpolate the PSF library to this focus once, for all the stars in this exposure
+                            self.camera.psf.focusSlab(self.currentfocus)
+                            self.addManyStars(x, y, mag, temp)
 
                             # if jitter == False:
                             #  self.writeToFITS(self.starimage, starsfilename)
@@ -630,8 +1030,14 @@ class CCD(object):
         pass
         # looks like I should use http://vizier.cfa.harvard.edu/viz-bin/Cat?VII/155 for a source catalog?
 
-    def addCosmics(self, gradient=False, version='fancy', diffusion=False, write=False, rate=5.0, correctcosmics=True):
-        """Add cosmic rays to image."""
+    def addCosmics(self, gradient=False, version='fancy', diffusion=False, write=False, rate=5.0, correctcosmics=True,
+                   sparse=False, threads=None, library=0):
+        """Add cosmic rays to image.
+
+            library > 0 draws them from a library of that many pre-generated images (see CosmicLibrary).
+            threads sets how many threads generate the cosmic rays (in tiles of rows; None = a share of the cores).
+            sparse=True returns the cosmic rays as a list of the pixels they hit, (rows, columns, electrons),
+            instead of as a whole image (and writes them, if requested, as a FITS table)."""
 
         # print update
         logger.info('adding cosmic rays')
@@ -639,205 +1045,249 @@ class CCD(object):
         # filenames, in case saving is required
 
 
-        # use Al's code to generate cosmic ray image of the correct size
-        image = Cosmics.cosmicImage(exptime=self.camera.cadence, size=self.npix,
-                                    gradient=gradient, diffusion=diffusion, rate=rate)
+        # the cosmic rays get their own random stream for each exposure
+        #  (separate from the exposure's other random numbers, so adding cosmics doesn't change the noise)
+        stream = exposurePRNG(self.camera.seed, self.camera.cadence, self.number, self.camera.counter, stream=1)
+
+        buffersize = 100
+        if library > 0:
+            # take a (randomly flipped, rotated, and offset) window from a library of cosmic ray images
+            cosmiclibrary = CosmicLibrary.load(library, size=self.npix, exptime=self.camera.cadence,
+                                               rate=rate, gradient=gradient, diffusion=diffusion)
+            image, choices = cosmiclibrary.draw(stream)
+            self.addInputLabels()
+            self.header['ICRLIBN'] = (cosmiclibrary.nframes, 'images in cosmic ray library')
+            self.header['ICRFRAME'] = (choices['frame'], 'cosmic ray library image used')
+            self.header['ICRFLIP'] = (choices['flip'], 'was it flipped (along rows)?')
+            self.header['ICRROT'] = (choices['rotation'], 'then rotated by this many 90 deg')
+            self.header['ICROFFX'] = (choices['offsetx'], 'x offset of window into it')
+            self.header['ICROFFY'] = (choices['offsety'], 'y offset of window into it')
+            if sparse:
+                rows, columns = np.nonzero(image)
+                image = (rows, columns, image[rows, columns].astype(np.float64))
+        else:
+            # keep one cosmic ray generator for this CCD, seeded for each exposure from the stream
+            try:
+                self.cosmicgenerator
+            except AttributeError:
+                self.cosmicgenerator = Cosmics.Generator()
+            self.cosmicgenerator.threads = Workers.threadsPerProcess() if threads is None else max(int(threads), 1)
+            self.cosmicgenerator.seed(int(stream.uniform() * 2 ** 32))
+
+            if sparse:
+                # use Al's code to generate the list of pixels hit by cosmic rays
+                image = Cosmics.cosmicHits(exptime=self.camera.cadence, size=self.npix, buffer_size=buffersize,
+                                           gradient=gradient, diffusion=diffusion, rate=rate,
+                                           generator=self.cosmicgenerator)
+            else:
+                # use Al's code to generate cosmic ray image of the correct size (in a reused, buffered array)
+                buffered = self.scratch('cosmics', shape=(self.npix + 2 * buffersize,) * 2, dtype=np.float32)
+                image = Cosmics.cosmicImage(exptime=self.camera.cadence, size=self.npix, buffer_size=buffersize,
+                                            gradient=gradient, diffusion=diffusion, rate=rate,
+                                            generator=self.cosmicgenerator, buffered=buffered)
 
-        # (optionally), write cosmic ray image
+        # (optionally), write cosmic ray image (or table of hits)
         if write:
             self.note = 'cosmics_' + self.fileidentifier
             cosmicsfilename = os.path.join(self.directory, self.note + '.fits' + zipsuffix)
-            self.writeToFITS(image, cosmicsfilename)
+            if sparse:
+                self.writeHitsToFITS(image, cosmicsfilename)
+            else:
+                self.writeToFITS(image, cosmicsfilename)
 
         # add the cosmics into the running image
         self.addInputLabels()
         if (correctcosmics == False) or self.camera.cadence <= 2:
-            self.image += image
+            if sparse:
+                # (each pixel is only listed once, so they can all be added at once)
+                rows, columns, electrons = image
+                self.image[rows, columns] += electrons
+            else:
+                self.image += image
             self.header['ICOSMICS'] = ('True', 'cosmic rays injected')
         else:
             self.header['ICOSMICS'] = ('False', 'cosmic rays injected')
 
         return image
 
-    def bleedSaturated(self, plot=False):
-        """Bleed saturated pixels in the image."""
+    def bleedWindows(self, saturation_limit, cosmics=None):
+        """Which columns could hold saturated pixels? (Those under bright stars, plus any with saturated cosmic rays.)"""
+
+        # a star can only saturate a pixel if (most of) its light lands on top of the brightest background
+        #  (with a factor of two to spare, for blended stars, noise, and smear)
+        electrons = self.camera.cadence * self.photons(self.starmag)
+        bright = electrons > 0.5 * (saturation_limit - self.backgroundmax)
+
+        # each bright star's light falls within the columns covered by its PSF stamp (padded for jitter)
+        psf = self.camera.psf
+        left = np.floor(self.starx[bright] + psf.dx_pixels_axis[0]).astype(np.int) - 2
+        right = np.ceil(self.starx[bright] + psf.dx_pixels_axis[-1]).astype(np.int) + 2
+        window = np.zeros(self.image.shape[1] + 1, dtype=np.int)
+        np.add.at(window, np.clip(left, 0, self.image.shape[1]), 1)
+        np.add.at(window, np.clip(right + 1, 0, self.image.shape[1]), -1)
+        columns = np.cumsum(window)[:-1] > 0
+
+        # add the columns where cosmic rays pushed pixels over the limit
+        if cosmics is not None:
+            if isinstance(cosmics, tuple):
+                hitrows, hitcolumns = cosmics[:2]
+            else:
+                hitrows, hitcolumns = np.nonzero(cosmics)
+            columns[hitcolumns[self.image[hitrows, hitcolumns] > saturation_limit]] = True
 
-        logger.info('bleeding saturated pixels')
+        logger.info('{0} bright stars and cosmic rays could saturate {1} columns'.format(
+            np.sum(bright), np.sum(columns)))
+        return np.nonzero(columns)[0]
+
+    def bleedSaturated(self, plot=False, windows=True, cosmics=None):
+        """Bleed saturated pixels in the image.
 
-        # keep track of the original image
-        untouched = self.image + 0.0
-        original = np.sum(self.image)
+            With windows=True, only the columns that could saturate (under bright stars from the catalog,
+            or hit by saturated cosmic rays, from the cosmics image) are looked at; windows=False checks
+            every column in the image (slower, for validation)."""
+
+        logger.info('bleeding saturated pixels')
 
         # set the saturation limit based on the number of individual reads included
         saturation_limit = self.camera.saturation * self.camera.cadence / self.camera.singleread
-        stilloversaturated = True
 
-        # keep looping until all saturation problems are gone
+        # decide which columns to look at
+        try:
+            assert (windows)
+            columns = self.bleedWindows(saturation_limit, cosmics=cosmics)
+        except (AssertionError, AttributeError):
+            # (without a projected catalog, look everywhere)
+            columns = np.arange(self.image.shape[1])
+        window = self.image[:, columns]
+
+        # keep track of the original image (if we're going to write out the bleed trails)
+        self.note = 'saturation_{0}K'.format(self.camera.saturation).replace('.', 'p')
+        saturationfilename = os.path.join(self.directory, self.note + '.fits')
+        write = not os.path.exists(saturationfilename)
+        if write:
+            untouched = window.copy()
+        original = np.sum(window)
+
+        # keep looping until all saturation problems are gone (with a KLUDGE to prevent endless loops)
         count = 0
-        while stilloversaturated:
+        while count < 10:
 
             # keep track of iterations, to prevent infinite loops!
             count += 1
 
-            # identify saturated pixels
-            oversaturated = self.image > saturation_limit
-            saturated = self.image >= saturation_limit
-
-            # loop over columns, treating each separately
-            for x in range(self.image.shape[1]):
-
-                # identify continuous saturated regions
-                regions, nregions = scipy.ndimage.measurements.label(saturated[:, x])
-                if nregions > 0:
-                    for i in np.arange(nregions) + 1:
-                        y = (regions == i).nonzero()[0]
-                        if oversaturated[y, x].any():
-                            # logger.info('')
-                            # logger.info('in column {0}'.format(x))
-                            # in this saturated region, how much flux needs to be redistributed?
-                            fluxtodistribute = np.sum(self.image[y, x])
-                            # logger.info('must distribute {0} electrons'.format(fluxtodistribute))
-                            # how many pixels would this correspond to? (including the original pixels)
-                            npixels = (fluxtodistribute / saturation_limit)
-                            # logger.info('which we could do over {0} pixels'.format(npixels))
-
-                            # find the center of the saturated region
-                            center = np.mean(y)
-
-                            # find how far we away from center we can totally saturate pixel
-                            grow = (npixels - 1.0) / 2.0
-                            # noinspection PyTypeChecker
-                            indices = np.arange(np.maximum(np.ceil(center - grow).astype(np.int), 0),
-                                                np.minimum(np.floor(center + grow).astype(np.int),
-                                                           self.image.shape[0] - 1) + 1)
-                            # logger.info('with indices of {0}'.format(indices))
-
-                            assert (y[0] in indices)
-
-                            # record the flux we're starting with in this region
-                            existingflux = np.sum(self.image[indices, x])
-
-                            # saturate the pixels needed
-                            self.image[indices, x] = saturation_limit
-                            leftoverflux = existingflux - indices.shape[0] * saturation_limit
-                            # logger.info('leaving {0} behind'.format(leftoverflux))
-
-                            '''if leftoverflux > 0:
-                leftedge = indices.min() -1
-                rightedge = indices.max() +1
-              else:'''
-                            leftedge = indices.min() - 1
-                            rightedge = indices.max() + 1
-                            try:
-                                try:
-                                    self.image[leftedge, x] += leftoverflux / 2.0
-                                except:
-                                    self.image[rightedge, x] += leftoverflux / 2.0
-                                try:
-                                    self.image[rightedge, x] += leftoverflux / 2.0
-                                except:
-                                    self.image[leftedge, x] += leftoverflux / 2.0
-                            except:
-                                logger.info("this star seems to saturate the entire detector!")
-            logger.info("    on pass #{0} through saturation filter:".format(count))
+            # only columns with oversaturated pixels need any bleeding
+            oversaturated = (window > saturation_limit).any(0)
+            if not oversaturated.any():
+                break
+
+            # bleed all the oversaturated runs in those columns
+            bled = window[:, oversaturated]
+            nruns = bleedColumns(bled, saturation_limit)
+            window[:, oversaturated] = bled
+
+            logger.info("    on pass #{0} through saturation filter, bled {1} runs in {2} columns:".format(
+                count, nruns, np.sum(oversaturated)))
             logger.info(
                 "        the max saturation fraction is {1:.2f}; flux change over entire image is {2:.2f} electrons".format(
-                    count, np.max(self.image) / saturation_limit, np.sum(self.image) - original))
-
+                    count, np.max(window) / saturation_limit, np.sum(window) - original))
 
-            # KLUDGE to prevent endless loops
-            stilloversaturated = (self.image > saturation_limit).any() and count < 10
+        # put the bled columns back into the image
+        self.image[:, columns] = window
 
-        self.note = 'saturation_{0}K'.format(self.camera.saturation).replace('.', 'p')
-        saturationfilename = os.path.join(self.directory, self.note + '.fits')
-        if not os.path.exists(saturationfilename):
-            self.writeToFITS(self.image - untouched, saturationfilename)
+        if write:
+            trails = self.zeros()
+            trails[:, columns] = window - untouched
+            self.writeToFITS(trails, saturationfilename)
 
         # update image header
         self.addInputLabels()
         self.header['ISATURAT'] = ('True', 'bleed trails for saturated pixels')
 
-    def addBackgrounds(self):
-        """Add smooth backgrounds (zodiacal light and unresolved stars) to background."""
+    def addBackgrounds(self, gridsize=33):
+        """Add smooth backgrounds (zodiacal light and unresolved stars) to background.
+
+            The backgrounds are interpolated from a [gridsize]x[gridsize] grid over the CCD
+            (see smoothBackground); gridsize=None calculates them exactly at every pixel."""
 
         # set up filenames for saving background, if need be
         self.note = 'backgrounds'
         backgroundsfilename = os.path.join(self.directory, self.note + '.fits')
         logger.info("adding backgrounds")
 
-        # if the background image already exists, just load it
+        # if the background image for this cadence already exists, just use it
         try:
             self.backgroundimage
-            assert (self.camera.counter != 0)
-        except (AttributeError, AssertionError):
-
-            try:
-                self.backgroundimage = self.loadFromFITS(backgroundsfilename)
-                # otherwise compute the backgrounds from scratch, and save them for next time
-            except IOError:
-                # define a blank background image
-                self.backgroundimage = self.zeros()
-                # define coordinates (equatorial, Galactic, celestial) at every pixel in the image
-                ra, dec = self.pixels().celestial.tuple
-                elon, elat = self.pixels().celestial.tuple
-                glon, glat = self.pixels().galactic.tuple
-
-                # add the zodiacal light, using the simple model from Josh and Peter on the TESS wiki
-                logger.info("   including smooth model for zodiacal light")
-                elon, elat
-                self.backgroundimage += self.zodicalBackground(elon, elat) * self.camera.cadence
-                self.addInputLabels()
-                self.header['IZODIACA'] = ('True', 'zodiacal light, treated as smooth')
-
-                # add unresolved background light, using the simple model from Josh and Peter on the TESS wiki
-                logger.info("   including smooth model for unresolved stars in the Galaxy")
-                self.backgroundimage += self.unresolvedBackground(glon, glat) * self.camera.cadence
-                self.header['IUNRESOL'] = ('True', 'unresolved stars, treated as smooth background')
-
-                # write the image, so it can just be loaded easily next time
+        except AttributeError:
+            # otherwise scale the background rate (from the simple models from Josh and Peter on the TESS wiki)
+            logger.info("   including smooth model for zodiacal light")
+            logger.info("   including smooth model for unresolved stars in the Galaxy")
+            self.backgroundimage = self.zeros()
+            self.backgroundimage += self.backgroundRateImage(gridsize=gridsize) * self.camera.cadence
+
+            # write the image, for reference
+            if not os.path.exists(backgroundsfilename):
                 self.writeToFITS(self.backgroundimage, backgroundsfilename, cancompress=False)
 
+            # remember the brightest background pixel (for bleedWindows)
+            self.backgroundmax = np.max(self.backgroundimage)
+
+        self.addInputLabels()
+        self.header['IZODIACA'] = ('True', 'zodiacal light, treated as smooth')
+        self.header['IUNRESOL'] = ('True', 'unresolved stars, treated as smooth background')
+
         # add the background image to the total image
         self.image += self.backgroundimage
 
-    def addPhotonNoise(self):
-        """Add photon noise into an image."""
+    def readVariance(self):
+        """The variance of the read noise in one exposure (summed over all its reads)."""
+        logger.info("    read noise = quadrature sum of {0:.0f} reads with {1} e- each.".format(
+            self.camera.cadence / self.camera.singleread, self.camera.read_noise))
+        return self.camera.cadence / self.camera.singleread * self.camera.read_noise ** 2
 
-        self.noiseimage = self.zeros()
-        logger.info("adding photon noise [sqrt(photons from stars and various backgrounds)]")
-        noise_variance = self.image
-        ok = noise_variance > 0
+    def addPhotonNoise(self, readnoise=False, poissonbelow=0.0):
+        """Add photon noise into an image (and read noise too, in the same draw, if readnoise=True).
 
-        noise = np.zeros_like(self.image)
-        noise[ok] = np.sqrt(noise_variance[ok])
+            Pixels expecting fewer than poissonbelow electrons get exact Poisson photon noise."""
 
+        logger.info("adding photon noise [sqrt(photons from stars and various backgrounds)]")
+        readvariance = 0.0
+        if readnoise:
+            logger.info("    (along with read noise, in the same draw)")
+            readvariance = self.readVariance()
+
+        # the photon noise is sqrt(variance) where the image is positive, and zero elsewhere
+        noise = self.noisemaker.addNoise(self.image, self.prng, photons=True, readvariance=readvariance,
+                                         poissonbelow=poissonbelow, noise=self.scratch('noise'))
         assert (np.isfinite(noise).all())
-        self.image += noise * np.random.randn(self.xsize, self.ysize)
         self.noiseimage = noise
 
         self.note = 'photonnoise'
+        if readnoise:
+            self.note = 'photonandreadnoise'
         noisefilename = os.path.join(self.directory, self.note + '.fits')
         if not os.path.exists(noisefilename):
             self.writeToFITS(noise, noisefilename)
         self.addInputLabels()
         self.header['IPHOTNOI'] = ('True', 'photon noise')
+        if readnoise:
+            self.header['IREADNOI'] = ('True', 'read noise')
 
     def addReadNoise(self):
         """Add read noise to image."""
         logger.info("adding read noise")
-        logger.info("    = quadrature sum of {2:.0f} reads with {3} e- each.".format(self.camera.cadence,
-                                                                                     self.camera.singleread,
-                                                                                     self.camera.cadence / self.camera.singleread,
-                                                                                     self.camera.read_noise))
 
         # calculate the variance due to read noise
-        noise_variance = self.camera.cadence / self.camera.singleread * self.camera.read_noise ** 2
+        noise_variance = self.readVariance()
 
         # add noise into image
-        self.image += np.sqrt(noise_variance) * np.random.randn(self.xsize, self.ysize)
+        self.noisemaker.addNoise(self.image, self.prng, photons=False, readvariance=noise_variance,
+                                 noise=self.scratch('readnoise'))
         try:
-            self.noiseimage = np.sqrt(self.noiseimage ** 2 + noise_variance)
-        except:
+            # (in place, since the noise image is one of the scratch arrays)
+            np.square(self.noiseimage, out=self.noiseimage)
+            self.noiseimage += noise_variance
+            np.sqrt(self.noiseimage, out=self.noiseimage)
+        except AttributeError:
             self.noiseimage = np.sqrt(noise_variance)
 
         # update image header
@@ -850,14 +1300,15 @@ class CCD(object):
         logger.info("    assuming {0} second readout times on {1} second exposures.".format(self.camera.readouttime,
                                                                                             self.camera.singleread))
 
-        untouched = self.image + 0.0
-        mean = np.mean(self.image, 0).reshape(1, self.image.shape[0]) * self.ones()
-        self.image += mean * self.camera.readouttime / self.camera.singleread
+        # every pixel in a column picks up the same smear, so it's just one row (spread over the image as it's added)
+        smear = np.mean(self.image, 0, dtype=np.float64).reshape(1, self.image.shape[1])
+        smear *= self.camera.readouttime / self.camera.singleread
+        self.image += smear
 
         self.note = 'readoutsmear'
         smearfilename = os.path.join(self.directory, self.note + '.fits')
         if not os.path.exists(smearfilename):
-            self.writeToFITS(self.image - untouched, smearfilename)
+            self.writeToFITS(smear * self.ones(), smearfilename)
 
         # update header
         self.addInputLabels()
@@ -875,22 +1326,39 @@ class CCD(object):
                skipcosmics=False,  # should we skip cosmic injection?
                correctcosmics=False,  # should we pretend cosmics don't exist?
                writecosmics=False,  # should the cosmics image write to file?
+               sparsecosmics=True,  # should cosmics be kept as a list of hit pixels (written as a table), not an image?
                writenoiseless=False,  # should we write an image with no noise?
                jitterscale=1.0,  # should we rescale the jitter?
                display=False,  # should we display this image in ds9?,
                magnitudethreshold=999,
                advancecounter=True,
+               focusbasis=False,  # should stars be blended from images cached at the PSF library's focus nodes?
+               focusbasistolerance=0.01,  # how far (in pixels) can stars move before those images are remade?
+               designmatrix=False,  # should stars be drawn with a cached (sparse) matrix of PSFs?
+               designmatrixtolerance=0.01,  # how far (in pixels) can stars move before that matrix is remade?
+               bleedwindows=True,  # should saturation only be looked for around bright stars (and cosmic rays)?
+               combinenoise=True,  # should photon and read noise be added in one draw (before cosmics)?
+               poissonbelow=0.0,  # below how many electrons should pixels get exact Poisson photon noise?
+               noisethreads=None,  # how many threads should draw the noise? (None = a share of the cores)
+               cosmicthreads=None,  # how many threads should generate the cosmic rays? (None = a share of the cores)
+               cosmiclibrary={2: 0, 20: 0, 120: 0, 1800: 0},  # how many library images to draw cosmics from? (0 = none)
+               backgroundgrid=33,  # interpolate the backgrounds from a grid this size (None = exact at every pixel)
                **kwargs):
 
         """Expose an image on this CCD."""
         self.plot = plot
+
+        # all the randomness in this exposure comes from its own generator, so exposures can be made in any order
+        self.prng = exposurePRNG(self.camera.seed, self.camera.cadence, self.number, self.camera.counter)
+        self.noisemaker = Noisemaker.Noisemaker(threads=noisethreads)
         self.display = display
         self.compress = compress
 
         # temp kludge
         cosmics, stars = None, None
-        # create a blank image
-        self.image = self.zeros()
+        # create a blank image (reusing the same array every exposure)
+        self.image = self.scratch('image')
+        self.image[:] = 0.0
 
         # populate the basics of the header
         self.populateHeader()
@@ -904,16 +1372,18 @@ class CCD(object):
             self.camera.jitter.applyNudge(self.camera.counter, header=self.header)
 
         # add stars to the image
-        self.addStars(jitter=jitter, remake=remake, magnitudethreshold=magnitudethreshold)
+        self.addStars(jitter=jitter, remake=remake, magnitudethreshold=magnitudethreshold, focusbasis=focusbasis,
+                      focusbasistolerance=focusbasistolerance, designmatrix=designmatrix,
+                      designmatrixtolerance=designmatrixtolerance)
 
         # add galaxies to the image
         self.addGalaxies()
 
         # add background to the image
-        self.addBackgrounds()
+        self.addBackgrounds(gridsize=backgroundgrid)
 
         if writesimulated == False:
-            stars = self.image + 0.0
+            stars = self.image.copy()
 
         if writenoiseless:
             # make filename for this image
@@ -925,23 +1395,25 @@ class CCD(object):
             self.writeToFITS(self.image, noiselessfilename, savetype=np.int32)
 
 
-        # add the photon noise from stars, galaxies, and backgrounds
-        self.addPhotonNoise()
+        # add the photon noise from stars, galaxies, and backgrounds (and the read noise, if combining them)
+        self.addPhotonNoise(readnoise=combinenoise, poissonbelow=poissonbelow)
 
         if skipcosmics == False:
             # add cosmic rays to the image (after noise, because the *sub-Poisson* noise is already modeled with the Fano factor)
             cosmics = self.addCosmics(write=writecosmics, version=cosmicsversion, diffusion=cosmicsdiffusion,
-                                      correctcosmics=correctcosmics)
+                                      correctcosmics=correctcosmics, sparse=sparsecosmics,
+                                      threads=cosmicthreads, library=cosmiclibrary.get(self.camera.cadence, 0))
 
         # add smear from the finite frame transfer time
         if smear:
             self.addSmear()
 
         # create saturation bleed trails
-        self.bleedSaturated()
+        self.bleedSaturated(windows=bleedwindows, cosmics=cosmics)
 
         # add read noise, constant across detector
-        self.addReadNoise()
+        if not combinenoise:
+            self.addReadNoise()
 
 
         # finally, update the header for the image
@@ -964,31 +1436,78 @@ class CCD(object):
 
         self.show()
 
+        # (return copies, because this CCD will reuse its image arrays for the next exposure)
         if writesimulated == False:
-            return self.image, cosmics, stars
+            if isinstance(cosmics, tuple):
+                # (hand back a cosmics image, from the list of hits)
+                rows, columns, electrons = cosmics
+                cosmics = self.zeros()
+                cosmics[rows, columns] = electrons
+            elif cosmics is not None:
+                cosmics = cosmics.copy()
+            return self.image.copy(), cosmics, stars
 
 
 class Aberrator(object):
-    """object to keep track of how to apply velocity abberation; must be reset for each CCD"""
+    """object to keep track of how to apply velocity abberation; must be reset for each CCD
+
+        The derivatives of (x, y) with longitude are fit across the CCD once for each pointing (and cached on disk).
+        A star's nudge in x is BETA*cos(L-FCLON+DLON)*ABDXFUNC(x,y), minus the same at the field center; that
+        splits into a spatial factor for each star times cos(DLON) or sin(DLON), so once the stars' factors have
+        been calculated (spatialFactors) the nudges at any time(s) are cheap (nudges)."""
 
     def __init__(self, cartographer):
         super(Aberrator, self).__init__()
 
-        # create a grid of stars spanning the CCD
         ccd = cartographer.ccd
         self.ccd = ccd
+
+        # the derivatives only depend on where the camera points, and which CCD this is
+        key = 'ra{0:.6f}_dec{1:.6f}_scale{2}_ccd{3}_{4}x{5}_center{6:.0f}x{7:.0f}'.format(
+            ccd.camera.pointing.ra, ccd.camera.pointing.dec, ccd.camera.pixelscale, ccd.number, ccd.xsize, ccd.ysize,
+            ccd.center[0], ccd.center[1])
+        directory = os.path.join(settings.intermediates, 'aberration')
+        zachopy.utils.mkdir(directory)
+        filename = os.path.join(directory, key + '.npy')
+        try:
+            coefs = np.load(filename)
+            self.fitted = False
+            logger.info('loaded velocity aberration derivatives from {0}'.format(filename))
+        except IOError:
+            coefs = self.fit(cartographer)
+            self.fitted = True
+            settings.saveAtomically(filename, coefs)
+            logger.info('saved velocity aberration derivatives to {0}'.format(filename))
+
+        self.strings, self.derivatives, self.coefs = {}, {}, {}
+        template = '{0:+.10f}*ccdx{1:+.10f}*ccdy{2:+.10f}'
+        for k, c in zip(['x', 'y'], coefs):
+            self.coefs[k] = c
+            self.derivatives[k] = polynomial(c)  # pixels/degree
+            self.strings[k] = template.format(*c)
+
+        # sign will definitely be wrong on this
+        self.beta = 29.8 * zachopy.units.km / zachopy.units.c  # unitless (radians)
+        if ccd.camera.warpspaceandtime:
+            self.beta /= ccd.camera.warpspaceandtime
+
+        # the ecliptic longitude of the field center, and the derivatives there
+        fieldcenter = cartographer.point(0, 0, type='focalxy')
+        self.fclon = fieldcenter.ecliptic.elon
+        fcx, fcy = fieldcenter.ccdxy.tuple
+        self.centerderivatives = dict(x=self.derivatives['x'](fcx, fcy), y=self.derivatives['y'](fcx, fcy))
+
+    def fit(self, cartographer):
+        """Fit quadratics in (x, y) to the numerical derivatives of (x, y) with longitude, over a grid spanning the CCD."""
+
+        # create a grid of stars spanning the CCD
+        ccd = self.ccd
         ngrid = 20
         xgrid, ygrid = np.meshgrid(np.linspace(ccd.xmin, ccd.xmax, ngrid),
                                    np.linspace(ccd.ymin, ccd.ymax, ngrid))
         x, y = xgrid.flatten(), ygrid.flatten()
 
-
         # estimate dx/delon and dy/delon
-
-
-        self.strings, self.derivatives, self.coefs, self.inputs = {}, {}, {}, {}
-        self.raw = {}
-        template = '{0:+.10f}*ccdx{1:+.10f}*ccdy{2:+.10f}'
         A = np.vstack([np.ones(len(x)), x, y, x ** 2, y ** 2, x * y]).T
 
         delta = 1.0 / 60.0 / 60.0  # step, in degrees, for calculating numerical derivative
@@ -996,81 +1515,75 @@ class Aberrator(object):
         elon, elat = notnudged.celestial.tuple
 
         nudgedinlon = cartographer.point(elon + delta, elat, type='celestial')
-        dxdelon = (nudgedinlon.ccdxy.x - x) / delta
-        self.coefs['x'] = np.linalg.lstsq(A, dxdelon)[0]
-
-        def model_dxdelon(x, y):
-            return self.coefs['x'][0] + self.coefs['x'][1] * x + self.coefs['x'][2] * y + self.coefs['x'][3] * x ** 2 + \
-                   self.coefs['x'][4] * y ** 2 + self.coefs['x'][5] * x * y  # pixels/degree
-
-        self.derivatives['x'] = model_dxdelon
-        self.strings['x'] = template.format(*self.coefs['x'])
-        self.raw['x'] = dxdelon
-        self.inputs['x'] = x
-
-        dydelon = (nudgedinlon.ccdxy.y - y) / delta
-        self.coefs['y'] = np.linalg.lstsq(A, dydelon)[0]
-
-        def model_dydelon(x, y):
-            return self.coefs['y'][0] + self.coefs['y'][1] * x + self.coefs['y'][2] * y + self.coefs['y'][3] * x ** 2 + \
-                   self.coefs['y'][4] * y ** 2 + self.coefs['y'][5] * x * y  # pixels/degree
-
-        self.derivatives['y'] = model_dydelon
-        self.strings['y'] = template.format(*self.coefs['y'])
-        self.raw['y'] = dydelon
-        self.inputs['y'] = y
-
-        # plt.ion()
-        '''
-    plt.figure()
-    plt.scatter(x, 3600.0/dxdelon, c=y)
-    plt.ylabel('arcsec of longitude/xpix')
-    plt.figure()
-
-    plt.scatter(x, 3600.0/dxdelat, c=y)
-    plt.ylabel('arcsec of longitude/xpix')
-
-    assert(False)
-    '''
+        raw = dict(x=(nudgedinlon.ccdxy.x - x) / delta, y=(nudgedinlon.ccdxy.y - y) / delta)
+        coefs = np.array([np.linalg.lstsq(A, raw[k])[0] for k in ['x', 'y']])
+
         plt.figure(figsize=(20, 10))
         gs = gridspec.GridSpec(2, 3, hspace=0.3, bottom=.2)
         for i, k in enumerate(['x', 'y']):
+            inputs = dict(x=x, y=y)[k]
+            model = polynomial(coefs[i])(x, y)
             plt.subplot(gs[i, 0])
-            plt.scatter(self.inputs[k], self.raw[k], c=y, edgecolor='none')
+            plt.scatter(inputs, raw[k], c=y, edgecolor='none')
             plt.ylabel('dccd{0}/delon (pixels/degrees)'.format(k))
             if i == 1:
                 plt.xlabel('directly\ncalculated')
             plt.subplot(gs[i, 1])
-            plt.scatter(self.inputs[k], self.derivatives[k](x, y), c=y, edgecolor='none')
+            plt.scatter(inputs, model, c=y, edgecolor='none')
             if i == 1:
                 plt.xlabel('model')
 
             plt.subplot(gs[i, 2])
-            plt.scatter(self.inputs[k], self.raw[k] - self.derivatives[k](x, y), c=y, edgecolor='none')
+            plt.scatter(inputs, raw[k] - model, c=y, edgecolor='none')
             if i == 1:
                 plt.xlabel('residuals')
 
         plt.savefig(os.path.join(self.ccd.directory, 'aberrationgeometry.pdf'))
+        return coefs
+
+    def spatialFactors(self, elon, x, y):
+        """Each star's part of the aberration, which doesn't change with time.
+
+            Returns {'x': (cosine, sine), 'y': (cosine, sine)}, where cosine = cos(L-FCLON)*ABD?FUNC(x,y)
+            and sine = sin(L-FCLON)*ABD?FUNC(x,y), for stars at ecliptic longitudes L and CCD positions (x, y)."""
+
+        offset = (np.asarray(elon) - self.fclon) * np.pi / 180.0
+        cosoffset, sinoffset = np.cos(offset), np.sin(offset)
+        factors = {}
+        for k in ['x', 'y']:
+            derivative = self.derivatives[k](x, y)
+            factors[k] = derivative * cosoffset, derivative * sinoffset
+        return factors
+
+    def nudges(self, factors, dt):
+        """The nudges (dx, dy, in pixels, relative to the field center) for stars with these factors, at dt days from antisun.
+
+            dt can be an array of times, in which case dx and dy have the shape of dt + the shape of the factors."""
+
+        # how far has the Earth moved (in ecliptic lon.), and how much does that nudge longitudes?
+        dtheta = 360.0 * np.asarray(dt) / 365.25 * np.pi / 180.0
+        scale = self.beta * 180 / np.pi  # degrees
+        c, s = scale * np.cos(dtheta), scale * np.sin(dtheta)
+
+        # (the field center's nudge is the same cosine term, so it's subtracted from the factors)
+        return tuple(np.multiply.outer(c, factors[k][0] - self.centerderivatives[k]) -
+                     np.multiply.outer(s, factors[k][1]) for k in ['x', 'y'])
+
+    def fieldCenter(self, dt):
+        """The nudges (fcdx, fcdy, in pixels) of the field center, at dt days from antisun."""
+        dfcelon = self.beta * np.cos(360.0 * np.asarray(dt) / 365.25 * np.pi / 180.0) * 180 / np.pi
+        return self.centerderivatives['x'] * dfcelon, self.centerderivatives['y'] * dfcelon
 
     def plotPossibilities(self, n=100):
         x, y = np.random.uniform(0, self.ccd.xsize, n), np.random.uniform(0, self.ccd.ysize, n)
         stars = self.ccd.camera.cartographer.point(x, y, type='ccdxy')
 
-        dx, dy, delon = [], [], []
-        fcdx, fcdy = [], []
+        # the nudges over a whole year, all at once
         bjds = np.linspace(0, 365, 1000) + self.ccd.camera.bjd0
-        for bjd in bjds:
-            nudges = self.ccd.aberrations(stars, bjd)
-            dx.append(nudges[0])
-            dy.append(nudges[1])
-            fcdx.append(self.ccd.fcdx)
-            fcdy.append(self.ccd.fcdy)
-            delon.append(self.ccd.delon)
-
-        dx = np.array(dx)
-        dy = np.array(dy)
-        fcdx = np.array(fcdx)
-        fcdy = np.array(fcdy)
+        dts = bjds - self.ccd.camera.bjdantisun
+        dx, dy = self.nudges(self.spatialFactors(stars.ecliptic.elon, x, y), dts)
+        fcdx, fcdy = self.fieldCenter(dts)
+
         plt.figure(figsize=(8, 8))
         gs = gridspec.GridSpec(2, 2, left=0.15, wspace=0.3)
         bjds -= min(bjds)
@@ -1102,6 +1615,15 @@ class Aberrator(object):
         logger.info('saved a plot of the aberration over one year to {}'.format(path))
 
 
+def polynomial(coefs):
+    """The quadratic C + CX*x + CY*y + CXX*x**2 + CYY*y**2 + CXY*x*y, as a function of (x, y)."""
+
+    def model(x, y):
+        return coefs[0] + coefs[1] * x + coefs[2] * y + coefs[3] * x ** 2 + coefs[4] * y ** 2 + coefs[5] * x * y
+
+    return model
+
+
 def gauss(x, y, xcenter, ycenter):
     rsquared = (x - xcenter) ** 2 + (y - ycenter) ** 2
     sigma = 1.0
@@ -10,9 +10,11 @@ import settings
 import Catalogs
 from PSF import PSF
 from Cartographer import Cartographer
+from Pointing import Pointing
 from CCD import CCD
 from Jitter import Jitter
 from Focus import Focus
+from Workers import CCDWorkers
 from settings import log_file_handler
 
 logger = logging.getLogger(__name__)
@@ -36,6 +38,8 @@ class Camera(object):
                  positionangle=None,  # position angle of the field
                  stamps={2: None, 120: None, 1800: None},  # how many postage stamps?
                  variablefocus=False,
+                 seed=None,  # seed for the random numbers in the exposures (drawn at random if None)
+                 imagedtype='float32',  # what kind of numbers should the simulated images be made of?
                  dirprefix='',
                  psfkw={},
                  jitterkw={},
@@ -55,6 +59,15 @@ class Camera(object):
         # keep track of which exposure is being simulated
         self.counter = 0
 
+        # each exposure's random numbers are derived from this seed, its cadence, its CCD, and its counter
+        #  (if no seed is given, draw one now, so the exposures of this camera can still be made in any order)
+        if seed is None:
+            seed = np.random.randint(0, 2 ** 31 - 1)
+        self.seed = seed
+
+        # the images are built up in this precision (float32 takes half the memory of float64)
+        self.imagedtype = np.dtype(imagedtype)
+
         # [logger.info will only report for this object if mute and pithy are turned off]
         logger.info("turning on a new TESS camera object.")
 
@@ -156,10 +169,31 @@ class Camera(object):
         zachopy.utils.mkdir(d)
         return d
 
-    def expose(self, **kwargs):
-        """Take an exposure on all the available CCD's."""
-        for c in self.ccds:
-            c.expose(**kwargs)
+    def expose(self, parallel=False, advancecounter=True, **kwargs):
+        """Take an exposure on all the available CCD's.
+            (if parallel=True, expose them all at once, each in its own worker process)"""
+
+        if parallel:
+            # (re)start the workers, if they haven't been started for this cadence
+            try:
+                assert (self.workers.cadence == self.cadence)
+            except AttributeError:
+                self.workers = CCDWorkers(self)
+            except AssertionError:
+                self.stopWorkers()
+                self.workers = CCDWorkers(self)
+            return self.workers.expose(advancecounter=advancecounter, **kwargs)
+
+        # (the last CCD will update the counter)
+        return [c.expose(advancecounter=advancecounter, **kwargs) for c in self.ccds]
+
+    def stopWorkers(self):
+        """Shut down the worker processes started by a parallel expose (if any)."""
+        try:
+            self.workers.stop()
+            del self.workers
+        except AttributeError:
+            pass
 
     def populateHeader(self):
         """Populate the header structure with information about the Camera, and its WCS."""
@@ -213,7 +247,7 @@ class Camera(object):
         # load the PSF for this Camera
         self.psf = PSF(camera=self, **self.psfkw)
 
-        # make sure the background image gets reset
+        # make sure the background image gets reset (it'll be rescaled from the background rate for this cadence)
         for c in self.ccds:
             try:
                 del c.backgroundimage
@@ -262,6 +296,9 @@ class Camera(object):
         # the coordinate system type - what should I use?
         self.wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"]
 
+        # the same projection, for quickly projecting whole catalogs (which it caches, until the camera is repointed)
+        self.pointing = Pointing(nudged_ra, nudged_dec, self.pixelscale)
+
         # set this to be the WCS
         # self.populateHeader()
 
@@ -1,6 +1,5 @@
 import numpy as np
-import astropy.coordinates
-import zachopy.borrowed.crossfield as crossfield
+import Spherical
 import logging
 from settings import log_file_handler
 
@@ -262,13 +261,12 @@ class celestial(position):
 
     @property
     def galactic(self):
-        gal = astropy.coordinates.ICRS(ra=self.ra, dec=self.dec, unit=(astropy.units.deg, astropy.units.deg)).galactic
-        l, b = gal.l.degree, gal.b.degree
+        l, b = Spherical.convert(self.ra, self.dec, 'celestial', 'galactic')
         return galactic(l, b, self.cartographer)
 
     @property
     def ecliptic(self):
-        elon, elat = crossfield.euler(self.ra, self.dec, select=3)
+        elon, elat = Spherical.convert(self.ra, self.dec, 'celestial', 'ecliptic')
         return ecliptic(elon, elat, self.cartographer)
 
 
@@ -283,10 +281,14 @@ class galactic(position):
     # use properties to define conversions (at least celestial and self)
     @property
     def celestial(self):
-        cel = astropy.coordinates.Galactic(l=self.glon, b=self.glat, unit=(astropy.units.deg, astropy.units.deg)).icrs
-        ra, dec = cel.ra.degree, cel.dec.degree
+        ra, dec = Spherical.convert(self.glon, self.glat, 'galactic', 'celestial')
         return celestial(ra, dec, self.cartographer)
 
+    @property
+    def ecliptic(self):
+        elon, elat = Spherical.convert(self.glon, self.glat, 'galactic', 'ecliptic')
+        return ecliptic(elon, elat, self.cartographer)
+
     @property
     def galactic(self):
         return self
@@ -303,9 +305,14 @@ class ecliptic(position):
     # use properties to define conversions (at least celestial and self)
     @property
     def celestial(self):
-        ra, dec = crossfield.euler(self.elon, self.elat, select=4)
+        ra, dec = Spherical.convert(self.elon, self.elat, 'ecliptic', 'celestial')
         return celestial(ra, dec, self.cartographer)
 
+    @property
+    def galactic(self):
+        glon, glat = Spherical.convert(self.elon, self.elat, 'ecliptic', 'galactic')
+        return galactic(glon, glat, self.cartographer)
+
     @property
     def ecliptic(self):
         return self
@@ -9,12 +9,14 @@ import astropy.coordinates
 import astropy.units
 import zachopy.utils
 import numpy as np
+import scipy.spatial
 
 import matplotlib.pylab as plt
 
 import settings
 import relations
 import Lightcurve
+import Spherical
 from settings import log_file_handler
 
 logger = logging.getLogger(__name__)
@@ -83,7 +85,7 @@ class Catalog():
 			fractionwithextremelc=False (should we allow fractionwithextremelc variability [good for movies] or no?)
 
 		"""
-		np.random.seed(seed)
+		prng = np.random.RandomState(seed)
 		# total number of stars we need to deal with
 		ntotal = len(self.tmag)
 		
@@ -107,8 +109,8 @@ class Catalog():
 		
 		if self.cluster is None:
 			# use the input seed, to ensure it wor
-			for i in np.random.choice(brightenough, len(brightenough) * fractionofstarswithlc, replace=False):
-				self.lightcurves[i] = Lightcurve.random(**kw)
+			for i in prng.choice(brightenough, len(brightenough) * fractionofstarswithlc, replace=False):
+				self.lightcurves[i] = Lightcurve.random(prng=prng, **kw)
 		else:
 			mem, = np.where(self.member == 1)
 			nonmem, = np.where(self.member != 1)
@@ -116,20 +118,54 @@ class Catalog():
 			print "assigning periods to nonmembers ", len(nonmem)
 			# all members get periods
 			for i in mem: 
-				self.lightcurves[i] = Lightcurve.random(cluster=self.cluster, **kw)
+				self.lightcurves[i] = Lightcurve.random(cluster=self.cluster, prng=prng, **kw)
 			# only bright nonmembers get periods
 			for i in nonmem:
 				if (self.tmag[i] < fainteststarwithlc) or (fainteststarwithlc is None):
-					self.lightcurves[i] = Lightcurve.random(**kw)
+					self.lightcurves[i] = Lightcurve.random(prng=prng, **kw)
 
 	@property
 	def lightcurvecodes(self):
 		"""return an array of the light curve codes"""
 		return [lc.code for lc in self.lightcurves]
+
+	@property
+	def lightcurvebank(self):
+		"""the light curves, gathered into a LightCurveBank (remade whenever self.lightcurves is replaced)"""
+		try:
+			assert (self.bank.lightcurves is self.lightcurves)
+		except (AttributeError, AssertionError):
+			self.bank = Lightcurve.LightCurveBank(self.lightcurves)
+		return self.bank
 	
 	def arrays(self):
 		"""return (static) arrays of positions, magnitudes, and effective temperatures"""
 		return self.ra, self.dec, self.tmag, self.temperature
+
+	def buildIndex(self):
+		"""build a spatial index (a KD-tree of unit vectors) of the stars, at the catalog's epoch"""
+		self.spatialindex = scipy.spatial.cKDTree(Spherical.unitVectors(self.ra, self.dec).T)
+		self.indexedstars = len(self.ra)
+		logger.info('built a spatial index of {0} stars'.format(self.indexedstars))
+
+	def near(self, ra, dec, radius, epoch=None):
+		"""return the (sorted) indices of the stars within radius (degrees) of (ra, dec);
+		if an epoch is given, the radius grows by how far the fastest star could have moved since the catalog's epoch"""
+
+		# build the index the first time it's needed (or if the catalog has changed size)
+		try:
+			assert (self.indexedstars == len(self.ra))
+		except (AttributeError, AssertionError):
+			self.buildIndex()
+
+		if epoch is not None and len(self.ra) > 0:
+			fastest = np.max(np.sqrt(self.pmra ** 2 + self.pmdec ** 2)) / 60.0 / 60.0 / 1000.0  # in degrees/year
+			radius = radius + fastest * np.abs(epoch - self.epoch)
+
+		# (search in straight-line distance through the unit sphere)
+		chord = 2.0 * np.sin(np.radians(np.minimum(radius, 180.0)) / 2.0)
+		nearby = self.spatialindex.query_ball_point(Spherical.unitVectors(ra, dec), chord)
+		return np.sort(np.array(nearby, dtype=np.int))
 	
 	def snapshot(self, bjd=None, epoch=None, exptime=0.5 / 24.0):
 		"""return a snapshot of positions, magnitudes, and effective temperatures
@@ -144,7 +180,7 @@ class Catalog():
 		ra, dec = self.atEpoch(epoch)
 		
 		# determine brightness of star
-		moment = np.array([lc.integrated(bjd, exptime) for lc in self.lightcurves]).flatten()
+		moment = self.lightcurvebank.integrated(bjd, exptime)
 		tmag = self.tmag + moment
 		
 		# determine color of star
@@ -683,4 +719,7 @@ class Trimmed(Catalog):
         for k in keystotransfer:
             self.__dict__[k] = inputcatalog.__dict__[k][keep]
 
+        # remember which of the input catalog's stars these are
+        self.parentindices = np.arange(len(inputcatalog.ra))[keep]
+
         self.epoch = inputcatalog.epoch
@@ -0,0 +1,111 @@
+"""Draw cosmic rays from a library of pre-generated images, instead of generating them for every exposure."""
+
+import os
+import numpy as np
+import zachopy.utils
+import Cosmics
+import settings
+import logging
+from settings import log_file_handler
+
+logger = logging.getLogger(__name__)
+logger.addHandler(log_file_handler)
+
+# the libraries this process has opened, keyed by filename (so all CCDs share them)
+libraries = {}
+
+
+def load(nframes, size, exptime, **kwargs):
+    """Open a library of nframes cosmic ray images (making it first, if need be)."""
+    library = CosmicLibrary(nframes, size, exptime, **kwargs)
+    try:
+        return libraries[library.filename]
+    except KeyError:
+        library.open()
+        libraries[library.filename] = library
+        return library
+
+
+class CosmicLibrary(object):
+    """A stack of cosmic ray images, each (size + 2*margin) pixels on a side, memory-mapped from disk.
+
+        Every exposure takes a size x size window out of one of the images, at a random offset,
+        flipped and rotated at random. Any image with the right exposure time has the right rate of
+        cosmic rays, so this is statistically the same as generating a new one (but much faster, for
+        thousands of 2s exposures). With a gradient, the window is only flipped along the rows, so
+        the gradient (along the columns) stays the right way around."""
+
+    def __init__(self, nframes, size, exptime, rate=5.0, gradient=False, diffusion=False, margin=100, seed=0):
+        self.nframes = int(nframes)
+        self.size = int(size)
+        self.exptime = exptime
+        self.rate = rate
+        self.gradient = gradient
+        self.diffusion = diffusion
+        self.margin = int(margin)
+        self.seed = seed
+
+        # the library's file is named by everything that went into making it
+        self.bigsize = self.size + 2 * self.margin
+        key = 'library_{0}x{1}x{1}_{2:.0f}s_rate{3}_gradient{4}_diffusion{5}_seed{6}'.format(
+            self.nframes, self.bigsize, self.exptime, self.rate, self.gradient, self.diffusion, self.seed)
+        self.directory = os.path.join(settings.intermediates, 'cosmics')
+        self.filename = os.path.join(self.directory, key + '.npy')
+
+    def open(self):
+        """Memory-map the library from disk (making it first, if it doesn't exist yet)."""
+        try:
+            self.frames = np.load(self.filename, mmap_mode='r')
+        except IOError:
+            self.create()
+            self.frames = np.load(self.filename, mmap_mode='r')
+        logger.info('opened a library of {0} cosmic ray images from {1}'.format(self.nframes, self.filename))
+
+    def create(self):
+        """Generate the library's images with Al's code, and save them to disk."""
+
+        zachopy.utils.mkdir(self.directory)
+        logger.info('generating a library of {0} {1}x{1} cosmic ray images, for {2:.0f}s exposures'.format(
+            self.nframes, self.bigsize, self.exptime))
+
+        # (write under a temporary name first, so no one ever loads a half-written library)
+        partial = settings.partialFilename(self.filename)
+        frames = np.lib.format.open_memmap(partial, mode='w+', dtype=np.float32,
+                                           shape=(self.nframes, self.bigsize, self.bigsize))
+        generator = Cosmics.Generator(self.seed)
+        buffersize = 100
+        buffered = np.zeros((self.bigsize + 2 * buffersize,) * 2, dtype=np.float32)
+        for i in range(self.nframes):
+            frames[i] = Cosmics.cosmicImage(exptime=self.exptime, size=self.bigsize, buffer_size=buffersize,
+                                            rate=self.rate, gradient=self.gradient, diffusion=self.diffusion,
+                                            generator=generator, buffered=buffered)
+        frames.flush()
+        del frames
+        os.rename(partial, self.filename)
+        logger.info('saved cosmic ray library to {0}'.format(self.filename))
+
+    def draw(self, prng):
+        """Pick a random window out of the library, with random numbers from prng.
+
+            Returns (image, choices), where choices is a dictionary of which image was used
+            and how it was flipped, rotated, and offset (enough to draw the same one again)."""
+
+        # (a numpy Generator draws integers with .integers; an older RandomState, with .randint)
+        try:
+            integers = prng.integers
+        except AttributeError:
+            integers = prng.randint
+
+        choices = dict(frame=int(integers(self.nframes)),
+                       flip=int(integers(2)),
+                       rotation=0 if self.gradient else int(integers(4)),
+                       offsety=int(integers(2 * self.margin + 1)),
+                       offsetx=int(integers(2 * self.margin + 1)))
+        return self.window(**choices), choices
+
+    def window(self, frame=0, flip=0, rotation=0, offsety=0, offsetx=0):
+        """A size x size window from one library image (flipped along the rows, then rotated by 90 degree steps)."""
+        image = self.frames[frame, offsety:offsety + self.size, offsetx:offsetx + self.size]
+        if flip:
+            image = image[::-1, :]
+        return np.rot90(image, rotation)
@@ -1,19 +1,43 @@
 # noinspection PyUnresolvedReferences
-from cosmical_realistic import cosmical
-import scipy.signal
+from cosmical_realistic import cosmical, Generator
 import numpy as np
 
+# Al's diffusion kernal (from the fancy code), spreading a pixel's charge into its neighbors
+kernal = np.array([[0.0034, 0.0516, 0.0034],
+                   [0.0516, 0.7798, 0.0516],
+                   [0.0034, 0.0516, 0.0034]])
 
-def cosmicImage(exptime=1800.0, size=2048, rate=5.0, gradient=False, diffusion=False, buffer_size=100):
-    """Generate a cosmic ray image, using Al Levine's fast C code."""
+
+def exposureTimes(exptime, gradient=False):
+    """The range of exposure times Al's code should spread the cosmic rays over."""
 
     # if a gradient is set, allow the exposure times to be different
     if gradient:
-        smallexptime = exptime
-        bigexptime = exptime * 2
+        return exptime, exptime * 2
     else:
-        smallexptime = exptime * 1.5
-        bigexptime = exptime * 1.5
+        return exptime * 1.5, exptime * 1.5
+
+
+def diffuseHits(rows, columns, electrons):
+    """Spread each hit's electrons over its 3x3 neighborhood, with Al's kernal.
+
+        (The same as convolving an image of the hits with the kernal, but only touching the
+        pixels next to hits. Pixels may be listed more than once, and some may be off the edge.)"""
+
+    spread = [(rows + di, columns + dj, electrons * kernal[di + 1, dj + 1])
+              for di in (-1, 0, 1) for dj in (-1, 0, 1)]
+    return tuple(np.concatenate(a) for a in zip(*spread))
+
+
+def cosmicImage(exptime=1800.0, size=2048, rate=5.0, gradient=False, diffusion=False, buffer_size=100,
+                generator=None, buffered=None):
+    """Generate a cosmic ray image, using Al Levine's fast C code.
+
+        generator is a cosmical_realistic.Generator (keeping its own, seedable random numbers);
+        if None, the C code seeds itself from the clock. buffered is an (optional) float32 array
+        of size (size + 2*buffer_size)**2 for the generator to fill, so it can be reused."""
+
+    smallexptime, bigexptime = exposureTimes(exptime, gradient)
 
     # add margin around image, because Al's code doesn't start cosmic ray images off the screen
     bufferedsize = size + 2 * buffer_size
@@ -22,16 +46,55 @@ def cosmicImage(exptime=1800.0, size=2048, rate=5.0, gradient=False, diffusion=F
     intdiffusion = 0  # np.int(diffusion)
 
     # call the fancy cosmic ray code
-    image = cosmical(rate, smallexptime, bigexptime, bufferedsize, bufferedsize, intdiffusion)
+    if generator is None:
+        image = cosmical(rate, smallexptime, bigexptime, bufferedsize, bufferedsize, intdiffusion)
+    else:
+        if buffered is None:
+            buffered = np.zeros((bufferedsize, bufferedsize), dtype=np.float32)
+        else:
+            buffered[:] = 0.0
+        generator.fill(buffered, rate, smallexptime, bigexptime)
+        image = buffered
 
-    # if we need to diffuse the image, use Al's kernal (from the fancy code)
+    # if we need to diffuse the image, spread out only the pixels that were hit (most of the image is empty)
     if diffusion:
-        kernal = np.array([[0.0034, 0.0516, 0.0034],
-                           [0.0516, 0.7798, 0.0516],
-                           [0.0034, 0.0516, 0.0034]])
-        image = scipy.signal.convolve2d(image, kernal, mode='same')
+        hitrows, hitcolumns = np.nonzero(image)
+        rows, columns, electrons = diffuseHits(hitrows, hitcolumns, image[hitrows, hitcolumns])
+        onimage = (rows >= 0) & (rows < bufferedsize) & (columns >= 0) & (columns < bufferedsize)
+        image[hitrows, hitcolumns] = 0.0
+        np.add.at(image, (rows[onimage], columns[onimage]), electrons[onimage])
 
     good_image = image[buffer_size:-buffer_size, buffer_size:-buffer_size] if buffer_size > 0 else image[:, :]
 
     # return the image
-    return good_image
\ No newline at end of file
+    return good_image
+
+
+def cosmicHits(exptime=1800.0, size=2048, rate=5.0, gradient=False, diffusion=False, buffer_size=100,
+               generator=None):
+    """Generate cosmic rays with Al Levine's C code, as a sparse list of the pixels they hit.
+
+        Returns (rows, columns, electrons), with each hit pixel of the size x size image listed once.
+        A cosmic ray only touches a few dozen pixels, so this is much smaller than a whole image."""
+
+    smallexptime, bigexptime = exposureTimes(exptime, gradient)
+
+    # add margin around image, because Al's code doesn't start cosmic ray images off the screen
+    bufferedsize = size + 2 * buffer_size
+
+    # call the fancy cosmic ray code (seeding it from the clock, if no generator was given)
+    if generator is None:
+        generator = Generator()
+    rows, columns, electrons = generator.hits(bufferedsize, bufferedsize, rate, smallexptime, bigexptime)
+
+    # if we need to diffuse the hits, spread each into its neighbors
+    if diffusion:
+        rows, columns, electrons = diffuseHits(rows, columns, electrons)
+
+    # trim off the margin, and add up the hits that landed on the same pixels
+    rows, columns = rows - buffer_size, columns - buffer_size
+    onimage = (rows >= 0) & (rows < size) & (columns >= 0) & (columns < size)
+    pixels, which = np.unique(rows[onimage] * size + columns[onimage], return_inverse=True)
+    electrons = np.bincount(which, weights=electrons[onimage], minlength=len(pixels))
+
+    return pixels // size, pixels % size, electrons
@@ -17,7 +17,7 @@ logger.addHandler(log_file_handler)
 def makeCartoon(seed=1):
     """Create a cartoon jitter timeseries"""
 
-    np.random.seed(seed)
+    prng = np.random.RandomState(seed)
     rmsat2s = 2.0 / 3.0
     rmsat120s = 0.21
 
@@ -33,7 +33,7 @@ def makeCartoon(seed=1):
     d = {}
     d['t'] = t
     for k in ['x', 'y']:
-        v = np.random.normal(0, 1, n)
+        v = prng.normal(0, 1, n)
         for i in range(2):
             v = np.convolve(v, np.ones(nsmooth), mode='same')
         d[k] = v / np.std(v) * rmsat2s1d
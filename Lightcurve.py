@@ -99,7 +99,7 @@ def generate(code):
 def random(options=('trapezoid', 'sin'),
            fractionwithextremelc=0.01, fractionwithrotation=None,
            fractionwithtrapezoid=None, fractionwithcustom=0.0, 
-           cluster=None, temperature=None, **kw):
+           cluster=None, temperature=None, prng=np.random, **kw):
     """
     random() returns random Lightcurve.
 
@@ -117,8 +117,8 @@ def random(options=('trapezoid', 'sin'),
     """
 
     # first of all, give preference to try to be extreme
-    if np.random.uniform(0, 1) < fractionwithextremelc:
-        return cartoonrandom(options=options, extreme=True)
+    if prng.uniform(0, 1) < fractionwithextremelc:
+        return cartoonrandom(options=options, extreme=True, prng=prng)
     else:
         # by default, set the fraction that get rotation to that from Kepler
         if fractionwithrotation is None:
@@ -133,15 +133,15 @@ def random(options=('trapezoid', 'sin'),
 
         # give trapezoids preference over sin curves
         if 'trapezoid' in options:
-            if np.random.uniform(0, 1) < fractionwithtrapezoid:
-                return draw_transit()
+            if prng.uniform(0, 1) < fractionwithtrapezoid:
+                return draw_transit(prng=prng)
 
         # then, try to include a sine curve
         if 'sin' in options:
             if cluster is not None: ## assume all cluster stars have rotation periods
-                return draw_cluster_rotation(cluster=cluster, temperature=temperature)
-            elif np.random.uniform(0, 1) < fractionwithrotation:
-                return draw_rotation()
+                return draw_cluster_rotation(prng=prng, cluster=cluster, temperature=temperature)
+            elif prng.uniform(0, 1) < fractionwithrotation:
+                return draw_rotation(prng=prng)
 
 
     # if nothing else, make the light curve a constant
@@ -295,19 +295,88 @@ class Trapezoid(LightCurve):
         return t - self.closesttransit(t)
 
     def model(self, t):
-        """model is returned in magnitudes, relative to a baseline level"""
-        flux = np.zeros_like(t)
+        """model is returned in magnitudes, relative to a baseline level
+
+            (the traits can be arrays, to model many trapezoids at once; see LightCurveBank)"""
         dt = np.abs(self.timefrommidtransit(t))
         start, finish = self.traits['T23'] / 2.0, self.traits['T14'] / 2.0
         depth = self.traits['D']
 
-        i = dt <= start
-        flux[i] = depth
-        i = (dt <= finish) * (dt > start)
-        flux[i] = (finish - dt[i]) / (finish - start) * depth
+        # (if T23 == T14, there's no ingress, so its division by zero is never used)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ingress = (finish - dt) / (finish - start) * depth
+        flux = np.where(dt <= start, depth, np.where(dt <= finish, ingress, 0.0))
 
         return flux
 
+
+class LightCurveBank(object):
+    """All of a catalog's light curves, with the traits of each kind gathered into arrays.
+
+        Instead of integrating each star's light curve on its own, the bank models all the
+        sinusoids (or trapezoids) at once, as a single LightCurve whose traits are arrays.
+        Constants are skipped, and any other kinds are integrated one at a time."""
+
+    # the kinds of light curves that can be modeled with arrays of traits
+    vectorized = ['Sinusoid', 'Trapezoid']
+
+    def __init__(self, lightcurves):
+        self.lightcurves = lightcurves
+        self.n = len(lightcurves)
+
+        # sort the stars by what kind of light curve they have
+        kinds = {}
+        for i, lc in enumerate(lightcurves):
+            kinds.setdefault(lc.__class__.__name__, []).append(i)
+        kinds.pop('constant', None)
+
+        # gather the traits of each kind that can be vectorized into arrays
+        self.groups = []
+        for name in self.vectorized:
+            try:
+                index = np.array(kinds.pop(name))
+            except KeyError:
+                continue
+            traits = {}
+            for k in lightcurves[index[0]].traits.keys():
+                traits[k] = np.array([lightcurves[i].traits[k] for i in index], dtype=np.float64)
+            self.groups.append((globals()[name], index, traits))
+
+        # (anything else gets integrated one star at a time)
+        self.others = np.sort(np.concatenate([np.array(i) for i in kinds.values()] + [np.zeros(0, dtype=np.int)]))
+        logger.info('gathered {0} light curves into a bank ({1})'.format(
+            self.n, ', '.join(['{0} {1}'.format(len(index), kind.__name__) for kind, index, traits in self.groups])))
+
+    def integrated(self, t, exptime=30.0 / 60.0 / 24.0, resolution=100, chunksize=10000):
+        """integrate every star's flux over a finite exposure time, at one or more times.
+
+            returns magnitudes (relative to each star's baseline), as a (stars) array for a
+            single time, or as a (times x stars) array for an array of times"""
+
+        times = np.atleast_1d(t)
+        mag = np.zeros((len(times), self.n))
+
+        # create a high-resolution subsampled timeseries (subsamples x times x stars)
+        nudges = np.linspace(-exptime / 2.0, exptime / 2.0, resolution)
+        subsampled = times.reshape(1, len(times), 1) + nudges.reshape(resolution, 1, 1)
+
+        for kind, index, traits in self.groups:
+            # model a chunk of stars at a time (the subsampled fluxes can be big)
+            for start in range(0, len(index), chunksize):
+                chunk = slice(start, start + chunksize)
+                lc = kind(**dict((k, v[chunk]) for k, v in traits.items()))
+
+                # make sure the average is photon-weighted (as opposed to magnitude weighted)
+                flux = 10 ** (-0.4 * lc.model(subsampled))
+                mag[:, index[chunk]] = -2.5 * np.log10(flux.mean(0))
+
+        for i in self.others:
+            mag[:, i] = self.lightcurves[i].integrated(times, exptime, resolution)
+
+        if np.ndim(t) == 0:
+            return mag[0]
+        return mag
+
 # class custom(LightCurve):
 #     def __init__(self, filepath):
 #         ''' load a light curve from a file path'''
@@ -15,11 +15,8 @@ from settings import log_file_handler
 logger = logging.getLogger(__name__)
 logger.addHandler(log_file_handler)
 
-import Cartographer
-
-
-# create a cartographer for managing conversions between ecliptic and galactic coordinates
-carto = Cartographer.Cartographer()
+# for converting between celestial, ecliptic, and galactic coordinates
+import Spherical
 
 # create an interpolator to estimate the best number of pixels in a photometric aperture
 optimalpixelsdata = astropy.io.ascii.read(pkgutil.get_data(__name__, 'relations/optimalnumberofpixels.txt'))
@@ -102,7 +99,7 @@ def noise(imag=10.0, exptime=1800.0, teff=5000.0,
     e_star = 10.0 ** (-0.4 * tmag) * tmag0 * effective_area * exptime * frac_aper
 
     if ra is not None and dec is not None:
-        elon, elat = carto.point(ra, dec, 'celestial').ecliptic.tuple
+        elon, elat = Spherical.convert(ra, dec, 'celestial', 'ecliptic')
 
     logger.debug('imag = {}'.format(imag))
     logger.debug('tmag = {}'.format(tmag))
@@ -132,8 +129,7 @@ def noise(imag=10.0, exptime=1800.0, teff=5000.0,
 
     # photoelectrons/pixel from background stars
     try:
-        coord = carto.point(elon, elat, 'ecliptic')
-        glon, glat = coord.galactic.tuple
+        glon, glat = Spherical.convert(elon, elat, 'ecliptic', 'galactic')
     except:
         glon, glat = 96.36079818, -30.18846954
     glon = np.array([glon])
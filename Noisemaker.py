@@ -0,0 +1,121 @@
+"""Add photon and read noise to images, in parallel over blocks of rows."""
+
+import threading
+import numpy as np
+import Workers
+import logging
+from settings import log_file_handler
+
+logger = logging.getLogger(__name__)
+logger.addHandler(log_file_handler)
+
+
+class Noisemaker(object):
+    """Draw the noise for an image in blocks of rows, each block with its own random stream.
+
+        With numpy's newer (PCG64) generators, block i draws from the exposure's generator
+        jumped ahead i + 1 times, so the blocks' streams never overlap and can be filled by
+        several threads at once; the noise doesn't depend on how many threads there are.
+        The exposure's generator is then left jumped past all of them, so the next call (or
+        anything else drawing from it) gets new numbers. With older numpy (no Generator),
+        the blocks draw from the one generator, in order."""
+
+    def __init__(self, threads=None, blockrows=128):
+        # how many threads should fill blocks at once? (None uses this process's share of the cores)
+        if threads is None:
+            threads = Workers.threadsPerProcess()
+        self.threads = max(int(threads), 1)
+
+        # how many rows of the image go into each block?
+        self.blockrows = blockrows
+
+    def streams(self, prng, nblocks):
+        """Independent generators for each of nblocks blocks (or None, if prng can't be jumped ahead).
+
+            (prng itself is moved on past all the blocks' streams)"""
+        try:
+            bitgenerator = prng.bit_generator
+        except AttributeError:
+            return None
+
+        # each block's stream starts one jump past the last one's
+        jumped, streams = bitgenerator, []
+        for i in range(nblocks):
+            jumped = jumped.jumped()
+            streams.append(np.random.Generator(jumped))
+
+        # move the exposure's generator on past the last block, so it never repeats them
+        bitgenerator.state = jumped.jumped().state
+        return streams
+
+    def addNoise(self, image, prng, photons=True, readvariance=0.0, poissonbelow=0.0, noise=None):
+        """Add noise to an image (in place), returning an image of the noise's standard deviation.
+
+            photons=True includes photon noise, with a variance equal to the (positive part of the) image.
+            readvariance is the variance of the (Gaussian) read noise, the same for every pixel.
+            poissonbelow sets how faint (in electrons) a pixel must be for its photon noise to be drawn
+            from an exact Poisson distribution, rather than the Gaussian approximation to it.
+            noise is an (optional) array to fill with the standard deviations.
+
+            Photon and read noise are added with a single draw per pixel, of their combined variance."""
+
+        if noise is None:
+            noise = np.empty_like(image)
+        nrows = image.shape[0]
+        blocks = [slice(start, min(start + self.blockrows, nrows)) for start in range(0, nrows, self.blockrows)]
+
+        def fill(rows, generator):
+            # the photon noise comes from the expected number of photons in each pixel
+            block, sigma = image[rows], noise[rows]
+            if photons:
+                expected = np.maximum(block, 0.0)
+                np.add(expected, readvariance, out=sigma)
+            else:
+                sigma[:] = readvariance
+            np.sqrt(sigma, out=sigma)
+
+            # draw one set of standard normal deviates for the block
+            deviates = np.empty_like(block)
+            try:
+                generator.standard_normal(out=deviates, dtype=deviates.dtype)
+            except TypeError:
+                deviates[:] = generator.standard_normal(deviates.shape)
+
+            faint = None
+            if photons and poissonbelow > 0:
+                faint = expected < poissonbelow
+            if faint is not None and faint.any():
+                # faint pixels get exact Poisson photon noise (leaving only the read noise in the Gaussian)
+                scale = sigma.copy()
+                scale[faint] = np.sqrt(readvariance)
+                deviates *= scale
+                deviates[faint] += generator.poisson(expected[faint]) - expected[faint]
+            else:
+                deviates *= sigma
+            block += deviates
+
+        streams = self.streams(prng, len(blocks))
+        if streams is None or self.threads == 1:
+            # one block after another (from each block's own stream, if there are any)
+            for i, rows in enumerate(blocks):
+                fill(rows, prng if streams is None else streams[i])
+        else:
+            # each thread takes every [threads]th block (numpy lets go of the GIL while it fills arrays)
+            errors = []
+
+            def work(first):
+                try:
+                    for i in range(first, len(blocks), self.threads):
+                        fill(blocks[i], streams[i])
+                except Exception as error:
+                    errors.append(error)
+
+            threads = [threading.Thread(target=work, args=(first,)) for first in range(min(self.threads, len(blocks)))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if len(errors) > 0:
+                raise errors[0]
+
+        return noise
@@ -8,6 +8,8 @@ import os
 import Camera
 import Catalogs
 import numpy as np
+import multiprocessing
+import Workers
 from debug import DebugDict
 from defaults import inputs as default
 import logging
@@ -16,6 +18,18 @@ from settings import log_file_handler
 logger = logging.getLogger(__name__)
 logger.addHandler(log_file_handler)
 
+# the observation being sharded across worker processes (inherited by them when they are forked)
+_shardedobservation = None
+
+
+def _exposeShard(counters):
+    """Expose all the CCDs at each of a list of counters (runs inside a worker process)."""
+    self = _shardedobservation
+    for counter in counters:
+        self.camera.counter = counter
+        self.camera.expose(parallel=False, advancecounter=False, **self.inputs['expose'])
+    return len(counters)
+
 
 class Observation(object):
     """an observation object handles a simulated group of observations,
@@ -38,6 +52,15 @@ class Observation(object):
         # setup the basics of the observation
         self.cadencestodo = self.inputs['observation']['cadencestodo']
         self.collate = self.inputs['observation']['collate']
+        self.parallel = self.inputs['observation'].get('parallel', False)
+        self.processes = self.inputs['observation'].get('processes', 1)
+        if self.processes > 1:
+            # (each shard exposes its CCDs in turn, so it can't also expose them all at once)
+            if self.parallel:
+                raise ValueError("processes > 1 can't be combined with parallel=True (choose one or the other)")
+            if not self.collate:
+                logger.warning('collate=False is ignored when processes > 1 '
+                               '(each process exposes all the CCDs at each of its counters)')
         self.testpattern = self.inputs['catalog']['name'].lower() == 'testpattern'
 
         # create the camera
@@ -49,10 +72,9 @@ class Observation(object):
     def expose(self):
         """execute one exposure of this observation, looping through all CCDs"""
 
-        # create one exposure, by looping over the CCDs
+        # create one exposure, by looping over the CCDs (or exposing them all at once)
         #   (the last CCD will update the counter)
-        for i, c in enumerate(self.camera.ccds):
-            c.expose(**self.inputs['expose'])
+        return self.camera.expose(parallel=self.parallel, **self.inputs['expose'])
 
     def create(self):
         """make *all* the exposures for this observation,
@@ -66,11 +88,14 @@ class Observation(object):
             # reset the counter
             self.camera.counter = 0
 
-            if self.collate:
-                # if collating, loop through exposure numbers, exposing all CCDs
+            if self.processes > 1:
+                # split the exposures into chunks of time, each made by a different process
+                self.createSharded(self.cadencestodo[k])
+
+            elif self.collate or self.parallel:
+                # if collating (or exposing the CCDs all at once), loop through exposure numbers, exposing all CCDs
                 for i in range(self.cadencestodo[k]):
-                    for c in self.camera.ccds:
-                        c.expose(**self.inputs['expose'])
+                    self.expose()
 
             else:
                 # if not collating, loop through CCDs, exposing all for each
@@ -83,6 +108,49 @@ class Observation(object):
                         # advance the counter by hand
                         c.camera.advanceCounter()
 
+        # shut down any worker processes
+        self.camera.stopWorkers()
+
+    def createSharded(self, nexposures):
+        """Make nexposures exposures (of all CCDs), splitting them in time across self.processes worker processes.
+
+            Each exposure's noise and cosmic rays come from its own random streams (set by the camera's
+            seed and the exposure's counter), so the images don't depend on which process made them, or
+            in what order. (The focusbasis/designmatrix caches follow the stars' drift exposure to
+            exposure, so with them turned on, shards may differ slightly from a serial run.)"""
+        global _shardedobservation
+
+        # the counters at which each exposure should be made
+        counters = [self.camera.counter + self.camera.counterstep * i for i in range(nexposures)]
+        if len(counters) == 0:
+            return
+
+        # make the first exposure here, so everything the exposures share
+        #  (catalog, PSF library, backgrounds) is ready before the workers are forked
+        logger.info('making the first exposure, before splitting the rest across {0} processes'.format(self.processes))
+        _shardedobservation = self
+        _exposeShard(counters[:1])
+
+        # split the rest into contiguous chunks of time
+        shards = [[int(c) for c in shard] for shard in np.array_split(counters[1:], self.processes) if len(shard) > 0]
+        if len(shards) > 0:
+            logger.info('exposing {0} more exposures in {1} shards'.format(len(counters) - 1, len(shards)))
+            # (the shards split the cores between them, so the threads inside each don't oversubscribe the machine)
+            Workers.sharers *= len(shards)
+            try:
+                pool = multiprocessing.Pool(len(shards))
+            finally:
+                Workers.sharers //= len(shards)
+            try:
+                pool.map(_exposeShard, shards, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        _shardedobservation = None
+
+        # leave the counter where it would be after exposing in turn
+        self.camera.counter = counters[-1] + self.camera.counterstep
+
     def createCamera(self):
 
         logger.info('setting up the camera for this Observation.')
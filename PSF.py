@@ -8,10 +8,12 @@ import zachopy.utils
 import numpy as np
 import astropy.io.fits
 import scipy.signal
+import scipy.fftpack
 import matplotlib.pylab as plt
 
 import settings
 import Intrapixel
+from Pixelizer import Pixelizer
 from CCD import CCD
 from Cartographer import Cartographer
 from settings import log_file_handler
@@ -19,6 +21,9 @@ from settings import log_file_handler
 logger = logging.getLogger(__name__)
 logger.addHandler(log_file_handler)
 
+# the order of the axes of the (dense) binned PSF library, before the [y, x] pixels of each PSF
+binnedaxes = ['focus', 'stellartemp', 'fieldx_px', 'fieldy_px', 'xoffset', 'yoffset']
+
 
 # define everything related to PSFs
 class PSF(object):
@@ -333,6 +338,10 @@ class PSF(object):
 
             logger.info('created pixel coordinate arrays')
 
+            # create a pixelizer, to bin (shifted) subpixel PSFs into these pixels
+            self.pixelizer = Pixelizer(self.dx_subpixels_axis, self.dx_pixels_edges,
+                                       self.dy_subpixels_axis, self.dy_pixels_edges, self.intrapixel)
+
             # create a subarray CCD with these parameters, to aid pixelization calculations
             self.ccd = CCD(camera=self.camera, subarray=self.dx_pixels.shape[0], number=1, label='PSF')
             self.cartographer = Cartographer(camera=self.ccd.camera, ccd=self.ccd)
@@ -381,7 +390,25 @@ class PSF(object):
         # self.header['PNSUBPIX'] = (unbinned_nsubpixels, '[pix] # of subpixels used for initial PSF integration')
         # self.header['PPIXSIZE'] = (self.pixsize, '[pix] pixel size')
 
-    def populateJitteredPSFLibrary(self):
+    def setupJitterKernel(self, imageshape):
+        """Take the FFT of the (normalized) jitter kernel, padded for convolving it with [imageshape] high-resolution PSFs."""
+        kernel = self.camera.jitter.jittermap[0] / np.sum(self.camera.jitter.jittermap[0])
+
+        # pad to the size of a full linear convolution (rounded up to a size that FFTs quickly)
+        self.jitterkernelshape = kernel.shape
+        self.jitterfftshape = tuple(scipy.fftpack.next_fast_len(n + m - 1) for n, m in zip(imageshape, kernel.shape))
+        self.jitterkernelfft = np.fft.rfft2(kernel, self.jitterfftshape)
+
+    def jitterConvolve(self, unjittered):
+        """Convolve a high-resolution PSF with the jitter kernel (the same as convolve2d(unjittered, kernel, 'same', 'fill', 0))."""
+        full = np.fft.irfft2(np.fft.rfft2(unjittered, self.jitterfftshape) * self.jitterkernelfft, self.jitterfftshape)
+
+        # trim the full convolution down to the same size (and centering) as the input
+        bottom, left = [(m - 1) // 2 for m in self.jitterkernelshape]
+        ny, nx = unjittered.shape
+        return full[bottom:bottom + ny, left:left + nx].astype(np.float32)
+
+    def populateJitteredPSFLibrary(self, processes=None):
         """convolve Deb's PSFs with a jittermap, at the camera's cadence"""
         logger.info('populating the jittered PSF library')
         jitteredfilename = os.path.join(
@@ -413,18 +440,31 @@ class PSF(object):
             logger.info(
                 'jittering all the PSFs in the library, using {} at cadence {}s'.format(self.camera.jitter.basename,
                                                                                         self.camera.cadence))
-            for focus in self.unbinned_axes['focus']:
-                for stellartemp in self.unbinned_axes['stellartemp']:
-                    for fieldx in self.unbinned_axes['fieldx_mm']:
-                        for fieldy in self.unbinned_axes['fieldy_mm']:
-                            unjittered = self.psflibrary[focus][stellartemp][fieldx][fieldy]
-                            kernel = self.camera.jitter.jittermap[0] / np.sum(self.camera.jitter.jittermap[0])
-                            jittered = scipy.signal.convolve2d(unjittered, kernel, 'same', 'fill', 0).astype(np.float32)
-                            self.psflibrary[focus][stellartemp][fieldx][fieldy] = jittered
-                            logger.info(
-                                'jittered focus={focus:.1f}, stellartemp={stellartemp:.0f}, fieldx={fieldx:.2f}, fieldy={fieldy:.2f}'.format(
-                                    **locals()))
-
+            keys = [(focus, stellartemp, fieldx, fieldy)
+                    for focus in self.unbinned_axes['focus']
+                    for stellartemp in self.unbinned_axes['stellartemp']
+                    for fieldx in self.unbinned_axes['fieldx_mm']
+                    for fieldy in self.unbinned_axes['fieldy_mm']]
+            focus, stellartemp, fieldx, fieldy = keys[0]
+            self.setupJitterKernel(self.psflibrary[focus][stellartemp][fieldx][fieldy].shape)
+
+            # the workers are forked from this process, so they inherit the library and the kernel FFT for free
+            global _jitterer
+            _jitterer = self
+            pool = multiprocessing.Pool(processes=processes or multiprocessing.cpu_count())
+            try:
+                for (focus, stellartemp, fieldx, fieldy), jittered in pool.imap_unordered(_jitterEntry, keys):
+                    self.psflibrary[focus][stellartemp][fieldx][fieldy] = jittered
+                    logger.info(
+                        'jittered focus={focus:.1f}, stellartemp={stellartemp:.0f}, fieldx={fieldx:.2f}, fieldy={fieldy:.2f}'.format(
+                            **locals()))
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+                _jitterer = None
 
             # make sure to repopulate the summaries
             self.summarizeLibrary()
@@ -535,24 +575,20 @@ class PSF(object):
         # create the high-resolution PSF appropriate for this position
         zeroCenteredSubgridPSF = self.highResolutionPSF(position, stellartemp=stellartemp, focus=focus, chatty=chatty)
 
-        # calculate the x and y subpixel grids, for both the unshifted and shifted pixels
-        unshiftedx, unshiftedy = self.dx_subpixels, self.dy_subpixels
-        shiftedx, shiftedy = unshiftedx + dx, unshiftedy + dy
+        # bin the high-resolution PSF into pixels, after shifting it by (dx, dy)
+        recenteredBinnedPSF = self.pixelizer.pixelize(zeroCenteredSubgridPSF, dx=dx, dy=dy)
 
-        # MAKE SURE THERE'S NOT AN ACCIDENTAL TRANSPOSE IN HERE!
-        prnu = self.intrapixel.prnu
+        if plot:
+            # calculate the x and y subpixel grids, for both the unshifted and shifted pixels
+            unshiftedx, unshiftedy = self.dx_subpixels, self.dy_subpixels
+            shiftedx, shiftedy = unshiftedx + dx, unshiftedy + dy
 
-        zeroCenteredBinnedPSF, xedges, yedges = \
-            np.histogram2d(unshiftedy.flatten(), unshiftedx.flatten(), \
-                           bins=[self.dy_pixels_edges, self.dx_pixels_edges], \
-                           weights=zeroCenteredSubgridPSF.flatten() * prnu(unshiftedy.flatten(), unshiftedx.flatten()))
+            # MAKE SURE THERE'S NOT AN ACCIDENTAL TRANSPOSE IN HERE!
+            prnu = self.intrapixel.prnu
 
-        recenteredBinnedPSF, xedges, yedges = \
-            np.histogram2d(shiftedy.flatten(), shiftedx.flatten(), \
-                           bins=[self.dy_pixels_edges, self.dx_pixels_edges], \
-                           weights=zeroCenteredSubgridPSF.flatten() * prnu(shiftedy.flatten(), shiftedx.flatten()))
+            # (the unshifted pixelization is only needed for comparison in the plot)
+            zeroCenteredBinnedPSF = self.pixelizer.pixelize(zeroCenteredSubgridPSF)
 
-        if plot:
             plt.ioff()
             try:
                 self.pixelizingfigure
@@ -618,142 +654,184 @@ class PSF(object):
         # return the pixelized, binned, PSF
         return recenteredBinnedPSF, centralx + self.dx_pixels, centraly + self.dy_pixels
 
+    def binHighResolutionPSFGrid(self, position, stellartemp=5000, focus=0.0, chatty=False):
+        """Pixelize a high resolution PSF at a given coordinate, at all the [xoffset, yoffset] of the binned library."""
+
+        # make sure the pixel arrays are already set up
+        self.setupPixelArrays()
+        self.ccd.center = np.array(np.round(position.focalxy.tuple))
+
+        # create the high-resolution PSF once, and bin it at every subpixel offset
+        zeroCenteredSubgridPSF = self.highResolutionPSF(position, stellartemp=stellartemp, focus=focus, chatty=chatty)
+        return self.pixelizer.pixelizeGrid(zeroCenteredSubgridPSF,
+                                           self.binned_axes['xoffset'], self.binned_axes['yoffset'])
+
+    @property
+    def binned_filename(self):
+        """the filename of a binned PSF library saved as nested dictionaries (the old format)"""
+        return os.path.join(self.deblibrarydirectory,
+                            'pixelizedlibrary_{jitter}_{intrapixel}_'
+                            '{npositions:02.0f}positions_{noffsets:02.0f}offsets.npy'.format(
+                                jitter=self.camera.jitter.basename, intrapixel=self.intrapixel.name,
+                                npositions=self.npositions, noffsets=self.noffsets))
+
+    @property
+    def binned_densefilename(self):
+        """the filename of the binned PSF library, as one [focus, stellartemp, fieldx, fieldy, xoffset, yoffset, y, x] array"""
+        return self.binned_filename.replace('.npy', '.dense.npy')
+
+    @property
+    def binned_axesfilename(self):
+        """the filename of the axes along which the dense binned PSF library is sampled"""
+        return self.binned_filename.replace('.npy', '.axes.npz')
+
+    def setupBinnedAxes(self):
+        """Define the grid of values over which the binned PSFs will be sampled."""
+        self.binned_axes = {}
+        self.binned_axes['focus'] = self.unbinned_axes['focus']
+        self.binned_axes['stellartemp'] = self.unbinned_axes['stellartemp']
+        self.binned_axes['fieldx_px'] = np.round(
+            np.linspace(-np.max(self.unbinned_axes['fieldx_mm']), np.max(self.unbinned_axes['fieldx_mm']),
+                        self.npositions) / self.pixelstomm).astype(np.int)
+        self.binned_axes['fieldy_px'] = np.round(
+            np.linspace(-np.max(self.unbinned_axes['fieldy_mm']), np.max(self.unbinned_axes['fieldy_mm']),
+                        self.npositions) / self.pixelstomm).astype(np.int)
+        self.binned_axes['xoffset'] = np.linspace(-0.5, 0.5, self.noffsets)  # 11)
+        self.binned_axes['yoffset'] = np.linspace(-0.5, 0.5, self.noffsets)  # 11)
+
+        self.numberofbinnedentries = 1
+        for k, v in self.binned_axes.items():
+            l = len(v)
+            logger.info('including {} entries for {}'.format(l, k))
+            self.numberofbinnedentries *= l
+        self.countthroughbinnedentries = 0
+
+    def loadBinned(self):
+        """Memory-map the dense binned PSF library (and its axes) from disk."""
+        logger.info('trying to load PSFs from {0}'.format(self.binned_densefilename))
+        self.binned = np.load(self.binned_densefilename, mmap_mode='r')
+        axes = np.load(self.binned_axesfilename)
+        self.binned_axes = dict((k, axes[k]) for k in axes.files)
+        logger.info('...success!')
+
+    def emptyBinned(self):
+        """Create an empty dense binned PSF library on disk, to be filled and then passed to finishBinned."""
+        shape = tuple(len(self.binned_axes[k]) for k in binnedaxes) + self.dx_pixels.shape
+
+        # pick up a partially finished library, if there is one with the same shape and axes (see parallelPopulateBinned)
+        partial = self.binned_densefilename + '.partial'
+        if os.path.exists(partial):
+            try:
+                axes = np.load(self.binned_axesfilename)
+                sameaxes = (sorted(axes.files) == sorted(self.binned_axes.keys())) and \
+                           all(np.array_equal(axes[k], self.binned_axes[k]) for k in axes.files)
+            except IOError:
+                sameaxes = False
+            # (a build killed while creating the file can leave it with a truncated header; then start over)
+            try:
+                binned = np.load(partial, mmap_mode='r+')
+            except (IOError, ValueError):
+                logger.info('could not reopen the partially populated library at {0}'.format(partial))
+                binned = None
+            if sameaxes and (binned is not None) and (binned.shape == shape):
+                logger.info('reopening a partially populated library at {0}'.format(partial))
+                return binned
+            del binned
+
+        # a new library has no positions finished yet, whatever checkpoints an old one left behind
+        self.clearBinnedCheckpoints()
+        np.savez(self.binned_axesfilename, **self.binned_axes)
+        return np.lib.format.open_memmap(partial, mode='w+', dtype=np.float32, shape=shape)
+
+    def finishBinned(self, binned):
+        """Move a filled binned PSF library into place, and memory-map it."""
+        binned.flush()
+        del binned
+        os.rename(self.binned_densefilename + '.partial', self.binned_densefilename)
+        logger.info('saved binned PSF library to {0}'.format(self.binned_densefilename))
+        self.loadBinned()
+
+    def convertBinned(self):
+        """Convert a binned PSF library saved as nested dictionaries into the dense format."""
+        logger.info('trying to convert PSFs from {0}'.format(self.binned_filename))
+        nested, self.binned_axes = np.load(self.binned_filename)
+        binned = self.emptyBinned()
+        for index in np.ndindex(*binned.shape[:len(binnedaxes)]):
+            entry = nested
+            for k, i in zip(binnedaxes, index):
+                entry = entry[self.binned_axes[k][i]]
+            binned[index] = entry
+        self.finishBinned(binned)
+
+    @property
+    def binned_checkpointdirectory(self):
+        """the directory where a parallel build of the binned PSF library records which positions are finished"""
+        return self.binned_densefilename + '.checkpoints'
+
+    def binned_checkpointfilename(self, index):
+        """the checkpoint file for one [focus, stellartemp, fieldx, fieldy] position of the binned PSF library"""
+        return os.path.join(self.binned_checkpointdirectory, 'f{0}t{1}x{2}y{3}.done'.format(*index))
+
+    def clearBinnedCheckpoints(self):
+        """Forget which positions of the binned PSF library have been finished."""
+        for f in glob.glob(os.path.join(self.binned_checkpointdirectory, '*.done')):
+            os.remove(f)
+
     # populate a library of binned PRFS, using the jittered high-resolution library
     # @profile
-    def parallelPopulateBinned(self, plot=False, chatty=True):
-        """Populate a library of binned PRFs, using the jittered, wavelength-integrated, high-resolution library."""
-        self.setupPixelArrays()
+    def parallelPopulateBinned(self, plot=False, chatty=True, processes=None, chunksize=1):
+        """Populate a library of binned PRFs, using the jittered, wavelength-integrated, high-resolution library.
 
-        # TODO: Make function
-        binned_filename = \
-            os.path.join(self.deblibrarydirectory,
-                         'pixelizedlibrary'
-                         '_{jitter}'
-                         '_{intrapixel}'
-                         '_{npositions:02.0f}positions'
-                         '_{noffsets:02.0f}offsets.npy'.format(
-                             jitter=self.camera.jitter.basename, intrapixel=self.intrapixel.name,
-                             npositions=self.npositions, noffsets=self.noffsets))
+            A pool of worker processes each bins all the [xoffset, yoffset] of one [focus, stellartemp, fieldx, fieldy]
+            position at a time, writing straight into the memory-mapped library on disk, and leaving behind a
+            checkpoint file when it's done. If a build is interrupted, rerunning this picks up where it left off."""
+
+        global _parallelbuilder
+        self.setupPixelArrays()
 
         try:
-            logger.info('trying to load PSFs from {0}'.format(binned_filename))
-            self.binned, self.binned_axes = np.load(binned_filename)
-            logger.info('...success!')
+            self.loadBinned()
         except IOError:
-            logger.info('creating a new library of binned PSFs')
-            self.populateJitteredPSFLibrary()
-
-            # set up the grid of values over which the
-            self.binned_axes = {}
-            self.binned_axes['focus'] = self.unbinned_axes['focus']
-            self.binned_axes['stellartemp'] = self.unbinned_axes['stellartemp']
-            self.binned_axes['fieldx_px'] = np.round(
-                np.linspace(-np.max(self.unbinned_axes['fieldx_mm']), np.max(self.unbinned_axes['fieldx_mm']),
-                            self.npositions) / self.pixelstomm).astype(np.int)
-            self.binned_axes['fieldy_px'] = np.round(
-                np.linspace(-np.max(self.unbinned_axes['fieldy_mm']), np.max(self.unbinned_axes['fieldy_mm']),
-                            self.npositions) / self.pixelstomm).astype(np.int)
-            self.binned_axes['xoffset'] = np.linspace(-0.5, 0.5, self.noffsets)  # 11)
-            self.binned_axes['yoffset'] = np.linspace(-0.5, 0.5, self.noffsets)  # 11)
-
-            pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
-            self.numberofbinnedentries = 1
-            for k, v in self.binned_axes.items():
-                l = len(v)
-                logger.info('including {} entries for {}'.format(l, k))
-                self.numberofbinnedentries *= l
-            self.countthroughbinnedentries = 0
             try:
-                self.binned
-            except AttributeError:
-                self.binned = {}
-                for focus in self.binned_axes['focus']:
-                    logger.info('adding focus {0:.1f}um'.format(focus), 1)
-                    try:
-                        self.binned[focus]
-                    except KeyError:
-                        self.binned[focus] = {}
-
-                        for stellartemp in self.binned_axes['stellartemp']:
-                            logger.info('adding stellartemp of {0:.0f}K'.format(stellartemp), 2)
+                self.convertBinned()
+            except IOError:
+                logger.info('creating a new library of binned PSFs (in parallel)')
+                self.populateJitteredPSFLibrary()
+                self.setupBinnedAxes()
+
+                # (emptyBinned clears the checkpoints, unless it reopens the partially populated library they refer to)
+                zachopy.utils.mkdir(self.binned_checkpointdirectory)
+                binned = self.emptyBinned()
+
+                # figure out which positions still need to be binned
+                positions = list(np.ndindex(*binned.shape[:4]))
+                todo = [index for index in positions if not os.path.exists(self.binned_checkpointfilename(index))]
+                perposition = binned.shape[4] * binned.shape[5]
+                self.countthroughbinnedentries = (len(positions) - len(todo)) * perposition
+                if len(todo) < len(positions):
+                    logger.info('resuming; {} of {} positions were already binned'.format(len(positions) - len(todo),
+                                                                                        len(positions)))
+
+                # the workers are forked from this process, so they inherit this PSF (and its library) for free
+                _parallelbuilder = self
+                pool = multiprocessing.Pool(processes=processes or multiprocessing.cpu_count())
+                try:
+                    for index in pool.imap_unordered(_binPosition, todo, chunksize):
+                        self.countthroughbinnedentries += perposition
+                        logger.info('{}/{} PSFs binned'.format(self.countthroughbinnedentries,
+                                                               self.numberofbinnedentries))
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+                    _parallelbuilder = None
 
-                            try:
-                                self.binned[focus][stellartemp]
-                            except KeyError:
-                                self.binned[focus][stellartemp] = {}
-
-                                for fieldx in self.binned_axes['fieldx_px']:
-                                    logger.info('adding focal plane x of {0:.0f} pixels'.format(fieldx), 3)
-                                    try:
-                                        self.binned[focus][stellartemp][fieldx]
-                                    except KeyError:
-                                        self.binned[focus][stellartemp][fieldx] = {}
-
-                                        for fieldy in self.binned_axes['fieldy_px']:
-                                            logger.info('adding focal plane y of {0:.0f} pixels'.format(fieldy), 4)
-                                            try:
-                                                self.binned[focus][stellartemp][fieldx][fieldy]
-                                            except KeyError:
-                                                self.binned[focus][stellartemp][fieldx][fieldy] = {}
-
-                                            position = self.cartographer.point(fieldx, fieldy, 'focalxy')
-
-                                            for xoffset in self.binned_axes['xoffset']:
-                                                logger.info('adding xoffset of {0:.2f} pixels'.format(xoffset), 6)
-                                                try:
-                                                    self.binned[focus][stellartemp][fieldx][fieldy][xoffset]
-                                                except KeyError:
-                                                    manager = multiprocessing.Manager()
-                                                    self.binned[focus][stellartemp][fieldx][fieldy][
-                                                        xoffset] = manager.dict()
-
-                                                jobs = [multiprocessing.Process(target=self.addPixelized, args=(
-                                                    self.binned[focus][stellartemp][fieldx][fieldy][xoffset], position,
-                                                    focus, stellartemp, xoffset, yoffset)) for yoffset in
-                                                        self.binned_axes['yoffset']]
-                                                # for yoffset in self.binned_axes['yoffset']:
-                                                #    pool.apply_async(self.addPixelized, (self.binned[focus][stellartemp][fieldx][fieldy][xoffset], position, focus, stellartemp, xoffset, yoffset))
-                                                for j in jobs:
-                                                    j.start()
-                                                for j in jobs:
-                                                    j.join()
-
-                                                self.countthroughbinnedentries += len(self.binned_axes['yoffset'])
-                                                logger.info('')
-                                                logger.info('{}/{} PSFs binned'.format(self.countthroughbinnedentries,
-                                                                                       self.numberofbinnedentries))
-                                                logger.info('')
-
-                np.save(binned_filename, (self.binned, self.binned_axes))
-                logger.info('saved binned PSF library to {0}'.format(binned_filename))
-
-    def addPixelized(self, d, position, focus, stellartemp, xoffset, yoffset, plot=False, chatty=True):
-        logger.info('adding yoffset of {0:.2f} pixels'.format(yoffset), 6)
-        d[yoffset] = \
-            self.binHighResolutionPSF(position, stellartemp=stellartemp, dx=xoffset, dy=yoffset, focus=focus, plot=plot,
-                                      chatty=chatty)[0]
-        if plot:
-            # TODO: Make function
-            binned_filename = \
-                os.path.join(self.deblibrarydirectory,
-                             'pixelizedlibrary'
-                             '_{jitter}'
-                             '_{intrapixel}'
-                             '_{npositions:02.0f}positions'
-                             '_{noffsets:02.0f}offsets.npy'.format(
-                                 jitter=self.camera.jitter.basename, intrapixel=self.intrapixel.name,
-                                 npositions=self.npositions, noffsets=self.noffsets))
-            plotdir = binned_filename.replace('pixelizedlibrary_', 'plotsfor_') + '/'
-            zachopy.utils.mkdir(plotdir)
-            plotfile = plotdir + 'f{focus:.0f}t{stellartemp:.0f}xf{fieldx:.0f}yf{fieldy:.0f}xo{xoffset:.2f}yo{yoffset:.2f}.pdf'.format(
-                **locals())
-            plt.savefig(plotfile)
-            logger.info('saved plot to {}'.format(plotfile))
-        logger.info(
-            '(focus={focus:.2f}um, T={stellartemp:.0f}K, pos={position}, dx={xoffset:.2f} pixels, dy={yoffset:.2f} pixels)'.format(
-                **locals()), 6)
-        return None
-        # self.input('thoughts?')
+                self.finishBinned(binned)
+                for index in positions:
+                    os.remove(self.binned_checkpointfilename(index))
+                os.rmdir(self.binned_checkpointdirectory)
 
     def populateBinned(self, plot=False, chatty=True):
         """Populate a library of binned PRFs, using the jittered, wavelength-integrated, high-resolution library."""
@@ -764,105 +842,60 @@ class PSF(object):
 
         self.setupPixelArrays()
 
-        binned_filename = \
-            os.path.join(self.deblibrarydirectory,
-                         'pixelizedlibrary_{jitter}_{intrapixel}_'
-                         '{npositions:02.0f}positions_{noffsets:02.0f}offsets.npy'.format(
-                             jitter=self.camera.jitter.basename, intrapixel=self.intrapixel.name,
-                             npositions=self.npositions, noffsets=self.noffsets))
         try:
-            logger.info('trying to load PSFs from {0}'.format(binned_filename))
-            self.binned, self.binned_axes = np.load(binned_filename)
-            logger.info('...success!')
+            self.loadBinned()
         except IOError:
-            logger.info('creating a new library of binned PSFs')
-            self.populateJitteredPSFLibrary()
-
-            # set up the grid of values over which the
-            self.binned_axes = {}
-            self.binned_axes['focus'] = self.unbinned_axes['focus']
-            self.binned_axes['stellartemp'] = self.unbinned_axes['stellartemp']
-            self.binned_axes['fieldx_px'] = np.round(
-                np.linspace(-np.max(self.unbinned_axes['fieldx_mm']), np.max(self.unbinned_axes['fieldx_mm']),
-                            self.npositions) / self.pixelstomm).astype(np.int)
-            self.binned_axes['fieldy_px'] = np.round(
-                np.linspace(-np.max(self.unbinned_axes['fieldy_mm']), np.max(self.unbinned_axes['fieldy_mm']),
-                            self.npositions) / self.pixelstomm).astype(np.int)
-            self.binned_axes['xoffset'] = np.linspace(-0.5, 0.5, self.noffsets)  # 11)
-            self.binned_axes['yoffset'] = np.linspace(-0.5, 0.5, self.noffsets)  # 11)
-
-            self.numberofbinnedentries = 1
-            for k, v in self.binned_axes.items():
-                l = len(v)
-                logger.info('including {} entries for {}'.format(l, k))
-                self.numberofbinnedentries *= l
-            self.countthroughbinnedentries = 0
             try:
-                self.binned
-            except AttributeError:
-                self.binned = {}
-                for focus in self.binned_axes['focus']:
-                    logger.info('adding focus {0:.1f}um'.format(focus), 1)
-                    try:
-                        self.binned[focus]
-                    except KeyError:
-                        self.binned[focus] = {}
-
-                        for stellartemp in self.binned_axes['stellartemp']:
-                            logger.info('adding stellartemp of {0:.0f}K'.format(stellartemp), 2)
-
-                            try:
-                                self.binned[focus][stellartemp]
-                            except KeyError:
-                                self.binned[focus][stellartemp] = {}
-
-                                for fieldx in self.binned_axes['fieldx_px']:
-                                    logger.info('adding focal plane x of {0:.0f} pixels'.format(fieldx), 3)
-                                    try:
-                                        self.binned[focus][stellartemp][fieldx]
-                                    except KeyError:
-                                        self.binned[focus][stellartemp][fieldx] = {}
-
-                                        for fieldy in self.binned_axes['fieldy_px']:
-                                            logger.info('adding focal plane y of {0:.0f} pixels'.format(fieldy), 4)
-                                            try:
-                                                self.binned[focus][stellartemp][fieldx][fieldy]
-                                            except KeyError:
-                                                self.binned[focus][stellartemp][fieldx][fieldy] = {}
-
-                                            position = self.cartographer.point(fieldx, fieldy, 'focalxy')
-
-                                            for xoffset in self.binned_axes['xoffset']:
-                                                logger.info('adding xoffset of {0:.2f} pixels'.format(xoffset), 6)
-                                                try:
-                                                    self.binned[focus][stellartemp][fieldx][fieldy][xoffset]
-                                                except KeyError:
-                                                    self.binned[focus][stellartemp][fieldx][fieldy][xoffset] = {}
-
-                                                for yoffset in self.binned_axes['yoffset']:
-                                                    logger.info('adding yoffset of {0:.2f} pixels'.format(yoffset), 6)
-                                                    self.binned[focus][stellartemp][fieldx][fieldy][xoffset][yoffset] = \
-                                                        self.binHighResolutionPSF(position, stellartemp=stellartemp,
-                                                                                  dx=xoffset, dy=yoffset, focus=focus,
-                                                                                  plot=plot, chatty=chatty)[0]
-                                                    if plot:
-                                                        plotdir = binned_filename.replace('pixelizedlibrary_',
-                                                                                          'plotsfor_') + '/'
-                                                        zachopy.utils.mkdir(plotdir)
-                                                        plotfile = plotdir + 'f{focus:.0f}t{stellartemp:.0f}xf{fieldx:.0f}yf{fieldy:.0f}xo{xoffset:.2f}yo{yoffset:.2f}.pdf'.format(
-                                                            **locals())
-                                                        plt.savefig(plotfile)
-                                                        logger.info('saved plot to {}'.format(plotfile))
-                                                    logger.info(
-                                                        '(focus={focus:.2f}um, T={stellartemp:.0f}K, pos={position}, dx={xoffset:.2f} pixels, dy={yoffset:.2f} pixels)'.format(
-                                                            **locals()), 6)
-                                                    self.countthroughbinnedentries += 1
-                                                    logger.info(
-                                                        '{}/{} PSFs binned'.format(self.countthroughbinnedentries,
-                                                                                   self.numberofbinnedentries))
-                                                    # self.input('thoughts?')
-                np.save(binned_filename, (self.binned, self.binned_axes))
-                logger.info('saved binned PSF library to {0}'.format(binned_filename))
+                self.convertBinned()
+            except IOError:
+                logger.info('creating a new library of binned PSFs')
+                self.populateJitteredPSFLibrary()
+                self.setupBinnedAxes()
+                binned = self.emptyBinned()
+
+                for i, focus in enumerate(self.binned_axes['focus']):
+                    logger.info('adding focus {0:.1f}um'.format(focus))
+                    for j, stellartemp in enumerate(self.binned_axes['stellartemp']):
+                        logger.info('adding stellartemp of {0:.0f}K'.format(stellartemp))
+                        for k, fieldx in enumerate(self.binned_axes['fieldx_px']):
+                            logger.info('adding focal plane x of {0:.0f} pixels'.format(fieldx))
+                            for l, fieldy in enumerate(self.binned_axes['fieldy_px']):
+                                logger.info('adding focal plane y of {0:.0f} pixels'.format(fieldy))
+                                position = self.cartographer.point(fieldx, fieldy, 'focalxy')
+
+                                if not plot:
+                                    # bin the same high-resolution PSF at all the subpixel offsets at once
+                                    binned[i, j, k, l] = self.binHighResolutionPSFGrid(
+                                        position, stellartemp=stellartemp, focus=focus, chatty=chatty)
+                                    self.countthroughbinnedentries += binned[i, j, k, l].shape[0] * \
+                                                                      binned[i, j, k, l].shape[1]
+                                    logger.info('{}/{} PSFs binned'.format(self.countthroughbinnedentries,
+                                                                           self.numberofbinnedentries))
+                                    continue
+
+                                for m, xoffset in enumerate(self.binned_axes['xoffset']):
+                                    logger.info('adding xoffset of {0:.2f} pixels'.format(xoffset))
+                                    for n, yoffset in enumerate(self.binned_axes['yoffset']):
+                                        logger.info('adding yoffset of {0:.2f} pixels'.format(yoffset))
+                                        binned[i, j, k, l, m, n] = \
+                                            self.binHighResolutionPSF(position, stellartemp=stellartemp,
+                                                                      dx=xoffset, dy=yoffset, focus=focus,
+                                                                      plot=plot, chatty=chatty)[0]
+                                        if plot:
+                                            plotdir = self.binned_filename.replace('pixelizedlibrary_',
+                                                                                   'plotsfor_') + '/'
+                                            zachopy.utils.mkdir(plotdir)
+                                            plotfile = plotdir + 'f{focus:.0f}t{stellartemp:.0f}xf{fieldx:.0f}yf{fieldy:.0f}xo{xoffset:.2f}yo{yoffset:.2f}.pdf'.format(
+                                                **locals())
+                                            plt.savefig(plotfile)
+                                            logger.info('saved plot to {}'.format(plotfile))
+                                        logger.info(
+                                            '(focus={focus:.2f}um, T={stellartemp:.0f}K, pos={position}, dx={xoffset:.2f} pixels, dy={yoffset:.2f} pixels)'.format(
+                                                **locals()))
+                                        self.countthroughbinnedentries += 1
+                                        logger.info('{}/{} PSFs binned'.format(self.countthroughbinnedentries,
+                                                                               self.numberofbinnedentries))
+                self.finishBinned(binned)
 
     def comparePSFs(self, position, stellartemp=4000, verbose=False, plot=True, justnew=False, center=None):
         """Compare the PSF pulled out of the library to a newly pixelized one."""
@@ -934,68 +967,95 @@ class PSF(object):
     def pixelizedPSF(self, position, focus=0.0, stellartemp=4000, verbose=False):
         """Drop a pixelized PSF, drawn from the library, at a particular position."""
 
+        interpolated, xindex, yindex = self.pixelizedPSFs(position, focus=focus, stellartemp=stellartemp)
+        return interpolated[0], xindex[0], yindex[0]
+
+    def focusWeights(self, focus):
+        """The [(index, weight), ...] of the focus nodes of the binned library that blend into a given focus."""
+        ongrid = self.binned_axes['focus'] == focus
+        if ongrid.any():
+            return [(np.nonzero(ongrid)[0][0], 1.0)]
+        focusbelow, focusabove, focusbelow_weight, focusabove_weight = \
+            findTwoNearestIndices(self.binned_axes['focus'], np.array([focus]))
+        return [(focusbelow[0], focusbelow_weight[0]), (focusabove[0], focusabove_weight[0])]
+
+    def focusSlab(self, focus):
+        """The binned PSF library [stellartemp, fieldx, fieldy, xoffset, yoffset, y, x], interpolated to one focus.
+
+            The slab is kept until it's asked for at a different focus, so all the stars in
+            an exposure (which share one focus) are drawn from the same precomputed slab."""
+
         # make sure the binned PSF library is already loaded
         try:
             self.binned
         except AttributeError:
             self.populateBinned()
 
+        try:
+            if self.focusslab_focus == focus:
+                return self.focusslab
+        except AttributeError:
+            pass
+
+        weights = self.focusWeights(focus)
+        if len(weights) == 1:
+            # on a grid node, the slab is just a view into the library
+            slab = self.binned[weights[0][0]]
+        else:
+            (focusbelow, focusbelow_weight), (focusabove, focusabove_weight) = weights
+            logger.info('interpolating the binned PSF library to a focus of {0}um'.format(focus))
+            slab = self.binned[focusbelow] * np.float32(focusbelow_weight) + \
+                   self.binned[focusabove] * np.float32(focusabove_weight)
+
+        # (replacing the previous slab, so only one is ever held in memory)
+        self.focusslab, self.focusslab_focus = slab, focus
+        return slab
+
+    def pixelizedPSFs(self, position, focus=0.0, stellartemp=4000):
+        """Drop many pixelized PSFs at once, drawn from the library, at an array of positions.
+            (Returns stacks of [star, y, x] arrays.)"""
+
+        # make sure the binned PSF library is already loaded
+        try:
+            self.binned
+        except AttributeError:
+            self.populateBinned()
 
-        # need to determine [radius][stellartemp][theta][xoffset][yoffset] to pull out of library
+        # need to determine [focus][stellartemp][fieldx][fieldy][xoffset][yoffset] to pull out of library
         fieldx, fieldy = position.focalxy.tuple
-        key_stellartemp = zachopy.utils.find_nearest(self.binned_axes['stellartemp'], stellartemp, verbose=verbose)
-        key_fieldx = zachopy.utils.find_nearest(self.binned_axes['fieldx_px'], fieldx, verbose=verbose)
-        key_fieldy = zachopy.utils.find_nearest(self.binned_axes['fieldx_px'], fieldy, verbose=verbose)
+        fieldx, fieldy = np.atleast_1d(fieldx), np.atleast_1d(fieldy)
+        stellartemp = np.atleast_1d(stellartemp) * np.ones(fieldx.shape)
+        key_stellartemp = findNearestIndices(self.binned_axes['stellartemp'], stellartemp)
+        key_fieldx = findNearestIndices(self.binned_axes['fieldx_px'], fieldx)
+        key_fieldy = findNearestIndices(self.binned_axes['fieldy_px'], fieldy)
 
-        ccdx, ccdy = position.ccdxy.tuple
         xoffset, yoffset = position.ccdxy.fractionalpixels
         centralx, centraly = position.ccdxy.integerpixels
+        xoffset, yoffset = np.atleast_1d(xoffset), np.atleast_1d(yoffset)
+        centralx, centraly = np.atleast_1d(centralx), np.atleast_1d(centraly)
 
-        # interpolate
-        xoffsetbounds = zachopy.utils.find_two_nearest(self.binned_axes['xoffset'], xoffset, verbose=verbose)
-        xbelow, xabove = xoffsetbounds
-        xbelow_weight, xabove_weight = zachopy.utils.interpolation_weights(xoffsetbounds, xoffset)
-        yoffsetbounds = zachopy.utils.find_two_nearest(self.binned_axes['yoffset'], yoffset, verbose=verbose)
-        ybelow, yabove = yoffsetbounds
-        ybelow_weight, yabove_weight = zachopy.utils.interpolation_weights(yoffsetbounds, yoffset)
+        # interpolation indices and weights for the subpixel offsets
+        xbelow, xabove, xbelow_weight, xabove_weight = findTwoNearestIndices(self.binned_axes['xoffset'], xoffset)
+        ybelow, yabove, ybelow_weight, yabove_weight = findTwoNearestIndices(self.binned_axes['yoffset'], yoffset)
 
-        try:
-            atfocus = self.binned[focus]
-            needtofocusinterpolate = False
-        except KeyError:
-            # logger.info('could not find focus entry exactly at {}'.format(focus))
-            needtofocusinterpolate = True
-
-        if needtofocusinterpolate:
-            # logger.info('interpolating in focus')
-            focusbounds = zachopy.utils.find_two_nearest(self.binned_axes['focus'], focus, verbose=verbose)
-            focusbelow, focusabove = focusbounds
-            focusbelow_weight, focusabove_weight = zachopy.utils.interpolation_weights(focusbounds, focus)
-            prfbelow = self.binned[focusbelow][key_stellartemp][key_fieldx][key_fieldy]
-            prfabove = self.binned[focusabove][key_stellartemp][key_fieldx][key_fieldy]
-
-            ibelow = xbelow_weight * ybelow_weight * prfbelow[xbelow][ybelow] + \
-                     xabove_weight * ybelow_weight * prfbelow[xabove][ybelow] + \
-                     xabove_weight * yabove_weight * prfbelow[xabove][yabove] + \
-                     xbelow_weight * yabove_weight * prfbelow[xbelow][yabove]
-
-            iabove = xbelow_weight * ybelow_weight * prfabove[xbelow][ybelow] + \
-                     xabove_weight * ybelow_weight * prfabove[xabove][ybelow] + \
-                     xabove_weight * yabove_weight * prfabove[xabove][yabove] + \
-                     xbelow_weight * yabove_weight * prfabove[xbelow][yabove]
-
-            interpolated = ibelow * focusbelow_weight + iabove * focusabove_weight
-        else:
-            # logger.info('evaluating at focus gridpoint')
-            prf = atfocus[key_stellartemp][key_fieldx][key_fieldy]
-            interpolated = xbelow_weight * ybelow_weight * prf[xbelow][ybelow] + \
-                           xabove_weight * ybelow_weight * prf[xabove][ybelow] + \
-                           xabove_weight * yabove_weight * prf[xabove][yabove] + \
-                           xbelow_weight * yabove_weight * prf[xbelow][yabove]
+        # (weights are per star, so broadcast them over each stamp)
+        def stamp(weights):
+            return weights[:, np.newaxis, np.newaxis]
+
+        # (the library has already been interpolated to this focus)
+        slab = self.focusSlab(focus)
+
+        def prf(xkey, ykey):
+            return slab[key_stellartemp, key_fieldx, key_fieldy, xkey, ykey]
 
-        assert (interpolated is not None)
+        interpolated = stamp(xbelow_weight * ybelow_weight) * prf(xbelow, ybelow) + \
+                       stamp(xabove_weight * ybelow_weight) * prf(xabove, ybelow) + \
+                       stamp(xabove_weight * yabove_weight) * prf(xabove, yabove) + \
+                       stamp(xbelow_weight * yabove_weight) * prf(xbelow, yabove)
 
-        return interpolated, centralx + self.dx_pixels, centraly + self.dy_pixels
+        return interpolated, \
+               stamp(centralx) + self.dx_pixels[np.newaxis, :, :], \
+               stamp(centraly) + self.dy_pixels[np.newaxis, :, :]
 
     def magnifiedPSF(self, position, focus=0.0, stellartemp=4000, verbose=False, binby=2):
         """create a magnified PSF to plop into an image, for Kalo's reference PSFs
@@ -1056,5 +1116,68 @@ class PSF(object):
             logger.info("   saved PSF plot to {0}".format(output))
 
 
+# the PSF being jittered by populateJitteredPSFLibrary (inherited by the forked worker processes)
+_jitterer = None
+
+
+def _jitterEntry(key):
+    """Convolve one [focus, stellartemp, fieldx, fieldy] entry of the PSF library with the jitter kernel, in a worker process."""
+    focus, stellartemp, fieldx, fieldy = key
+    return key, _jitterer.jitterConvolve(_jitterer.psflibrary[focus][stellartemp][fieldx][fieldy])
+
+
+# the PSF being binned by parallelPopulateBinned (inherited by the forked worker processes)
+_parallelbuilder = None
+
+
+def _binPosition(index):
+    """Bin all the offsets of one [focus, stellartemp, fieldx, fieldy] position, in a worker process."""
+    psf = _parallelbuilder
+    i, j, k, l = index
+    position = psf.cartographer.point(psf.binned_axes['fieldx_px'][k], psf.binned_axes['fieldy_px'][l], 'focalxy')
+    grid = psf.binHighResolutionPSFGrid(position, stellartemp=psf.binned_axes['stellartemp'][j],
+                                        focus=psf.binned_axes['focus'][i])
+
+    # write into the library on disk, and only then leave a checkpoint saying this position is done
+    binned = np.load(psf.binned_densefilename + '.partial', mmap_mode='r+')
+    binned[index] = grid
+    binned.flush()
+    del binned
+    open(psf.binned_checkpointfilename(index), 'w').close()
+    return index
+
+
 def extent(x, y):
     return [x.min(), x.max(), y.min(), y.max()]
+
+
+def findNearestIndices(axis, values):
+    """Vectorized zachopy.utils.find_nearest, returning indices into the axis."""
+    axis = np.asarray(axis)
+    return np.abs(axis[np.newaxis, :] - np.asarray(values)[:, np.newaxis]).argmin(1)
+
+
+def findTwoNearestIndices(axis, values):
+    """Vectorized zachopy.utils.find_two_nearest + interpolation_weights,
+        returning (below, above) indices into the axis and their weights."""
+    axis = np.asarray(axis)
+    values = np.asarray(values, dtype=np.float)
+
+    # handle 1-element axes
+    if len(axis) == 1:
+        zeros = np.zeros(len(values), dtype=np.int)
+        return zeros, zeros, np.ones(len(values)), np.zeros(len(values))
+
+    # the left edge of the bracketing interval (an exact hit on a gridpoint lands on the right edge)
+    below = np.clip(np.searchsorted(axis, values, side='left') - 1, 0, len(axis) - 2)
+    above = below + 1
+    span = (axis[above] - axis[below]).astype(np.float)
+    belowweight = (axis[above] - values) / span
+    aboveweight = (values - axis[below]) / span
+
+    # values outside the axis are pinned to the nearest end
+    for outside, end in [(values < axis[0], 0), (values > axis[-1], len(axis) - 1)]:
+        below[outside], above[outside] = end, end
+        belowweight[outside], aboveweight[outside] = 1.0, 0.0
+
+    return below, above, belowweight, aboveweight
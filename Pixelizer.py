@@ -0,0 +1,122 @@
+"""Bin high-resolution PSFs (sampled on a regular subpixel grid) into pixels."""
+
+import numpy as np
+import logging
+from settings import log_file_handler
+
+logger = logging.getLogger(__name__)
+logger.addHandler(log_file_handler)
+
+
+class Pixelizer(object):
+    """Bin images sampled on a regular subpixel grid into pixels, after shifting them by (dx, dy) pixels.
+
+        Shifting the subpixel grid moves every subpixel by an integer number of subpixels, plus
+        a fractional remainder that is shared between neighboring subpixels (linear interpolation).
+        Both steps are linear and act separately along x and y, so binning an image is two small
+        matrix products, binned = Sy * (image * prnu) * Sx.T, where Sx and Sy say how much of each
+        subpixel lands in each pixel. Those matrices, and the intrapixel sensitivity at each shift,
+        are cached, so pixelizing the same grid of offsets over and over is cheap."""
+
+    def __init__(self, x_subpixels_axis, x_pixels_edges, y_subpixels_axis, y_pixels_edges, intrapixel):
+        # the (regularly spaced) centers of the subpixels, and the edges of the pixels, in pixels
+        self.x_subpixels_axis, self.x_pixels_edges = x_subpixels_axis, x_pixels_edges
+        self.y_subpixels_axis, self.y_pixels_edges = y_subpixels_axis, y_pixels_edges
+
+        # the size of one subpixel (in pixels), and how many of them make up one pixel
+        self.subpixelsize = np.mean(np.diff(x_subpixels_axis))
+        self.nsubpixelsperpixel = int(np.round(1.0 / self.subpixelsize))
+
+        # the intrapixel sensitivity object, whose prnu(x, y) we'll multiply in
+        self.intrapixel = intrapixel
+
+        # caches for the binning matrices and the prnu maps, keyed by shift
+        self.matrices = {}
+        self.prnutiles = {}
+
+    def binningMatrix(self, axis, shift):
+        """Matrix [npixels, nsubpixels] of how much of each subpixel falls into each pixel, after a shift along an axis ('x' or 'y')."""
+
+        key = (axis, shift)
+        try:
+            return self.matrices[key]
+        except KeyError:
+            pass
+
+        subpixels_axis = getattr(self, '{0}_subpixels_axis'.format(axis))
+        pixels_edges = getattr(self, '{0}_pixels_edges'.format(axis))
+        npixels, nsubpixels = len(pixels_edges) - 1, len(subpixels_axis)
+
+        # split the shift into a whole number of subpixels and a fractional remainder
+        whole = np.floor(shift / self.subpixelsize)
+        remainder = shift / self.subpixelsize - whole
+
+        # (1 - remainder) of each subpixel moves by the whole number of subpixels, the rest moves one subpixel further
+        matrix = np.zeros((npixels, nsubpixels))
+        columns = np.arange(nsubpixels)
+        for nsubpixelsmoved, weight in [(whole, 1.0 - remainder), (whole + 1, remainder)]:
+            center = subpixels_axis + nsubpixelsmoved * self.subpixelsize
+            pixel = np.searchsorted(pixels_edges, center, side='right') - 1
+            ok = (pixel >= 0) & (pixel < npixels)
+            np.add.at(matrix, (pixel[ok], columns[ok]), weight)
+
+        self.matrices[key] = matrix
+        return matrix
+
+    def prnuTile(self, dx, dy):
+        """The intrapixel sensitivity over one pixel's worth of subpixels, shifted by (dx, dy) pixels (None if uniform)."""
+
+        key = (dx, dy)
+        try:
+            return self.prnutiles[key]
+        except KeyError:
+            n = self.nsubpixelsperpixel
+            x, y = np.meshgrid(self.x_subpixels_axis[:n] + dx, self.y_subpixels_axis[:n] + dy)
+            # (keeping the same argument order as the original histogram-based pixelization)
+            tile = self.intrapixel.prnu(y, x)
+            if np.all(tile == 1.0):
+                tile = None
+            self.prnutiles[key] = tile
+            return tile
+
+    def prnu(self, dx, dy):
+        """The intrapixel sensitivity over the whole subpixel grid, shifted by (dx, dy) pixels (None if uniform)."""
+
+        # the sensitivity repeats every pixel, so only one pixel's worth of it is calculated (and cached)
+        tile = self.prnuTile(dx, dy)
+        if tile is None:
+            return None
+        reps = (len(self.y_subpixels_axis) // tile.shape[0], len(self.x_subpixels_axis) // tile.shape[1])
+        return np.tile(tile, reps)
+
+    def pixelize(self, image, dx=0.0, dy=0.0):
+        """Bin a subpixel image [y, x] into pixels, after shifting it by (dx, dy) pixels."""
+
+        sx = self.binningMatrix('x', dx)
+        sy = self.binningMatrix('y', dy)
+
+        prnu = self.prnu(dx, dy)
+        if prnu is not None:
+            image = image * prnu
+
+        return np.dot(sy, np.dot(image, sx.T))
+
+    def pixelizeGrid(self, image, dxs, dys):
+        """Bin a subpixel image [y, x] at every combination of shifts, returning a [len(dxs), len(dys), y, x] array."""
+
+        dxs, dys = np.asarray(dxs), np.asarray(dys)
+        sx = [self.binningMatrix('x', dx) for dx in dxs]
+        sy = [self.binningMatrix('y', dy) for dy in dys]
+        ny, nx = sy[0].shape[0], sx[0].shape[0]
+
+        uniform = all(self.prnuTile(dx, dy) is None for dx in dxs for dy in dys)
+        if uniform:
+            # with uniform pixels, every shift can be binned at once, with two (bigger) matrix products
+            stacked = np.dot(np.vstack(sy), np.dot(image, np.vstack(sx).T))
+            return stacked.reshape(len(dys), ny, len(dxs), nx).transpose(2, 0, 1, 3)
+
+        binned = np.zeros((len(dxs), len(dys), ny, nx))
+        for i, dx in enumerate(dxs):
+            for j, dy in enumerate(dys):
+                binned[i, j] = self.pixelize(image, dx, dy)
+        return binned
@@ -0,0 +1,79 @@
+"""Project whole catalogs onto the focal plane, with a cached tangent-plane model of where the camera points."""
+
+import numpy as np
+import logging
+from settings import log_file_handler
+
+logger = logging.getLogger(__name__)
+logger.addHandler(log_file_handler)
+
+
+class Pointing(object):
+    """The gnomonic (TAN) projection that the camera's WCS describes, for projecting catalogs quickly.
+
+        Each catalog's stars are projected onto the tangent plane about the field center once, along
+        with how far their proper motions carry them across it in a year. After that, projecting the
+        catalog at any epoch is a couple of multiply-adds per star (instead of a trip through the WCS).
+        A roll of the spacecraft (in arcsec) is applied as a small rotation in the tangent plane."""
+
+    def __init__(self, ra, dec, pixelscale):
+        # the tangent point (the field center, in degrees) and the pixel scale (in arcsec)
+        self.ra, self.dec = ra, dec
+        self.pixelscale = pixelscale
+
+        # the projected catalogs, keyed by id(catalog)
+        self.cache = {}
+
+    def tangentPlane(self, ra, dec):
+        """Project (ra, dec) onto the tangent plane, returning focal-plane (x, y) in pixels from the field center.
+
+            (the same as the camera's WCS, which has +x pointing to the west and +y to the north)"""
+
+        ra, dec = np.radians(ra), np.radians(dec)
+        ra0, dec0 = np.radians(self.ra), np.radians(self.dec)
+        cosdec, sindec = np.cos(dec), np.sin(dec)
+        cosdra = np.cos(ra - ra0)
+
+        # the standard coordinates (xi to the east, eta to the north), in radians
+        denominator = sindec * np.sin(dec0) + cosdec * np.cos(dec0) * cosdra
+        xi = cosdec * np.sin(ra - ra0) / denominator
+        eta = (sindec * np.cos(dec0) - cosdec * np.sin(dec0) * cosdra) / denominator
+
+        # (stars on the far side of the sky don't land on the tangent plane at all)
+        behind = denominator <= 0
+        xi, eta = np.where(behind, np.nan, xi), np.where(behind, np.nan, eta)
+
+        # convert to pixels
+        scale = np.degrees(1.0) * 60.0 * 60.0 / self.pixelscale
+        return -xi * scale, eta * scale
+
+    def project(self, catalog, epoch, roll=0.0, subset=None):
+        """Focal-plane (x, y) pixel positions of a catalog's stars at an epoch (in years), with an optional roll (in arcsec).
+
+            subset is an (optional) array of indices, to project only those stars."""
+
+        try:
+            cached = self.cache[id(catalog)]
+            assert (cached['catalog'] is catalog)
+            assert (len(cached['x']) == len(catalog.ra))
+        except (KeyError, AssertionError):
+            # project the stars at the catalog's epoch, and a year later (proper motions barely curve in a year)
+            logger.info('projecting {0} stars onto the tangent plane at ({1:.6f}, {2:.6f})'.format(
+                len(catalog.ra), self.ra, self.dec))
+            x, y = self.tangentPlane(*catalog.atEpoch(catalog.epoch))
+            xlater, ylater = self.tangentPlane(*catalog.atEpoch(catalog.epoch + 1.0))
+            cached = dict(catalog=catalog, x=x, y=y, dxdt=xlater - x, dydt=ylater - y)
+            self.cache[id(catalog)] = cached
+
+        # move the stars along with their proper motions
+        if subset is None:
+            subset = slice(None)
+        dt = epoch - catalog.epoch
+        x = cached['x'][subset] + dt * cached['dxdt'][subset]
+        y = cached['y'][subset] + dt * cached['dydt'][subset]
+
+        # roll the field around its center (the same way a PC matrix would, in the WCS)
+        if roll != 0.0:
+            angle = np.radians(roll / 60.0 / 60.0)
+            x, y = np.cos(angle) * x + np.sin(angle) * y, -np.sin(angle) * x + np.cos(angle) * y
+        return x, y
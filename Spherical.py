@@ -0,0 +1,80 @@
+"""Convert between celestial, ecliptic, and galactic coordinates, with (cached) rotation matrices."""
+
+import numpy as np
+import astropy.coordinates
+import astropy.units
+import logging
+from settings import log_file_handler
+
+logger = logging.getLogger(__name__)
+logger.addHandler(log_file_handler)
+
+# the obliquity of the ecliptic at J2000 (the same as crossfield.euler, which this replaces)
+obliquity = 23.4392911111
+
+# the rotation matrices between each pair of frames, once they've been made
+matrices = {}
+
+
+def unitVectors(lon, lat):
+    """Unit vectors (stacked along the first axis) pointing at longitudes and latitudes (in degrees)."""
+    lon, lat = np.radians(lon), np.radians(lat)
+    coslat = np.cos(lat)
+    return np.array([coslat * np.cos(lon), coslat * np.sin(lon), np.sin(lat)])
+
+
+def fromCelestial(frame):
+    """The matrix that rotates (ICRS) celestial unit vectors into another frame."""
+
+    if frame == 'celestial':
+        return np.eye(3)
+    elif frame == 'ecliptic':
+        # the ecliptic is tilted about the vernal equinox (the x axis)
+        e = np.radians(obliquity)
+        return np.array([[1.0, 0.0, 0.0],
+                         [0.0, np.cos(e), np.sin(e)],
+                         [0.0, -np.sin(e), np.cos(e)]])
+    elif frame == 'galactic':
+        # ask astropy where the celestial axes point in galactic coordinates (once), so the two always agree
+        axes = astropy.coordinates.SkyCoord(ra=[0.0, 90.0, 0.0] * astropy.units.deg,
+                                            dec=[0.0, 0.0, 90.0] * astropy.units.deg, frame='icrs').galactic
+        return unitVectors(axes.l.degree, axes.b.degree)
+    else:
+        raise ValueError("{0} isn't a frame Spherical knows about".format(frame))
+
+
+def rotationMatrix(frm='celestial', to='ecliptic'):
+    """The (cached) matrix that rotates unit vectors from one frame to another."""
+    try:
+        return matrices[frm, to]
+    except KeyError:
+        matrices[frm, to] = fromCelestial(to).dot(fromCelestial(frm).T)
+        logger.debug('made the rotation matrix from {0} to {1} coordinates'.format(frm, to))
+        return matrices[frm, to]
+
+
+def convert(lon, lat, frm='celestial', to='ecliptic', out=None):
+    """Convert longitudes and latitudes (in degrees) from one frame to another.
+
+        frm and to can be 'celestial' (ra, dec), 'ecliptic' (elon, elat), or 'galactic' (glon, glat).
+        out is an (optional) pair of float64 arrays to put the new (lon, lat) into; they can be the
+        input arrays themselves, to convert in place. Longitudes come out between 0 and 360."""
+
+    lon, lat = np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+    matrix = rotationMatrix(frm, to)
+
+    # rotate the unit vectors (all at once)
+    vectors = unitVectors(lon, lat)
+    x, y, z = np.dot(matrix, vectors.reshape(3, -1)).reshape(vectors.shape)
+
+    if out is None:
+        out = np.empty_like(lon), np.empty_like(lat)
+    newlon, newlat = out
+    np.degrees(np.arctan2(y, x), out=newlon)
+    np.mod(newlon, 360.0, out=newlon)
+    np.degrees(np.arctan2(z, np.hypot(x, y)), out=newlat)
+
+    # (give scalars back for scalars)
+    if newlon.ndim == 0:
+        return newlon[()], newlat[()]
+    return newlon, newlat
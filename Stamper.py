@@ -61,17 +61,11 @@ class Stamper(object):
         logger.info('randomly populating {} with {} postage stamps'.format(self.ccd.name, nstamps))
 
         # select (randomly) some target stars, seeded by the CCD number
-        np.random.seed(self.ccd.number)
+        prng = np.random.RandomState(self.ccd.number)
 
-        ras, decs, tmag, temperatures = self.camera.catalog.snapshot(self.camera.bjd,
-                                                                     exptime=self.camera.cadence / 60.0 / 60.0 / 24.0)
-
-        # assign the cartrographer's CCD to this one
-        self.camera.cartographer.ccd = self.ccd
-
-        # create coordinate object for the stars
-        stars = self.camera.cartographer.point(ras, decs, 'celestial')
-        x, y = stars.ccdxy.tuple
+        # project the stars near the CCD (the rest can't be on it)
+        candidates = self.ccd.candidates
+        x, y = self.project(self.camera.catalog, candidates)
 
         # start with targets with centers on the chip
         onccd = (np.round(x) > 0) & \
@@ -80,15 +74,13 @@ class Stamper(object):
                 (np.round(y) < self.ccd.ysize)
 
         # weight stars inversely to their abundance, to give roughly uniform distribution of magnitudes
-        weights = \
-            (1.0 / dndmag(self.camera.catalog.tmag) * (self.camera.catalog.tmag >= 6) * (
-            self.camera.catalog.tmag <= 16))[
-                onccd]
+        tmag = self.camera.catalog.tmag[candidates]
+        weights = (1.0 / dndmag(tmag) * (tmag >= 6) * (tmag <= 16))[onccd]
         weights /= np.sum(weights)
-        itargets = np.random.choice(onccd.nonzero()[0],
-                                    size=np.minimum(nstamps, np.sum(weights != 0)),
-                                    replace=False,
-                                    p=weights)
+        itargets = prng.choice(candidates[onccd],
+                               size=np.minimum(nstamps, np.sum(weights != 0)),
+                               replace=False,
+                               p=weights)
 
         # populate position arrays
         self.ra = self.camera.catalog.ra[itargets]
@@ -118,25 +110,36 @@ class Stamper(object):
 
         self.finishFromStars()
 
-    def trimCatalog(self, catalog):
-        '''trim a catalog to contain only stars that fall on the CCD and in a stamp'''
-
-        # assuming stars don't move in and out of postage stamps over time
-        ras, decs, tmag, temperatures = self.camera.catalog.snapshot(self.camera.bjd,
-                                                                     exptime=self.camera.cadence / 60.0 / 60.0 / 24.0)
+    def project(self, catalog, subset=None):
+        '''project (a subset of) a catalog's stars onto the CCD, at the current time'''
 
         # assign the cartrographer's CCD to this one
         self.camera.cartographer.ccd = self.ccd
 
-        # create coordinate object for the stars
-        stars = self.camera.cartographer.point(ras, decs, 'celestial')
-        x, y = stars.ccdxy.integerpixels
+        # project the stars from the camera's cached tangent plane
+        focalx, focaly = self.camera.pointing.project(catalog, self.ccd.epoch, roll=self.camera.nudge['z'],
+                                                      subset=subset)
+        return self.camera.cartographer.point(focalx, focaly, 'focalxy').ccdxy.tuple
+
+    def trimCatalog(self, catalog, candidates=None):
+        '''trim a catalog to contain only stars that are near the CCD (the candidates, if given) and not outside a stamp'''
+
+        if candidates is None:
+            candidates = np.arange(len(catalog.ra))
+
+        # assuming stars don't move in and out of postage stamps over time
+        ok = self.keep(*self.project(catalog, candidates))
+
+        return Catalogs.Trimmed(catalog, candidates[ok])
+
+    def keep(self, x, y):
+        '''which stars at (x, y) on the CCD survive trimming (everything except stars on the CCD, but outside a stamp)'''
+        x, y = np.round(x).astype(np.int), np.round(y).astype(np.int)
 
         onccd = (x >= 0) * (x < self.ccd.xsize) * (y >= 0) * (y < self.ccd.ysize)
         ok = np.ones_like(onccd)
         ok[onccd] *= self.ccd.stampimage[y[onccd], x[onccd]].astype(np.bool)
-
-        return Catalogs.Trimmed(self.camera.catalog, ok)
+        return ok
 
     def populateStampImage(self):
 
@@ -0,0 +1,132 @@
+"""Expose all the CCDs of a Camera at once, each in its own (forked) worker process."""
+
+import multiprocessing
+import traceback
+import numpy as np
+import matplotlib.font_manager
+import logging
+from settings import log_file_handler
+
+logger = logging.getLogger(__name__)
+logger.addHandler(log_file_handler)
+
+# how many processes are sharing this machine's cores (worker processes multiply it by how many run alongside them)
+sharers = 1
+
+
+def threadsPerProcess():
+    """How many threads this process should use, when not told otherwise (its share of the cores)."""
+    return max(multiprocessing.cpu_count() // sharers, 1)
+
+
+def sharedImages(n, shape, dtype):
+    """A stack of n image-sized arrays, in memory that processes forked afterward share with this one.
+
+        (the memory is only really allocated once it's written to, so unused arrays cost nothing)"""
+    dtype = np.dtype(dtype)
+    raw = multiprocessing.RawArray('b', n * int(np.prod(shape)) * dtype.itemsize)
+    return np.frombuffer(raw, dtype=dtype).reshape((n,) + tuple(shape))
+
+
+def work(ccd, connection, shared, nworkers):
+    """Wait for exposures to make with one CCD, and send back the results (runs inside a worker process).
+
+        The images an exposure returns are written into [shared], memory shared with the parent
+        process, so only which of them exist (and the header) have to be sent down the pipe.
+        The cores are split between the nworkers workers exposing at once."""
+    global sharers
+    sharers *= nworkers
+
+    # don't share the parent's open font files (matplotlib's cache of them breaks when used by several processes)
+    try:
+        matplotlib.font_manager._get_font.cache_clear()
+    except AttributeError:
+        pass
+
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        counter, kwargs = task
+        try:
+            # pick up the time from the parent, and leave advancing the counter to it
+            #  (each exposure draws its noise from its own random stream, set by the camera's seed and the counter)
+            ccd.camera.counter = counter
+            result = ccd.expose(advancecounter=False, **kwargs)
+            if result is not None:
+                for image, buffer in zip(result, shared):
+                    if image is not None:
+                        buffer[:] = image
+                result = [image is not None for image in result]
+            connection.send((result, ccd.header))
+        except Exception:
+            connection.send(RuntimeError('exposing {0} failed:\n{1}'.format(ccd.name, traceback.format_exc())))
+    connection.close()
+
+
+class CCDWorkers(object):
+    """A set of worker processes, one per CCD, that expose a Camera's CCDs at the same time.
+
+        The workers are forked from the process that holds the Camera, after the (memory-mapped)
+        PSF library and the star catalog have been loaded, so they share those instead of each
+        making their own copies. Each worker keeps its own CCD's state (background, caches)."""
+
+    def __init__(self, camera):
+        self.camera = camera
+
+        # the workers only know about the cadence they were started with
+        self.cadence = camera.cadence
+
+        # load the things all CCDs need before forking, so the workers inherit them
+        logger.info('loading the PSF library and catalog, to be shared by all the CCD workers')
+        camera.psf.populateBinned()
+        try:
+            camera.catalog
+        except AttributeError:
+            camera.populateCatalog()
+
+        self.connections, self.processes, self.shared = [], [], []
+        for c in camera.ccds:
+            # the (image, cosmics, stars) each exposure returns come back through shared memory
+            shared = sharedImages(3, c.zeros().shape, camera.imagedtype)
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=work, args=(c, child, shared, len(camera.ccds)), name=c.name)
+            process.daemon = True
+            process.start()
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+            self.shared.append(shared)
+        logger.info('started {0} CCD workers'.format(len(self.processes)))
+
+    def expose(self, advancecounter=True, **kwargs):
+        """Expose all the CCDs at the current counter, returning their results in the order of camera.ccds."""
+
+        for connection in self.connections:
+            connection.send((self.camera.counter, kwargs))
+
+        results = []
+        for c, connection, shared in zip(self.camera.ccds, self.connections, self.shared):
+            answer = connection.recv()
+            if isinstance(answer, Exception):
+                raise answer
+            result, c.header = answer
+            if result is not None:
+                # (copy the images out, since the worker will reuse the shared memory for its next exposure)
+                result = tuple(buffer.copy() if exists else None for buffer, exists in zip(shared, result))
+                c.image = result[0]
+            results.append(result)
+
+        # advance the camera's counter once all the CCDs are done (what the last CCD would do when exposing in turn)
+        if advancecounter:
+            self.camera.advanceCounter()
+        return results
+
+    def stop(self):
+        """Tell all the workers to finish up."""
+        for connection in self.connections:
+            connection.send(None)
+            connection.close()
+        for process in self.processes:
+            process.join()
+        logger.info('stopped {0} CCD workers'.format(len(self.processes)))
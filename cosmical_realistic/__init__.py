@@ -1,4 +1,4 @@
 # Re-export cosmical from _cosmical
 
 # noinspection PyUnresolvedReferences
-from _cosmical import cosmical
+from _cosmical import cosmical, Generator
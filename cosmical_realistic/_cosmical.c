@@ -1,9 +1,27 @@
 #define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
 #include <Python.h>
+#include <structmember.h>
 #include <numpy/arrayobject.h>
 #include "cosmical.h"
+#include "seed_tw_ran.h"
 static char module_docstring[] = "This module allows Python to access Al Levine's fast and accurate cosmic ray generator written in C.";
 static char cosmical_docstring[] = "Calculate a simulated cosmic ray image for a given exposure time.";
+static char generator_docstring[] =
+    "Generator(seed=None, threads=1, tilerows=256)\n\n"
+    "A cosmic ray generator that keeps its own random numbers from image to image.\n"
+    "(seed=None seeds it from the clock, like cosmical does on every call.)\n\n"
+    "The CCD is split into tiles of tilerows rows, each with its own random numbers\n"
+    "(seeded from the generator's), which are filled by up to threads threads at once.\n"
+    "The cosmic rays depend on the seed and tilerows, but not on the number of threads.";
+static char seed_docstring[] = "seed(seed) restarts the generator's random numbers from an integer seed.";
+static char hits_docstring[] =
+    "hits(NX, NY, crfl, exptm1, exptm2) sends cosmic rays through an NX x NY pixel CCD, returning\n"
+    "the pixels they hit and the electrons they left, as arrays (i, j, electrons). A pixel\n"
+    "appears once for every cosmic ray that hit it. Uses the same random numbers as fill.";
+static char fill_docstring[] =
+    "fill(image, crfl, exptm1, exptm2) adds cosmic rays into image (a C-contiguous 2D float32 array),\n"
+    "in place, for a flux of crfl (per cm^2 per s) and exposure times from exptm1 to exptm2 (s).\n"
+    "Returns the number of cosmic rays.";
 
 static PyObject *cosmical_cosmical(PyObject *self, PyObject *args);
 
@@ -12,12 +30,209 @@ static PyMethodDef module_methods[] = {
     {NULL, NULL, 0, NULL}
 };
 
+/******************************************************************************/
+// the Generator type, which holds one Mersenne twister
+
+typedef struct {
+    PyObject_HEAD
+    twister rng;
+    int threads;
+    long tilerows;
+} Generator;
+
+static PyMemberDef Generator_members[] = {
+    {"threads", T_INT, offsetof(Generator, threads), 0, "how many threads fill the tiles at once"},
+    {"tilerows", T_LONG, offsetof(Generator, tilerows), 0, "how many rows are in each tile"},
+    {NULL, 0, 0, 0, NULL}
+};
+
+static int Generator_seed_from(Generator *self, PyObject *seed)
+{
+    unsigned long value;
+
+    if (seed == NULL || seed == Py_None) {
+        seedTwister(&self->rng, get_tw_seed());
+        return 0;
+    }
+    value = PyLong_AsUnsignedLongMask(seed);
+    if (PyErr_Occurred())
+        return -1;
+    seedTwister(&self->rng, (uint32) (value & 0xFFFFFFFFUL));
+    return 0;
+}
+
+static int Generator_init(Generator *self, PyObject *args, PyObject *kwds)
+{
+    PyObject *seed = NULL;
+    static char *kwlist[] = {"seed", "threads", "tilerows", NULL};
+
+    self->threads = 1;
+    self->tilerows = 256;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|Oil", kwlist, &seed, &self->threads, &self->tilerows))
+        return -1;
+
+    /* Read the straggling table now, once and for all. */
+    cosmical_load_table();
+    return Generator_seed_from(self, seed);
+}
+
+static PyObject *Generator_seed(Generator *self, PyObject *args)
+{
+    PyObject *seed = NULL;
+
+    if (!PyArg_ParseTuple(args, "O", &seed))
+        return NULL;
+    if (Generator_seed_from(self, seed) < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+static PyObject *Generator_fill(Generator *self, PyObject *args)
+{
+    PyArrayObject *image;
+    double crfl, exptm1, exptm2;
+    cosmical_sink sink;
+    long ncr;
+
+    if (!PyArg_ParseTuple(args, "O!ddd", &PyArray_Type, &image, &crfl, &exptm1, &exptm2))
+        return NULL;
+
+    if (PyArray_NDIM(image) != 2 || PyArray_TYPE(image) != NPY_FLOAT32 ||
+        !PyArray_IS_C_CONTIGUOUS(image) || !PyArray_ISWRITEABLE(image)) {
+        PyErr_SetString(PyExc_ValueError, "image must be a writeable, C-contiguous, 2D float32 array");
+        return NULL;
+    }
+
+    memset(&sink, 0, sizeof(sink));
+    sink.fimage = (float *) PyArray_DATA(image);
+    sink.NY = PyArray_DIM(image, 1);
+
+    /* The generator only touches its own state and the image, so let other threads run. */
+    Py_BEGIN_ALLOW_THREADS
+    ncr = cosmical_generate_tiled(&self->rng, crfl, exptm1, exptm2, PyArray_DIM(image, 0), PyArray_DIM(image, 1),
+                                  self->tilerows, self->threads, &sink);
+    Py_END_ALLOW_THREADS
+
+    if (sink.failed)
+        return PyErr_NoMemory();
+    return PyInt_FromLong(ncr);
+}
+
+static PyObject *Generator_hits(Generator *self, PyObject *args)
+{
+    long NX, NY, n;
+    double crfl, exptm1, exptm2;
+    cosmical_sink sink;
+    npy_intp size[1];
+    PyObject *i, *j, *e;
+
+    if (!PyArg_ParseTuple(args, "llddd", &NX, &NY, &crfl, &exptm1, &exptm2))
+        return NULL;
+
+    /* Collect the hits into a list, rather than an image. */
+    memset(&sink, 0, sizeof(sink));
+    sink.NY = NY;
+    Py_BEGIN_ALLOW_THREADS
+    cosmical_generate_tiled(&self->rng, crfl, exptm1, exptm2, NX, NY, self->tilerows, self->threads, &sink);
+    Py_END_ALLOW_THREADS
+
+    if (sink.failed) {
+        free(sink.hiti);
+        free(sink.hitj);
+        free(sink.hite);
+        return PyErr_NoMemory();
+    }
+
+    /* Copy the hits into numpy arrays. */
+    size[0] = sink.nhits;
+    i = PyArray_SimpleNew(1, size, NPY_LONG);
+    j = PyArray_SimpleNew(1, size, NPY_LONG);
+    e = PyArray_SimpleNew(1, size, NPY_DOUBLE);
+    if (i != NULL && j != NULL && e != NULL) {
+        for (n = 0; n < sink.nhits; ++n) {
+            ((long *) PyArray_DATA((PyArrayObject *) i))[n] = sink.hiti[n];
+            ((long *) PyArray_DATA((PyArrayObject *) j))[n] = sink.hitj[n];
+            ((double *) PyArray_DATA((PyArrayObject *) e))[n] = sink.hite[n];
+        }
+    }
+    free(sink.hiti);
+    free(sink.hitj);
+    free(sink.hite);
+    if (i == NULL || j == NULL || e == NULL) {
+        Py_XDECREF(i);
+        Py_XDECREF(j);
+        Py_XDECREF(e);
+        return NULL;
+    }
+
+    return Py_BuildValue("(NNN)", i, j, e);
+}
+
+static PyMethodDef Generator_methods[] = {
+    {"seed", (PyCFunction) Generator_seed, METH_VARARGS, seed_docstring},
+    {"fill", (PyCFunction) Generator_fill, METH_VARARGS, fill_docstring},
+    {"hits", (PyCFunction) Generator_hits, METH_VARARGS, hits_docstring},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyTypeObject GeneratorType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_cosmical.Generator",       /* tp_name */
+    sizeof(Generator),           /* tp_basicsize */
+    0,                           /* tp_itemsize */
+    0,                           /* tp_dealloc */
+    0,                           /* tp_print */
+    0,                           /* tp_getattr */
+    0,                           /* tp_setattr */
+    0,                           /* tp_compare */
+    0,                           /* tp_repr */
+    0,                           /* tp_as_number */
+    0,                           /* tp_as_sequence */
+    0,                           /* tp_as_mapping */
+    0,                           /* tp_hash */
+    0,                           /* tp_call */
+    0,                           /* tp_str */
+    0,                           /* tp_getattro */
+    0,                           /* tp_setattro */
+    0,                           /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,          /* tp_flags */
+    generator_docstring,         /* tp_doc */
+    0,                           /* tp_traverse */
+    0,                           /* tp_clear */
+    0,                           /* tp_richcompare */
+    0,                           /* tp_weaklistoffset */
+    0,                           /* tp_iter */
+    0,                           /* tp_iternext */
+    Generator_methods,           /* tp_methods */
+    Generator_members,           /* tp_members */
+    0,                           /* tp_getset */
+    0,                           /* tp_base */
+    0,                           /* tp_dict */
+    0,                           /* tp_descr_get */
+    0,                           /* tp_descr_set */
+    0,                           /* tp_dictoffset */
+    (initproc) Generator_init,   /* tp_init */
+    0,                           /* tp_alloc */
+    0,                           /* tp_new */
+};
+
+/******************************************************************************/
+
 PyMODINIT_FUNC init_cosmical(void)
 {
-    PyObject *m = Py_InitModule3("_cosmical", module_methods, module_docstring);
+    PyObject *m;
+
+    GeneratorType.tp_new = PyType_GenericNew;
+    if (PyType_Ready(&GeneratorType) < 0)
+        return;
+
+    m = Py_InitModule3("_cosmical", module_methods, module_docstring);
     if (m == NULL)
        return;
 
+    Py_INCREF(&GeneratorType);
+    PyModule_AddObject(m, "Generator", (PyObject *) &GeneratorType);
+
     /* Load 'numpy' functionality. */
     import_array();
 }
@@ -36,6 +36,13 @@
  *
  * Dec. 17, 2014 - Add code to optionally convolve image with a 3x3 kernel
  *                 that grossly represents the effect of charge diffusion.
+ *
+ * ZKBT says: the straggling table is now parsed only once, and the random
+ *    numbers come from a 'twister' passed in, so Python can keep (and seed)
+ *    its own generators. Electrons are handed to a 'cosmical_sink', which
+ *    adds them to a double or a float image. The old cosmical() still works.
+ *    cosmical_generate_tiled splits the CCD into tiles, each with its own
+ *    twister, and fills them in several threads at once.
  */
 
 #include <stdio.h>
@@ -44,10 +51,12 @@
 #include <stdlib.h>
 #include <time.h>
 #include <string.h>
+#include <pthread.h>
 #include "twister.h"
 #include "seed_tw_ran.h"
 #include "fmemopen.h"
 #include "st_dat.h"
+#include "cosmical.h"
 
 #define DR (M_PI/180.0)
 #define NELEC_MICRON 80.0
@@ -63,21 +72,23 @@
 #define M_PROTON_MEV 938.0
 
 double lamb[NLMAX], phi[NLMAX], phicum[NLMAX];
-int nlamb;
+int nlamb = -1;   // (-1 until the table has been read)
 double eprot, pgamma, bfac, beta;
-double xlen, xi, xlam, delta, capi, lnepp;
+double capi, lnepp;
 
-double origin[3], dx[3], ccddim[3];   // CCD geometric parameters
+double dx[3];   // pixel size (microns)
 // The 'difker' array contains the values for rssq = 5.0 microns.
 double difker[3][3] = {
   {0.0034, 0.0516, 0.0034},
   {0.0516, 0.7798, 0.0516},
   {0.0034, 0.0516, 0.0034}
 };
-int npix[3];   // Set to NX, NY, 1 in initialization
-int ncr;
-double ncrmn, rfac;
-double *image, *imaged, *temp;
+
+// the geometry of the CCD being hit
+typedef struct {
+  double origin[3], ccddim[3];
+  int npix[3];   // Set to NX, NY, 1 in initialization
+} cosmical_ccd;
 
 /******************************************************************************/
 /* exposure time - should include frame store time (which is approximately the
@@ -105,7 +116,7 @@ void usage(char *prog)
 
 /******************************************************************************/
 // ZKBT says this function was copied and pasted from gasdev2t.c
-double gasdev()
+double gasdev(twister *rng)
 {
   static int iset=0;
   static double gset;
@@ -113,8 +124,8 @@ double gasdev()
 
   if  (iset == 0) {
     do {
-      v1=2.0*ranMT()-1.0;
-      v2=2.0*ranMT()-1.0;
+      v1=2.0*ranTwister(rng)-1.0;
+      v2=2.0*ranTwister(rng)-1.0;
       r=v1*v1+v2*v2;
     } while (r >= 1.0);
     fac=sqrt(-2.0*log(r)/r);
@@ -149,37 +160,32 @@ double gammln(double xx)
 /******************************************************************************/
 // From poidev2t.c
 
-double poidev(double xm)
+double poidev(twister *rng, double xm)
 {
-  static double sq, alxm, g, oldm=(-1.0);
+  // (no values cached between calls, so generators can run at the same time)
+  double sq, alxm, g;
   double em, t, y;
 
   if (xm < 12.0) {
-    if (xm != oldm) {
-      oldm=xm;
-      g=exp(-xm);
-    }
+    g=exp(-xm);
     em = -1;
     t=1.0;
     do {
       em += 1.0;
-      t *= ranMT();
+      t *= ranTwister(rng);
     } while (t > g);
   } else {
-    if (xm != oldm) {
-      oldm=xm;
-      sq=sqrt(2.0*xm);
-      alxm=log(xm);
-      g=xm*alxm-gammln(xm+1.0);
-    }
+    sq=sqrt(2.0*xm);
+    alxm=log(xm);
+    g=xm*alxm-gammln(xm+1.0);
     do {
       do {
-        y=tan(M_PI*ranMT());
+        y=tan(M_PI*ranTwister(rng));
         em=sq*y+xm;
       } while (em < 0.0);
       em=floor(em);
       t=0.9*(1.0+y*y)*exp(em*alxm-gammln(em+1.0)-g);
-    } while (ranMT() > t);
+    } while (ranTwister(rng) > t);
   }
   return em;
 }
@@ -202,12 +208,12 @@ void read_phi_lambda(FILE *fp)
 
 /******************************************************************************/
 
-double get_lambda_random()
+double get_lambda_random(twister *rng)
 {
   double x, xlam, cumdif, lamdif;
   int i;
 
-  x = ranMT();
+  x = ranTwister(rng);
   xlam = 0.0;
   for(i=0;i<(nlamb-1);++i) {
     if ( (x >= phicum[i]) && (x <= phicum[i+1]) ) {
@@ -400,10 +406,13 @@ double path_len(double pts[2][3])
 // or column of pixels.
 // Determine which pixels in the row or column contain charge and how much.
 
-void do_cosmic_ray(double v0[3], double a[3], long NX, long NY)
+void do_cosmic_ray(twister *rng, cosmical_ccd *ccd, cosmical_sink *sink, double v0[3], double a[3], long NX, long NY)
 {
   double corn[2][3], ptsccd[2][3], ptscol[2][3], ptspix[2][3];
   double xr[2], yr[2], xrc[2], yrc[2], plen, nelec;
+  double xlen, xi, xlam, delta;
+  double *origin = ccd->origin;
+  int *npix = ccd->npix;
   int i, j, iax, npts, ixa, ixb, iya, iyb, jya, jyb;
 
   for(iax=0;iax<3;++iax) {
@@ -479,20 +488,20 @@ void do_cosmic_ray(double v0[3], double a[3], long NX, long NY)
       // to no. of electron-hole pairs (nelec).
       xlen = plen;
       xi = get_xi(xlen,beta);
-      xlam = get_lambda_random();
+      xlam = get_lambda_random(rng);
       delta = get_energy_loss(beta,xi,xlam,lnepp);
       nelec = get_num_elect(delta);
       /* fprintf(stdout,"xlen,xi,xlam,delta,nelec = %f %f %f %f %f\n\n",
          xlen,xi,xlam,delta,nelec); */
 
-      *(image + i*NY + j) += nelec;
+      cosmical_deposit(sink, i, j, nelec);
     }
   }
 }
 
 /******************************************************************************/
 
-void print_image(long NX, long NY, FILE *fp)
+void print_image(double *image, long NX, long NY, FILE *fp)
 {
   int i, j, ne;
 
@@ -512,7 +521,7 @@ void print_image(long NX, long NY, FILE *fp)
  *             due to residence time in the frame store region
  */
 
-void get_ran_cr(double origin[3], double v0[3], double a[3], double ratefac)
+void get_ran_cr(twister *rng, cosmical_ccd *ccd, double v0[3], double a[3], double ratefac)
 {
   double cth, sth, ph, x, y, c1, c2, xc;
   int i;
@@ -522,7 +531,7 @@ void get_ran_cr(double origin[3], double v0[3], double a[3], double ratefac)
   c2 = 2.0*(1.0 - c1);
 
   for(i=0;i<3;++i) {
-    x = ranMT();
+    x = ranTwister(rng);
     if (i != 1)
       y = x;
     else {
@@ -535,11 +544,11 @@ void get_ran_cr(double origin[3], double v0[3], double a[3], double ratefac)
     y = x;
       }
     }
-    v0[i] = origin[i] + (y*ccddim[i]);
+    v0[i] = ccd->origin[i] + (y*ccd->ccddim[i]);
   }
 
-  ph = 2.0*M_PI*ranMT();
-  cth = -1.0 + 2.0*ranMT();
+  ph = 2.0*M_PI*ranTwister(rng);
+  cth = -1.0 + 2.0*ranTwister(rng);
   if (fabs(cth) <= 1.0)
     sth = sqrt(1.0 - cth*cth);
   else {
@@ -555,16 +564,12 @@ void get_ran_cr(double origin[3], double v0[3], double a[3], double ratefac)
 /******************************************************************************/
 // Convolve the 2-d image array w/ the 3x3 kernel difker.
 
-void do_diffusion(long NX, long NY)
+void do_diffusion(double *image, double *imaged, long NX, long NY)
 {
   int i, j, il, im, jl, jm, ip, jp;
   double ximg;
 
-  // Swap 'image' and 'imaged' so the final results are in 'image'.
-
-  temp = image;
-  image = imaged;
-  imaged = temp;
+  // 'imaged' holds the undiffused image, and the final results go in 'image' (which starts at zero).
 
   for(j=0;j<NY;++j) {
     jl = j - 1;
@@ -606,14 +611,70 @@ void print_cr(FILE *fp, double v0[3], double a[3])
 
 
 /******************************************************************************/
-// Tasks that we don't want to do unnecessarily when doing multiple images
+// Make room for n hits in a list (returning 0 if there's no memory for it).
+
+static int cosmical_grow(long **hiti, long **hitj, double **hite, long n)
+{
+  long *i, *j;
+  double *e;
+
+  i = realloc(*hiti, n*sizeof(long));
+  if (i == NULL)
+    return 0;
+  *hiti = i;
+  j = realloc(*hitj, n*sizeof(long));
+  if (j == NULL)
+    return 0;
+  *hitj = j;
+  e = realloc(*hite, n*sizeof(double));
+  if (e == NULL)
+    return 0;
+  *hite = e;
+  return 1;
+}
+
+/******************************************************************************/
+// Add electrons to pixel (i, j) of whatever image the sink holds (or to its list of hits).
+
+void cosmical_deposit(cosmical_sink *sink, long i, long j, double nelec)
+{
+  long more;
+
+  if (sink->fimage != NULL)
+    sink->fimage[i*sink->NY + j] += nelec;
+  else if (sink->dimage != NULL)
+    sink->dimage[i*sink->NY + j] += nelec;
+  else {
+    // ZKBT says: add the hit to the list (doubling the room for hits, if it's full)
+    if (sink->nhits == sink->maxhits) {
+      more = (sink->maxhits > 0) ? 2*sink->maxhits : 4096;
+      if (!cosmical_grow(&sink->hiti, &sink->hitj, &sink->hite, more)) {
+        sink->failed = 1;
+        return;
+      }
+      sink->maxhits = more;
+    }
+    sink->hiti[sink->nhits] = i;
+    sink->hitj[sink->nhits] = j;
+    sink->hite[sink->nhits] = nelec;
+    ++sink->nhits;
+  }
+}
+
+/******************************************************************************/
+// Tasks that only need to be done once: read the straggling table, and set up
+// the physical constants (ZKBT says: this used to happen with every image).
 
-void cosmical_setup(double crfl, double exptm1, double exptm2, long NX, long NY, int idodif)
+void cosmical_load_table(void)
 {
-  double exptm, tot;
   int ip, jp;
-  unsigned long seed;
-  FILE *fpin = fmemopen(phi_lambda_data, strlen(phi_lambda_data), "r");
+  double tot;
+  FILE *fpin;
+
+  if (nlamb >= 0)
+    return;
+
+  fpin = fmemopen(phi_lambda_data, strlen(phi_lambda_data), "r");
   read_phi_lambda(fpin);
   fclose(fpin);
 
@@ -631,103 +692,248 @@ void cosmical_setup(double crfl, double exptm1, double exptm2, long NX, long NY,
   dx[1] = 15.0;
   dx[2] = 100.0;
 
+  // normalize the diffusion kernel
+  tot = 0.0;
+  for(jp=0;jp<3;++jp) {
+    for(ip=0;ip<3;++ip) {
+      tot += difker[ip][jp];
+    }
+  }
+  for(jp=0;jp<3;++jp) {
+    for(ip=0;ip<3;++ip) {
+      difker[ip][jp] /= tot;
+    }
+  }
+}
+
+/******************************************************************************/
+// Set up the geometry of an NX x NY pixel CCD.
+
+void cosmical_setup_ccd(cosmical_ccd *ccd, long NX, long NY)
+{
+  ccd->origin[0] = 0.0;
+  ccd->origin[1] = 0.0;
+  ccd->origin[2] = 0.0;
+
+  ccd->ccddim[0] = NX*dx[0];
+  ccd->ccddim[1] = NY*dx[1];
+  ccd->ccddim[2] = dx[2];
+
+  ccd->npix[0] = NX;
+  ccd->npix[1] = NY;
+  ccd->npix[2] = 1;
+}
+
+/******************************************************************************/
+// Send a random (Poisson) number of cosmic rays through an NX x NY pixel CCD,
+// drawing random numbers from 'rng' and handing the electrons to 'sink'.
+// Returns the number of cosmic rays.
+
+long cosmical_generate(twister *rng, double crfl, double exptm1, double exptm2, long NX, long NY,
+                       cosmical_sink *sink)
+{
+  cosmical_ccd ccd;
+  double v0[3], a[3], rfac, exptm, ncrmn;
+  long icr, ncr;
+
+  cosmical_load_table();
+  cosmical_setup_ccd(&ccd, NX, NY);
+
   rfac = exptm2/exptm1;
   exptm = 0.5*(exptm1 + exptm2);
   ncrmn = exptm*crfl*(NX*dx[0]/10000.0)*(NY*dx[1]/10000.0);
   // fprintf(stderr,"setup: ncrmn = %f\n",ncrmn);
 
-  image = malloc(NX*NY*sizeof(double));
-  if (idodif == 1)
-     imaged = malloc(NX*NY*sizeof(double));
+  // ncr = ncrmn + gasdev()*sqrt(ncrmn);
+  ncr = poidev(rng, ncrmn);
+  // ncr = 3;  // testing only
+  // fprintf(stderr,"ncrmn, ncr = %f, %d\n\n",ncrmn,ncr);
 
-  origin[0] = 0.0;
-  origin[1] = 0.0;
-  origin[2] = 0.0;
+  for (icr=0;icr<ncr;++icr) {
+    get_ran_cr(rng,&ccd,v0,a,rfac);
+    //fprintf(stderr," cosmic ray #%d\n",icr+1);
+    //print_cr(stderr,v0,a);
+    do_cosmic_ray(rng,&ccd,sink,v0,a,NX,NY);
+  }
 
-  ccddim[0] = NX*dx[0];
-  ccddim[1] = NY*dx[1];
-  ccddim[2] = dx[2];
+  return ncr;
+}
 
-  npix[0] = NX;
-  npix[1] = NY;
-  npix[2] = 1;
+/******************************************************************************/
+// One tile of the CCD (rows i0 to i1-1), with its own random numbers and its own list of hits.
 
-  if(idodif == 1) {
-    tot = 0.0;
-    for(jp=0;jp<3;++jp) {
-      for(ip=0;ip<3;++ip) {
-    tot += difker[ip][jp];
-      }
-    }
-    for(jp=0;jp<3;++jp) {
-      for(ip=0;ip<3;++ip) {
-    difker[ip][jp] /= tot;
-    fprintf(stderr,"difker[%d][%d] = %f\n",ip,jp,difker[ip][jp]);
-      }
-    }
-  }
+typedef struct {
+  twister rng;
+  long i0, i1, ncr;
+  cosmical_sink hits;
+} cosmical_tile;
+
+typedef struct {
+  cosmical_tile *tiles;
+  long ntiles, first, step, NX, NY;
+  double ncrmn, rfac;
+} cosmical_work;
+
+// Send the cosmic rays that start within a tile through the (whole) CCD.
+
+static void cosmical_do_tile(cosmical_tile *tile, long NX, long NY, double ncrmn, double rfac)
+{
+  cosmical_ccd ccd, start;
+  double v0[3], a[3];
+  long icr;
+
+  cosmical_setup_ccd(&ccd, NX, NY);
+
+  // the cosmic rays start anywhere in the tile's rows (and the tile gets its share of them)
+  start = ccd;
+  start.origin[0] = ccd.origin[0] + tile->i0*dx[0];
+  start.ccddim[0] = (tile->i1 - tile->i0)*dx[0];
 
-  // Invent a CR for testing
-  /*
-  v0[0] = 107.0;
-  v0[1] = 99.9;
-  v0[2] = 20.2;
-  th = 65.3*DR;
-  ph = 31.4*DR;
-  a[0] = sin(th)*cos(ph);
-  a[1] = sin(th)*sin(ph);
-  a[2] = cos(th);
-  */
-
-  seed = get_tw_seed();
-  //fprintf(stderr," using CosmicAl to generate simulated cosmic rays for a %ldx%ld pixel image, assuming:\n", NX,NY);
-  //fprintf(stderr,"     exposure times spanning %f to %f s\n", exptm1, exptm2);
-  //fprintf(stderr,"     a mean of %f events \n", ncrmn);
-  //fprintf(stderr,"     Fano factor of %f\n", SQRT_FANO_SI*SQRT_FANO_SI);
-  //fprintf(stderr,"     and a seed of %lu \n",seed);
-  seedMT(seed);
+  tile->ncr = poidev(&tile->rng, ncrmn*(tile->i1 - tile->i0)/NX);
+  for (icr=0;icr<tile->ncr;++icr) {
+    get_ran_cr(&tile->rng,&start,v0,a,rfac);
+    do_cosmic_ray(&tile->rng,&ccd,&tile->hits,v0,a,NX,NY);
+  }
 }
 
+// Do every [step]th tile, starting from [first] (what each thread does).
 
-/******************************************************************************/
-// ZKBT says: cosmic generation moved from main() to a separate function,
-//    which can be called directly from Python and returns a 1D image array
+static void *cosmical_do_tiles(void *arg)
+{
+  cosmical_work *work = (cosmical_work *) arg;
+  long t;
 
-double * cosmical(double crfl, double exptm1, double exptm2, long NX, long NY, int idodif)
+  for (t=work->first;t<work->ntiles;t+=work->step)
+    cosmical_do_tile(&work->tiles[t], work->NX, work->NY, work->ncrmn, work->rfac);
+  return NULL;
+}
+
+/******************************************************************************/
+// Like cosmical_generate, but with the CCD split into tiles of 'tilerows' rows,
+// which are filled by up to 'nthreads' threads at once. Each tile's twister is
+// seeded (in order) from 'rng', and the tiles' hits are handed to 'sink' in
+// order, so the result depends on the tile size but not on the number of threads.
+// Returns the number of cosmic rays.
+
+long cosmical_generate_tiled(twister *rng, double crfl, double exptm1, double exptm2, long NX, long NY,
+                             long tilerows, int nthreads, cosmical_sink *sink)
 {
-  cosmical_setup(crfl, exptm1, exptm2, NX, NY, idodif);
+  cosmical_tile *tiles;
+  cosmical_work *work;
+  pthread_t *threads;
+  int *started;
+  double rfac, exptm, ncrmn;
+  long ntiles, t, n, ncr;
+  int k;
+
+  // (read the table before any threads start)
+  cosmical_load_table();
+
+  if (tilerows < 1)
+    tilerows = NX;
+  ntiles = (NX + tilerows - 1)/tilerows;
+  if (nthreads < 1)
+    nthreads = 1;
+  if (nthreads > ntiles)
+    nthreads = ntiles;
 
-  double v0[3], a[3], rfac;
-  int i, j, icr;
   rfac = exptm2/exptm1;
+  exptm = 0.5*(exptm1 + exptm2);
+  ncrmn = exptm*crfl*(NX*dx[0]/10000.0)*(NY*dx[1]/10000.0);
 
-  for(i=0;i<NX;++i) {
-    for(j=0;j<NY;++j) {
-      image[i*NY + j] = 0.0;
-      if (idodif == 1)
-        imaged[i*NY + j] = 0.0;
-      }
-    }
+  tiles = calloc(ntiles, sizeof(cosmical_tile));
+  work = calloc(nthreads, sizeof(cosmical_work));
+  threads = calloc(nthreads, sizeof(pthread_t));
+  started = calloc(nthreads, sizeof(int));
+  if (tiles == NULL || work == NULL || threads == NULL || started == NULL) {
+    free(tiles);
+    free(work);
+    free(threads);
+    free(started);
+    sink->failed = 1;
+    return 0;
+  }
+
+  for (t=0;t<ntiles;++t) {
+    seedTwister(&tiles[t].rng, randomTwister(rng));
+    tiles[t].i0 = t*tilerows;
+    tiles[t].i1 = (t + 1)*tilerows < NX ? (t + 1)*tilerows : NX;
+    tiles[t].hits.NY = NY;
+  }
+
+  // start the extra threads (doing the first share here, and any share a thread couldn't be started for)
+  for (k=0;k<nthreads;++k) {
+    work[k].tiles = tiles;
+    work[k].ntiles = ntiles;
+    work[k].first = k;
+    work[k].step = nthreads;
+    work[k].NX = NX;
+    work[k].NY = NY;
+    work[k].ncrmn = ncrmn;
+    work[k].rfac = rfac;
+    if (k > 0)
+      started[k] = (pthread_create(&threads[k], NULL, cosmical_do_tiles, &work[k]) == 0);
+  }
+  for (k=0;k<nthreads;++k)
+    if (!started[k])
+      cosmical_do_tiles(&work[k]);
+  for (k=1;k<nthreads;++k)
+    if (started[k])
+      pthread_join(threads[k], NULL);
+
+  // hand the hits to the sink, tile by tile
+  ncr = 0;
+  for (t=0;t<ntiles;++t) {
+    ncr += tiles[t].ncr;
+    if (tiles[t].hits.failed)
+      sink->failed = 1;
+    for (n=0;n<tiles[t].hits.nhits;++n)
+      cosmical_deposit(sink, tiles[t].hits.hiti[n], tiles[t].hits.hitj[n], tiles[t].hits.hite[n]);
+    free(tiles[t].hits.hiti);
+    free(tiles[t].hits.hitj);
+    free(tiles[t].hits.hite);
+  }
+
+  free(tiles);
+  free(work);
+  free(threads);
+  free(started);
+  return ncr;
+}
 
-    // ncr = ncrmn + gasdev()*sqrt(ncrmn);
-    ncr = poidev(ncrmn);
-    // ncr = 3;  // testing only
-    // fprintf(stderr,"ncrmn, ncr = %f, %d\n\n",ncrmn,ncr);
-
-    for (icr=0;icr<ncr;++icr) {
-      get_ran_cr(origin,v0,a,rfac);
-      //fprintf(stderr," cosmic ray #%d\n",icr+1);
-      //print_cr(stderr,v0,a);
-      do_cosmic_ray(v0,a,NX,NY);
-      //print_image(NX,NY,stderr);
-    }
 
-    if (idodif == 1)
-      do_diffusion(NX,NY);
+/******************************************************************************/
+// ZKBT says: cosmic generation moved from main() to a separate function,
+//    which can be called directly from Python and returns a 1D image array
+//    (reseeded from the clock on every call; see cosmical_generate for more control)
+
+double * cosmical(double crfl, double exptm1, double exptm2, long NX, long NY, int idodif)
+{
+  static twister rng;
+  cosmical_sink sink;
+  double *image, *imaged;
+
+  seedTwister(&rng, get_tw_seed());
+
+  image = calloc(NX*NY, sizeof(double));
+  memset(&sink, 0, sizeof(sink));
+  sink.dimage = image;
+  sink.NY = NY;
+
+  if (idodif == 1) {
+    // make the image, then diffuse it into a fresh one
+    imaged = image;
+    image = calloc(NX*NY, sizeof(double));
+    sink.dimage = imaged;
+    cosmical_generate(&rng, crfl, exptm1, exptm2, NX, NY, &sink);
+    do_diffusion(image, imaged, NX, NY);
     free(imaged);
-    free(temp);
-    return image;
   }
+  else
+    cosmical_generate(&rng, crfl, exptm1, exptm2, NX, NY, &sink);
+
+  return image;
+}
 
 
 /******************************************************************************/
@@ -754,8 +960,6 @@ int main(int argc, char *argv[])
   nimg = atoi(argv[4]);
   idodif = atoi(argv[5]);  // = 0 or 1 => no or yes, to diffusion modelling
 
-  cosmical_setup(crfl,exptm1,exptm2,NX,NY, idodif);
-
   // loop here to end to do multiple images (nimg) with one setup
   for(iimg=0;iimg<nimg;++iimg) {
     cosmical(crfl,exptm1,exptm2,NX,NY,idodif);
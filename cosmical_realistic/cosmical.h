@@ -1 +1,27 @@
+#ifndef COSMICAL_H
+#define COSMICAL_H
+
+#include "twister.h"
+
+// where the electrons from cosmic rays go: added to a double image, or (if fimage is set) a float one,
+// with pixel (i, j) at [i*NY + j]; if neither is set, each hit is appended to a list of
+// (hiti, hitj, hite), which grows as needed (check 'failed', and free the lists when done)
+typedef struct {
+  double *dimage;
+  float *fimage;
+  long NY;
+  long nhits, maxhits;
+  long *hiti, *hitj;
+  double *hite;
+  int failed;
+} cosmical_sink;
+
+void cosmical_load_table(void);
+void cosmical_deposit(cosmical_sink *sink, long i, long j, double nelec);
+long cosmical_generate(twister *rng, double crfl, double exptm1, double exptm2, long NX, long NY,
+                       cosmical_sink *sink);
+long cosmical_generate_tiled(twister *rng, double crfl, double exptm1, double exptm2, long NX, long NY,
+                             long tilerows, int nthreads, cosmical_sink *sink);
 double *cosmical(double crfl, double exptm1, double exptm2, long NX, long NY, int idodif);
+
+#endif
@@ -47,14 +47,9 @@
 
 #include <stdio.h>
 #include <stdlib.h>
+#include "twister.h"
 
-//
-// uint32 must be an unsigned integer type capable of holding at least 32
-// bits; exactly 32 should be fastest, but 64 is better on an Alpha with
-// GCC at -O3 optimization so try your options and see what's best for you
-//
-
-typedef unsigned long uint32;
+// (uint32 is defined in twister.h)
 
 #define N              (624)                 // length of state vector
 #define M              (397)                 // a period parameter
@@ -64,11 +59,12 @@ typedef unsigned long uint32;
 #define loBits(u)      ((u) & 0x7FFFFFFFU)   // mask     the highest   bit of u
 #define mixBits(u, v)  (hiBit(u)|loBits(v))  // move hi bit of u to hi bit of v
 
-static uint32   state[N+1];     // state vector + 1 extra to not violate ANSI C
-static uint32   *next;          // next random value is computed from here
-static int      left = -1;      // can *next++ this many times before reloading
+// ZKBT says: the state vector, the pointer to the next value, and the count of values left
+//    live in a 'twister' struct, so each cosmic ray generator can have its own;
+//    seedMT/randomMT/ranMT still use one shared generator, as before.
+static twister shared = {{0}, NULL, -1};
 
-void seedMT(uint32 seed)
+void seedTwister(twister *t, uint32 seed)
  {
     //
     // We initialize state[0..(N-1)] via the generator
@@ -116,23 +112,24 @@ void seedMT(uint32 seed)
     // so-- that's why the only change I made is to restrict to odd seeds.
     //
 
-    register uint32 x = (seed | 1U) & 0xFFFFFFFFU, *s = state;
+    register uint32 x = (seed | 1U) & 0xFFFFFFFFU, *s = t->state;
     register int    j;
 
-    for(left=0, *s++=x, j=N; --j;
+    for(t->left=0, *s++=x, j=N; --j;
         *s++ = (x*=69069U) & 0xFFFFFFFFU);
  }
 
 
-uint32 reloadMT(void)
+static uint32 reloadTwister(twister *t)
  {
+    uint32 *state = t->state;
     register uint32 *p0=state, *p2=state+2, *pM=state+M, s0, s1;
     register int    j;
 
-    if(left < -1)
-        seedMT(4357U);
+    if(t->left < -1)
+        seedTwister(t, 4357U);
 
-    left=N-1, next=state+1;
+    t->left=N-1, t->next=state+1;
 
     for(s0=state[0], s1=state[1], j=N-M+1; --j; s0=s1, s1=*p2++)
         *p0++ = *pM++ ^ (mixBits(s0, s1) >> 1) ^ (loBit(s1) ? K : 0U);
@@ -148,14 +145,14 @@ uint32 reloadMT(void)
  }
 
 
-uint32 randomMT(void)
+uint32 randomTwister(twister *t)
  {
     uint32 y;
 
-    if(--left < 0)
-        return(reloadMT());
+    if(--t->left < 0)
+        return(reloadTwister(t));
 
-    y  = *next++;
+    y  = *t->next++;
     y ^= (y >> 11);
     y ^= (y <<  7) & 0x9D2C5680U;
     y ^= (y << 15) & 0xEFC60000U;
@@ -163,15 +160,35 @@ uint32 randomMT(void)
  }
 
 // AML code July 8, 2014
-double ranMT(void)
+double ranTwister(twister *t)
  {
    uint32 r;
 
-   r = randomMT();
+   r = randomTwister(t);
    // fprintf(stderr,"r = %lu\n",r);
    return( ((double) r)/4294967296.0);
  }
 
+void seedMT(uint32 seed)
+ {
+    seedTwister(&shared, seed);
+ }
+
+uint32 reloadMT(void)
+ {
+    return(reloadTwister(&shared));
+ }
+
+uint32 randomMT(void)
+ {
+    return(randomTwister(&shared));
+ }
+
+double ranMT(void)
+ {
+    return(ranTwister(&shared));
+ }
+
 // #ifdef NOCOMPILE
 int dontdo_main(void)
  {
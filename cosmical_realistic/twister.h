@@ -1,4 +1,6 @@
 // From twister.c
+#ifndef TWISTER_H
+#define TWISTER_H
 
 //
 // uint32 must be an unsigned integer type capable of holding at least 32
@@ -7,7 +9,22 @@
 //
 
 typedef unsigned long uint32;
+
+// the state of one generator (so several can run side by side)
+typedef struct {
+    uint32 state[624+1];
+    uint32 *next;
+    int left;
+} twister;
+
+extern void seedTwister(twister *t, uint32 seed);
+extern uint32 randomTwister(twister *t);
+extern double ranTwister(twister *t);
+
+// the original interface, using one shared generator
 extern void seedMT(uint32 seed);
 extern uint32 reloadMT(void);
 extern uint32 randomMT(void);
 extern double ranMT(void);
+
+#endif
@@ -79,6 +79,15 @@ camerakw = dict(
     #  (set to integer > 1 to speed up time)
     counterstep=1,
 
+    # what seed should the random numbers in the exposures be derived from?
+    #  (each exposure gets its own generator from (seed, cadence, ccd, counter);
+    #   if None, a seed is drawn at random when the camera is created)
+    seed=None,
+
+    # what kind of numbers should the images be built up from?
+    #  (float32 halves the memory of float64, and is plenty for counts of electrons)
+    imagedtype='float32',
+
     # how many fake postage stamps per CCD should be made, for each cadence?
     # three options:
     #   if None, then create a full-frame image, for that cadence
@@ -178,6 +187,40 @@ exposekw = dict(
     # should readout smear be included?
     smear=False,
 
+    # with a variable focus, should star images be blended from images cached at the PSF library's focus nodes?
+    #   (much faster, but the cached images are only reused while the stars stay put, so it's best without jitter)
+    focusbasis=False,
+
+    # how far (in pixels) can stars drift (e.g. from aberration) before the cached focus images are remade?
+    focusbasistolerance=0.01,
+
+    # should stars be drawn as a (sparse) matrix of cached PSFs times each star's brightness?
+    #   (only brightnesses change from exposure to exposure, until stars drift by more than the tolerance)
+    designmatrix=False,
+
+    # how far (in pixels) can stars drift before the cached matrix of PSFs is remade?
+    designmatrixtolerance=0.01,
+
+    # should saturated pixels only be looked for in the columns around bright stars (and saturated cosmic rays)?
+    #   (False checks every column of the image, which is slower but makes no assumptions)
+    bleedwindows=True,
+
+    # should photon and read noise be added with one draw per pixel, of their combined variance?
+    #   (this happens before cosmics, smear, and bleeding; False adds the read noise last, on its own)
+    combinenoise=True,
+
+    # below how many electrons should a pixel's photon noise be drawn from an exact Poisson distribution?
+    #   (0 uses the Gaussian approximation everywhere)
+    poissonbelow=0.0,
+
+    # how many threads should draw the noise, in blocks of rows? (None = one per core, split between
+    #   the processes exposing at once, if parallel or processes > 1)
+    noisethreads=None,
+
+    # the smooth backgrounds are calculated on an NxN grid of pixels over each CCD, and interpolated from there
+    #   (a finer grid is used if needed, to stay within 0.1%; None calculates them exactly at every pixel)
+    backgroundgrid=33,
+
     # should we skip cosmic injection?
     skipcosmics=True,
 
@@ -187,6 +230,20 @@ exposekw = dict(
     # should diffusion of cosmics be done?
     cosmicsdiffusion=True,
 
+    # should cosmics be kept as a list of the pixels they hit, rather than a whole image?
+    #   (they're added straight into those pixels, and written as a FITS table if writecosmics is set)
+    sparsecosmics=True,
+
+    # how many threads should generate the cosmic rays, in tiles of rows? (None = one per core, split between
+    #   the processes exposing at once, if parallel or processes > 1)
+    #   (the cosmic rays come out the same, however many threads there are)
+    cosmicthreads=None,
+
+    # for each cadence, how many pre-generated cosmic ray images should exposures draw from? (0 = generate new ones)
+    #   (each exposure takes a randomly flipped, rotated, and offset window from one of them; much faster for
+    #    thousands of 2s exposures. The library is made once, and kept in $SPYFFIDATA/intermediates/cosmics)
+    cosmiclibrary={2:0, 20:0, 120:0, 1800:0},
+
     # should we pretend cosmics don't exist?
     correctcosmics=True,
 
@@ -203,6 +260,17 @@ observationkw = dict(
     # if collate is False,
     #   ccds will expose in order [1,1,1,...,2,2,2,...,3,3,3,...,4,4,4...]
     collate = True,
+
+    # if parallel is True,
+    #   all the ccds will expose at the same time, each in its own process
+    #   (sharing the PSF library and catalog, which are loaded before the processes start)
+    parallel = False,
+
+    # how many processes should share the exposures of each cadence?
+    #   (each takes a range of counters; images are identical to making them all in one process)
+    #   processes > 1 takes precedence over collate (each process exposes all the ccds at each of its
+    #   counters, in turn), and can't be combined with parallel
+    processes = 1,
     # type
 )
 
@@ -3,7 +3,9 @@ documented_keywords = {
                 'skykw': '???',
                 'lckw': '???'},
     'observation': {'cadencestodo': '???',
-                    'collate': '???'},
+                    'collate': '???',
+                    'parallel': 'If True, expose all the CCDs at the same time, each in its own process',
+                    'processes': 'How many processes should share (ranges of) the exposures of each cadence'},
     'camera': {'cadence': 'Do not use, use observation.cadencestodo',
                'ra': 'Right Ascension of field center',
                'dec': 'Declination of field center',
@@ -15,6 +17,8 @@ documented_keywords = {
                                    'Otherwise, use False',
                'abberate': 'If True, apply abberation of light to star positions',
                'counterstep': 'Normally 1. Scales the time between exposures',
+               'seed': 'Seed from which the random numbers of every exposure are derived (None to draw one)',
+               'imagedtype': "Numerical type of the simulated images (normally 'float32')",
                'positionangle': 'Unimplemented, do not use',
 
                },
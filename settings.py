@@ -1,6 +1,7 @@
 """Global settings required needed for TESS SPyFFI simulations."""
 import os
 import logging
+import numpy as np
 # noinspection PyUnresolvedReferences
 from sh import wget, tar, rm, shasum
 
@@ -83,3 +84,15 @@ plots = dirs['plots']
 inputs = dirs['inputs']
 outputs = dirs['outputs']
 intermediates = dirs['intermediates']
+
+
+def partialFilename(filename):
+    """A temporary name to write filename under, unique to this process (so no one loads a half-written file)."""
+    return '{0}.partial{1}.npy'.format(filename, os.getpid())
+
+
+def saveAtomically(filename, array):
+    """Save an array to filename (as np.save would), appearing there only once it's completely written."""
+    partial = partialFilename(filename)
+    np.save(partial, array)
+    os.rename(partial, filename)
@@ -41,7 +41,10 @@ setup(
                             "cosmical_realistic/cosmical.c",
                             "cosmical_realistic/twister.c",
                             "cosmical_realistic/seed_tw_ran.c",
-			    "cosmical_realistic/fmemopen.c"])],
+			    "cosmical_realistic/fmemopen.c"],
+                           # (cosmical.c generates tiles of cosmic rays in threads)
+                           extra_compile_args=['-pthread'],
+                           extra_link_args=['-pthread'])],
     # Uncomment this if there's a tagged release that's the same as VERSION, and SPyFFI is publicly released
     download_url = 'https://github.com/TESScience/SPyFFI/tarball/{}'.format(VERSION),
 )
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# check that bleeding saturated runs as arrays (CCD.bleedColumns) matches the old column-by-column loop
+
+from __future__ import print_function
+
+import numpy as np
+import scipy.ndimage.measurements
+import checks
+# noinspection PyUnresolvedReferences
+from SPyFFI.CCD import bleedColumns
+
+
+def oldPass(image, saturation_limit):
+    """One pass of the original bleedSaturated loop (over every column, one run at a time)."""
+    oversaturated = image > saturation_limit
+    saturated = image >= saturation_limit
+    for x in range(image.shape[1]):
+        regions, nregions = scipy.ndimage.measurements.label(saturated[:, x])
+        for i in np.arange(nregions) + 1:
+            y = (regions == i).nonzero()[0]
+            if oversaturated[y, x].any():
+                fluxtodistribute = np.sum(image[y, x])
+                npixels = (fluxtodistribute / saturation_limit)
+                center = np.mean(y)
+                grow = (npixels - 1.0) / 2.0
+                indices = np.arange(np.maximum(np.ceil(center - grow).astype(np.int), 0),
+                                    np.minimum(np.floor(center + grow).astype(np.int), image.shape[0] - 1) + 1)
+                existingflux = np.sum(image[indices, x])
+                image[indices, x] = saturation_limit
+                leftoverflux = existingflux - indices.shape[0] * saturation_limit
+                image[indices.min() - 1, x] += leftoverflux / 2.0
+                image[indices.max() + 1, x] += leftoverflux / 2.0
+
+
+def bleed(image, saturation_limit, onepass):
+    """Keep bleeding until nothing is oversaturated (or for 10 passes, like CCD.bleedSaturated)."""
+    for count in range(10):
+        if not (image > saturation_limit).any():
+            break
+        onepass(image, saturation_limit)
+    return image
+
+
+# a field of stars (some bright enough to bleed, some in pairs close enough along a column to interfere),
+#  kept far enough from the top and bottom that no bleed trail reaches the edge (where the old loop wrapped around)
+prng = np.random.RandomState(0)
+saturation_limit = 1.0e5
+nrows, ncols = 400, 80
+y, x = np.mgrid[:nrows, :ncols]
+image = prng.uniform(0, 100, (nrows, ncols))
+for i in range(60):
+    xc, yc = prng.uniform(0, ncols), prng.uniform(100, nrows - 100)
+    image += 10 ** prng.uniform(4, 6.5) * np.exp(-0.5 * ((x - xc) ** 2 + (y - yc) ** 2) / 1.5 ** 2)
+for i in range(10):
+    xc, yc = prng.uniform(0, ncols), prng.uniform(120, nrows - 140)
+    for dy in [0, prng.uniform(4, 15)]:
+        image += 10 ** prng.uniform(5.5, 6.5) * np.exp(-0.5 * ((x - xc) ** 2 + (y - yc - dy) ** 2) / 1.5 ** 2)
+
+old = bleed(image.copy(), saturation_limit, oldPass)
+new = bleed(image.copy(), saturation_limit, bleedColumns)
+
+print('{0} oversaturated pixels; total charge changed by {1:.2e} (old) and {2:.2e} (new)'.format(
+    np.sum(image > saturation_limit), np.sum(old) / np.sum(image) - 1, np.sum(new) / np.sum(image) - 1))
+checks.compare('the bled images', np.max(np.abs(new - old)) / saturation_limit, 1e-9, 'of the saturation limit')
+checks.finish()
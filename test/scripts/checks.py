@@ -0,0 +1,26 @@
+# bookkeeping shared by the *_check scripts: note what fails as they go, then exit with 1 at the end if anything did
+
+from __future__ import print_function
+
+import sys
+
+failures = []
+
+
+def require(label, ok):
+    """Note a failure (by its label) unless ok."""
+    if not ok:
+        failures.append(label)
+
+
+def compare(label, difference, tolerance, units=''):
+    """Report how much two things differ by, and note a failure if it's more than tolerance (or isn't a number)."""
+    print('{0}: differ by up to {1:.2e}{2}'.format(label, difference, ' ' + units if units else ''))
+    require(label, difference <= tolerance)
+
+
+def finish():
+    """List what failed (if anything) and exit with 1."""
+    if len(failures) > 0:
+        print('FAILED: ' + ', '.join(failures), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# check that cosmic rays can be drawn from a library (with either kind of numpy generator), in a real observation
+
+from __future__ import print_function
+
+import os
+import copy
+import glob
+import numpy as np
+import astropy.io.fits
+import checks
+# noinspection PyUnresolvedReferences
+from SPyFFI.Observation import Observation, default
+# noinspection PyUnresolvedReferences
+from SPyFFI.CCD import exposurePRNG
+# noinspection PyUnresolvedReferences
+from SPyFFI import CosmicLibrary
+
+# a small library, drawn from with the exposure generator (whatever this numpy has) and with an old RandomState
+library = CosmicLibrary.load(3, 50, 1800, margin=10)
+for prng in [exposurePRNG(42, 1800, 1, 0, stream=1), np.random.RandomState(0)]:
+    image, choices = library.draw(prng)
+    same = np.array_equal(image, library.window(**choices))
+    print('{0}: drew {1} (with {2:.0f} electrons of cosmic rays)'.format(
+        type(prng).__name__, choices, float(np.sum(image))))
+    checks.require('drawing with a ' + type(prng).__name__, image.shape == (50, 50) and same and np.sum(image) > 0)
+
+# a short observation, with the cosmic rays taken from a library
+inputs = copy.deepcopy(default)
+inputs['camera']['label'] = 'cosmiclibrarytest'
+inputs['camera']['subarray'] = 100
+inputs['camera']['seed'] = 42
+inputs['catalog']['name'] = 'testpattern'
+inputs['expose']['skipcosmics'] = False
+inputs['expose']['correctcosmics'] = False
+inputs['expose']['cosmiclibrary'] = {1800: 3}
+inputs['observation']['cadencestodo'] = {1800: 2}
+o = Observation(inputs)
+o.create()
+
+filenames = sorted(glob.glob(os.path.join(o.camera.ccds[0].directory, 'simulated_*.fits*')))
+frames = [astropy.io.fits.getheader(f).get('ICRFRAME') for f in filenames]
+print('{0} images, drawn from library images {1}'.format(len(filenames), frames))
+checks.require('the observation', len(filenames) > 0 and None not in frames)
+
+checks.finish()
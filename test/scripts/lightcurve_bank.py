@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# check that a LightCurveBank models and integrates every star's light curve the same way the star's own would
+
+from __future__ import print_function
+
+import numpy as np
+import checks
+# noinspection PyUnresolvedReferences
+from SPyFFI import Lightcurve
+
+
+class Ramp(Lightcurve.LightCurve):
+    """A kind of light curve the bank can't vectorize (so it has to integrate it one star at a time)."""
+
+    def __init__(self, slope=0.01):
+        Lightcurve.LightCurve.__init__(self)
+        self.traits = dict(slope=slope)
+
+    def model(self, t):
+        return self.traits['slope'] * np.sin(t)
+
+
+# a catalog's worth of light curves (constants, sinusoids, and trapezoids, some extreme),
+#  plus a couple the bank can't vectorize and a trapezoid with no flat bottom
+prng = np.random.RandomState(1)
+lightcurves = [Lightcurve.random(prng=prng, fractionwithextremelc=0.05, fractionwithtrapezoid=0.3,
+                                 fractionwithrotation=0.3) for i in range(2000)]
+lightcurves += [Ramp(0.02), Ramp(-0.05), Lightcurve.Trapezoid(P=2.0, E=0.1, D=0.01, T23=0.1, T14=0.1)]
+bank = Lightcurve.LightCurveBank(lightcurves)
+
+
+def check(label, new, old, tolerance=1e-10):
+    """Compare the bank's magnitudes to those of the stars on their own."""
+    checks.compare(label, np.max(np.abs(new - old)), tolerance, 'mag')
+
+
+exptime, bjd = 1800.0 / 60.0 / 60.0 / 24.0, 2457827.3
+times = bjd + np.arange(5) * 0.37
+
+# an instant exposure is just the model
+check('the model, at one time', bank.integrated(bjd, exptime=0.0, resolution=1),
+      np.array([lc.model(np.array([bjd]))[0] for lc in lightcurves]))
+
+# a finite exposure, at one time and at many (in small chunks, to check they're stitched back together)
+check('integrated, at one time', bank.integrated(bjd, exptime),
+      np.array([lc.integrated(bjd, exptime)[0] for lc in lightcurves]))
+check('integrated, at {0} times'.format(len(times)), bank.integrated(times, exptime, chunksize=77),
+      np.array([lc.integrated(times, exptime) for lc in lightcurves]).T)
+
+checks.finish()
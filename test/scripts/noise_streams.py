@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# check that the Noisemaker's noise is fresh on every call, and doesn't depend on how many threads draw it
+
+from __future__ import print_function
+
+import numpy as np
+import checks
+# noinspection PyUnresolvedReferences
+from SPyFFI.Noisemaker import Noisemaker
+
+
+def generator():
+    """The same exposure generator every time (a jumpable one, if this numpy has them)."""
+    try:
+        return np.random.Generator(np.random.PCG64(np.random.SeedSequence([1, 2, 3])))
+    except AttributeError:
+        return np.random.RandomState(123)
+
+
+shape, kw = (300, 300), dict(photons=True, readvariance=100.0)
+
+# two calls with the same exposure generator should draw two different sets of noise
+prng = generator()
+first, second = np.full(shape, 50.0), np.full(shape, 50.0)
+Noisemaker(threads=1).addNoise(first, prng, **kw)
+Noisemaker(threads=1).addNoise(second, prng, **kw)
+correlation = np.corrcoef(first.ravel(), second.ravel())[0, 1]
+print('two successive calls are correlated by {0:.4f}'.format(correlation))
+checks.require('successive calls', np.abs(correlation) < 0.05)
+
+# spreading the blocks over threads should draw exactly the same noise
+threaded = np.full(shape, 50.0)
+Noisemaker(threads=3).addNoise(threaded, generator(), **kw)
+checks.compare('one thread and three threads', np.max(np.abs(threaded - first)), 0.0)
+
+checks.finish()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# check that the Pixelizer's binning matrices bin subpixel PSFs the same way np.histogram2d does
+
+from __future__ import print_function
+
+import numpy as np
+import checks
+# noinspection PyUnresolvedReferences
+from SPyFFI.Pixelizer import Pixelizer
+# noinspection PyUnresolvedReferences
+from SPyFFI.Intrapixel import Perfect, Boxcar
+
+# a subpixel grid like the PSF library's (PSF.setupPixelArrays), but smaller
+nsubpixelsperpixel, npixels = 11, 9
+subpixels_axis = np.arange(nsubpixelsperpixel * npixels) / float(nsubpixelsperpixel)
+subpixels_axis -= np.mean(subpixels_axis)
+pixels_axis = np.arange(np.round(subpixels_axis[0]), np.round(subpixels_axis[-1]) + 1)
+pixels_edges = np.append(pixels_axis - 0.5, pixels_axis[-1] + 0.5)
+x, y = np.meshgrid(subpixels_axis, subpixels_axis)
+
+# a lopsided, positive image to pixelize
+prng = np.random.RandomState(0)
+image = np.exp(-0.5 * ((x - 0.3) ** 2 + (y + 0.2) ** 2 / 2.0)) * prng.uniform(0.5, 1.5, x.shape)
+
+
+def check(label, new, old, tolerance=1e-12):
+    checks.compare(label, np.max(np.abs(new - old)) / np.max(np.abs(old)), tolerance, 'relative to the largest pixel')
+
+
+for intrapixel in [Perfect(), Boxcar()]:
+    pixelizer = Pixelizer(subpixels_axis, pixels_edges, subpixels_axis, pixels_edges, intrapixel)
+
+    # shifts by whole numbers of subpixels should land every subpixel exactly where histogram2d puts it
+    shifts = np.array([0, 1, 5, -7, 13]) / float(nsubpixelsperpixel)
+    for dx, dy in zip(shifts, shifts[::-1]):
+        sx, sy = x + dx, y + dy
+        old, xedges, yedges = np.histogram2d(sy.flatten(), sx.flatten(), bins=[pixels_edges, pixels_edges],
+                                             weights=image.flatten() * intrapixel.prnu(sy.flatten(), sx.flatten()))
+        check('{0} pixels, shifted by ({1:+.3f}, {2:+.3f})'.format(intrapixel.name, dx, dy),
+              pixelizer.pixelize(image, dx, dy), old)
+
+    # a fractional shift is shared between the two nearest whole-subpixel shifts
+    if intrapixel.name == 'perfectpixels':
+        step = 1.0 / nsubpixelsperpixel
+        below, above = pixelizer.pixelize(image, 2 * step, 0.0), pixelizer.pixelize(image, 3 * step, 0.0)
+        check('perfect pixels, shifted by 2.25 subpixels', pixelizer.pixelize(image, 2.25 * step, 0.0),
+              0.75 * below + 0.25 * above)
+
+    # binning a whole grid of shifts at once should match binning them one by one
+    dxs, dys = np.linspace(-0.5, 0.5, 4), np.linspace(-0.5, 0.5, 3)
+    grid = pixelizer.pixelizeGrid(image, dxs, dys)
+    onebyone = np.array([[pixelizer.pixelize(image, dx, dy) for dy in dys] for dx in dxs])
+    check('{0} pixels, a grid of shifts'.format(intrapixel.name), grid, onebyone)
+
+checks.finish()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# check that projecting catalogs through a Pointing lands stars where the camera's WCS would put them
+
+from __future__ import print_function
+
+import copy
+import numpy as np
+import astropy.wcs
+import checks
+# noinspection PyUnresolvedReferences
+from SPyFFI.Pointing import Pointing
+# noinspection PyUnresolvedReferences
+from SPyFFI.Observation import Observation, default
+
+pixelscale = 21.1
+
+
+def check(label, x, y, wcsx, wcsy, tolerance=1e-6):
+    """Compare two sets of focal-plane positions, by the largest difference (in pixels) in either direction."""
+    checks.compare(label, max(np.max(np.abs(x - wcsx)), np.max(np.abs(y - wcsy))), tolerance, 'pixels')
+
+
+def tan(ra, dec, roll=0.0):
+    """A WCS like the camera's (Camera.point), optionally rolled by a PC matrix."""
+    wcs = astropy.wcs.WCS(naxis=2)
+    wcs.wcs.crpix = [0.0, 0.0]
+    wcs.wcs.cdelt = [-pixelscale / 60.0 / 60.0, pixelscale / 60.0 / 60.0]
+    wcs.wcs.crval = [ra, dec]
+    angle = np.radians(roll / 60.0 / 60.0)
+    wcs.wcs.pc = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+    wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    return wcs
+
+
+class Fixed(object):
+    """A catalog of stars that don't move."""
+    epoch = 2000.0
+
+    def __init__(self, ra, dec):
+        self.ra, self.dec = ra, dec
+
+    def atEpoch(self, epoch):
+        return self.ra, self.dec
+
+
+# stars scattered across a whole camera's field (and beyond), at several field centers (one near the pole)
+prng = np.random.RandomState(0)
+for ra, dec in [(270.0, 66.56070833333332), (30.0, -10.0), (0.5, 89.0)]:
+    for roll in [0.0, 7200.0]:
+        wcs = tan(ra, dec, roll)
+        fieldx, fieldy = prng.uniform(-6000, 6000, (2, 10000))
+        catalog = Fixed(*wcs.wcs_pix2world(fieldx, fieldy, 1))
+        x, y = Pointing(ra, dec, pixelscale).project(catalog, catalog.epoch, roll=roll)
+        check('centered on ({0}, {1}), rolled by {2:.0f}"'.format(ra, dec, roll), x, y,
+              *wcs.wcs_world2pix(catalog.ra, catalog.dec, 1))
+
+# a camera's own catalog (with large proper motions), projected at epochs near and far from the catalog's
+#  (a Pointing moves stars in straight lines across the tangent plane, so they drift slightly off decades away)
+inputs = copy.deepcopy(default)
+inputs['camera']['label'] = 'pointingtest'
+inputs['camera']['subarray'] = 200
+inputs['catalog']['name'] = 'testpattern'
+inputs['catalog']['testpatternkw']['randomizepropermotionsby'] = 500.0
+np.random.seed(0)
+camera = Observation(inputs).camera
+for epoch in [2018.0, 2030.0, 1990.0]:
+    x, y = camera.pointing.project(camera.catalog, epoch)
+    ra, dec = camera.catalog.atEpoch(epoch)
+    check("the camera's catalog at {0}".format(epoch), x, y, *camera.wcs.wcs_world2pix(ra, dec, 1), tolerance=1e-3)
+
+checks.finish()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# check that an observation split across processes (in time) makes exactly the same images as one made in turn
+
+from __future__ import print_function
+
+import os
+import copy
+import glob
+import numpy as np
+import astropy.io.fits
+import checks
+# noinspection PyUnresolvedReferences
+from SPyFFI.Observation import Observation, default
+
+outputs = {}
+for label, processes in [('serial', 1), ('sharded', 3)]:
+    # start from the default settings (with a fixed seed, so every exposure's random streams are set)
+    inputs = copy.deepcopy(default)
+    inputs['camera']['label'] = 'shardtest_' + label
+    inputs['camera']['subarray'] = 100
+    inputs['camera']['seed'] = 42
+    inputs['catalog']['name'] = 'testpattern'
+    inputs['catalog']['testpatternkw']['magnitudes'] = [6, 14]
+    inputs['catalog']['testpatternkw']['randomizemagnitudes'] = True
+    inputs['expose']['skipcosmics'] = False
+    inputs['expose']['correctcosmics'] = False
+    inputs['observation']['cadencestodo'] = {1800: 5}
+    inputs['observation']['processes'] = processes
+    # (the test pattern's random magnitudes come from numpy's global generator)
+    np.random.seed(0)
+    o = Observation(inputs)
+    o.create()
+
+    directory = o.camera.ccds[0].directory
+    outputs[label] = sorted(glob.glob(os.path.join(directory, 'simulated_*.fits*')))
+    print('{0}: {1} images in {2}'.format(label, len(outputs[label]), directory))
+
+checks.require('the number of images', len(outputs['serial']) == len(outputs['sharded']) > 0)
+for serial, sharded in zip(outputs['serial'], outputs['sharded']):
+    a, b = astropy.io.fits.getdata(serial), astropy.io.fits.getdata(sharded)
+    checks.compare(os.path.basename(serial), np.max(np.abs(a.astype(np.float64) - b)), 0.0)
+
+checks.finish()
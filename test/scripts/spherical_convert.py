@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# check that Spherical's rotation matrices convert coordinates the same way astropy (and crossfield.euler) do
+
+from __future__ import print_function
+
+import numpy as np
+import astropy.coordinates
+import astropy.units as u
+import zachopy.borrowed.crossfield as crossfield
+import checks
+# noinspection PyUnresolvedReferences
+from SPyFFI import Spherical
+
+# points spread evenly over the whole sky
+prng = np.random.RandomState(1)
+n = 10000
+ra, dec = prng.uniform(0, 360, n), np.degrees(np.arcsin(prng.uniform(-1, 1, n)))
+
+
+def check(label, lon, lat, otherlon, otherlat, tolerance):
+    """Compare two sets of positions (in degrees), by the largest angle (in milliarcseconds) between them."""
+    a, b = Spherical.unitVectors(lon, lat), Spherical.unitVectors(otherlon, otherlat)
+    separation = np.degrees(np.arctan2(np.linalg.norm(np.cross(a.T, b.T), axis=1), np.sum(a * b, 0))) * 3600e3
+    checks.compare(label, np.max(separation), tolerance, 'mas')
+
+
+# galactic coordinates should match astropy's (the matrix is made from astropy, so to rounding error)
+galactic = astropy.coordinates.SkyCoord(ra=ra * u.deg, dec=dec * u.deg, frame='icrs').galactic
+glon, glat = Spherical.convert(ra, dec, 'celestial', 'galactic')
+check('celestial to galactic, vs SkyCoord', glon, glat, galactic.l.degree, galactic.b.degree, 1e-3)
+
+# ecliptic coordinates should match crossfield.euler, which they replaced (to its rounding of the angles involved)
+elon, elat = Spherical.convert(ra, dec, 'celestial', 'ecliptic')
+check('celestial to ecliptic, vs crossfield.euler', elon, elat, *crossfield.euler(ra, dec, select=3), tolerance=0.1)
+
+# going around through every frame (the last step in place) should come back to where it started
+lon, lat = Spherical.convert(glon, glat, 'galactic', 'ecliptic')
+lon, lat = Spherical.convert(lon, lat, 'ecliptic', 'celestial', out=(lon, lat))
+check('celestial to galactic to ecliptic to celestial', lon, lat, ra, dec, 1e-3)
+
+checks.finish()